@@ -0,0 +1,327 @@
+#!/usr/bin/python
+from array import array
+from calendar import timegm
+from glob import glob
+from heapq import merge
+from logging import getLogger
+from mmap import ACCESS_READ, mmap
+from os import makedirs, remove, rename
+from os.path import basename, join
+from struct import Struct
+from threading import Lock
+from time import gmtime, strftime, strptime, time
+from zlib import compressobj
+
+from metrics import Counter
+from units import canonical_units, get_conversion
+
+log = getLogger(__name__)
+
+chunks_written = Counter('pienviro_archive_chunks_written_total', 'Archive chunk files written.')
+rows_exported = Counter('pienviro_archive_rows_exported_total', 'Rows streamed by archive exports.', ('format',))
+
+
+class ArchiveChunk(object):
+    """
+    One hour (or day) of archived samples in a read-only columnar file.
+    The header holds the chunk start time and an index with, for every
+    channel, its sample count, data offset and first and last sample
+    time. Each channel's data is a column of timestamp deltas (uint32
+    milliseconds since the previous sample, the first since chunk start)
+    followed by a column of float32 values, so a sample takes 8 bytes
+    (vs 24 in the spool). Columns are read straight out of a memory map,
+    without copying or decoding the whole file.
+    """
+
+    header = Struct('<4sHHqI') # magic, version, channel count, start time (ms since epoch), chunk length (sec)
+    index_entry = Struct('<B3xIIqq') # channel id, (padding), sample count, data offset, first and last time (ms since epoch)
+    magic = b'PEAC'
+    version = 1
+
+    def __init__(self, path):
+        """
+        Constructor, opens and maps chunk file.
+        :param path: Chunk file path.
+        """
+        self.path = path
+        with open(path, 'rb') as chunk_file:
+            self._map = mmap(chunk_file.fileno(), 0, access=ACCESS_READ)
+        magic, version, channel_count, self.start_ms, self.chunk_sec = self.header.unpack_from(self._map)
+        if magic != self.magic or version != self.version:
+            self._map.close()
+            raise ValueError('Invalid archive chunk ({})'.format(path))
+        self.index = {} # channel id -> (count, offset, first time, last time)
+        for i in range(channel_count):
+            channel_id, count, offset, first_ms, last_ms = self.index_entry.unpack_from(self._map, self.header.size + i * self.index_entry.size)
+            self.index[channel_id] = (count, offset, first_ms, last_ms)
+
+    @classmethod
+    def write(cls, path, start_ms, chunk_sec, columns):
+        """
+        Write chunk file. The file is written under a temporary name and
+        renamed, so readers never see a partial chunk.
+        :param path: Chunk file path.
+        :param start_ms: Chunk start time, in ms since epoch.
+        :param chunk_sec: Chunk length, in seconds.
+        :param columns: Dict of channel id to (times, values), where
+        times is a sorted sequence of ms since epoch.
+        """
+        offset = cls.header.size + len(columns) * cls.index_entry.size
+        head = [cls.header.pack(cls.magic, cls.version, len(columns), start_ms, chunk_sec)]
+        data = []
+        for channel_id, (times, values) in sorted(columns.items()):
+            deltas = array('I', (t - previous for t, previous in zip(times, [start_ms] + list(times[:-1]))))
+            head.append(cls.index_entry.pack(channel_id, len(times), offset, times[0], times[-1]))
+            data.append(deltas.tobytes())
+            data.append(array('f', values).tobytes())
+            offset += 8 * len(times)
+        with open(path + '.tmp', 'wb') as chunk_file:
+            chunk_file.write(b''.join(head + data))
+        rename(path + '.tmp', path)
+
+    def samples(self, channel_id, since_ms=None, until_ms=None):
+        """
+        Return iterator of (time in ms since epoch, value) for channel.
+        :param channel_id: Channel id.
+        :param since_ms: Skip samples older than this.
+        :param until_ms: Stop at samples this new or newer.
+        """
+        if channel_id not in self.index:
+            return
+        count, offset, first_ms, last_ms = self.index[channel_id]
+        if (since_ms is not None and last_ms < since_ms) or (until_ms is not None and first_ms >= until_ms):
+            return
+        with memoryview(self._map) as view, view[offset:offset + 4 * count].cast('I') as deltas, \
+                view[offset + 4 * count:offset + 8 * count].cast('f') as values:
+            t = self.start_ms
+            for delta, value in zip(deltas, values):
+                t += delta
+                if since_ms is not None and t < since_ms:
+                    continue
+                if until_ms is not None and t >= until_ms:
+                    break
+                yield t, value
+
+    def close(self):
+        self._map.close()
+
+
+class SampleArchive(object):
+    """
+    Long-term archive of every sample, rolled into one columnar chunk
+    file (see ArchiveChunk) per chunk_sec period. Samples of the current
+    period are buffered in memory and written as a chunk once a sample
+    from the next period arrives. The current period is not written on
+    shutdown, it is rebuilt from the spool on startup instead, so each
+    chunk is written exactly once and never modified. Chunks older than
+    retention_sec are deleted.
+    """
+
+    def __init__(self, archive_dir, channels, chunk_sec=3600, retention_sec=365*24*60*60):
+        """
+        Constructor.
+        :param archive_dir: Directory for chunk files.
+        :param channels: List of channel names. Chunks store the index
+        of the channel in this list, so only append to the end of it.
+        :param chunk_sec: Period covered by each chunk, in seconds (an
+        hour or a day).
+        :param retention_sec: Minimum age of a chunk before it is
+        deleted, in seconds.
+        """
+        makedirs(archive_dir, exist_ok=True)
+        self._archive_dir = archive_dir
+        self._channels = list(channels)
+        self._channel_ids = dict((channel, i) for i, channel in enumerate(self._channels))
+        self._chunk_sec = int(chunk_sec)
+        self.retention_sec = retention_sec
+        self._chunks = {} # start time (sec since epoch) -> path, of written chunks
+        self._period = None # start of buffered period
+        self._buffer = {} # channel id -> (times, values) arrays
+        self._lock = Lock()
+        for path in glob(join(archive_dir, '*.chunk')):
+            self._chunks[timegm(strptime(basename(path)[:-len('.chunk')], '%Y%m%d%H'))] = path
+
+    def _period_start(self, timestamp):
+        return int(timestamp) // self._chunk_sec * self._chunk_sec
+
+    ####################################################################
+
+    def append(self, timestamp, samples):
+        """
+        Add batch of samples read at the same time. Samples for periods
+        that are already written (e.g. replayed from the spool) are
+        skipped.
+        :param timestamp: Sample time, in seconds since epoch.
+        :param samples: Dict of channel name to value, in canonical
+        units.
+        """
+        period = self._period_start(timestamp)
+        time_ms = int(round(timestamp * 1000))
+        with self._lock:
+            if period in self._chunks:
+                return
+            if self._period is None or period > self._period:
+                self._write_buffer()
+                self._period = period
+            elif period < self._period:
+                log.debug('Dropping archive samples older than current period (%s)', timestamp)
+                return
+            for channel, value in samples.items():
+                channel_id = self._channel_ids[channel]
+                if channel_id not in self._buffer: self._buffer[channel_id] = (array('q'), array('f'))
+                times, values = self._buffer[channel_id]
+                times.append(time_ms)
+                values.append(value)
+
+    def _write_buffer(self):
+        """
+        Write buffered period to chunk file, then delete expired chunks.
+        Must be called with lock held.
+        """
+        if not self._buffer:
+            return
+        columns = {}
+        for channel_id, (times, values) in self._buffer.items():
+            order = sorted(range(len(times)), key=times.__getitem__) # samples may arrive slightly out of order
+            columns[channel_id] = ([times[i] for i in order], [values[i] for i in order])
+        path = join(self._archive_dir, strftime('%Y%m%d%H', gmtime(self._period)) + '.chunk')
+        try:
+            ArchiveChunk.write(path, self._period * 1000, self._chunk_sec, columns)
+            self._chunks[self._period] = path
+            chunks_written.inc()
+        except (IOError, OSError) as err:
+            log.error('Failed to write archive chunk %s (%s)!', path, err)
+        self._buffer = {}
+        self._delete_expired()
+
+    def _delete_expired(self):
+        """
+        Delete chunks older than retention. Must be called with lock
+        held.
+        """
+        oldest = time() - self.retention_sec
+        for period in sorted(self._chunks):
+            if period + self._chunk_sec >= oldest:
+                break
+            try:
+                remove(self._chunks[period])
+            except OSError as err:
+                log.warning('Failed to delete archive chunk %s (%s)!', self._chunks[period], err)
+            del self._chunks[period]
+
+    ####################################################################
+
+    def rows(self, since=None, until=None):
+        """
+        Return iterator of (timestamp, samples) rows, oldest first, where
+        samples is a dict of channel name to value in canonical units.
+        Chunks are read one at a time, so memory use doesn't grow with
+        the range.
+        :param since: Skip samples older than this, in seconds since
+        epoch.
+        :param until: Stop at samples this new or newer, in seconds since
+        epoch.
+        """
+        since_ms = int(round(since * 1000)) if since is not None else None
+        until_ms = int(round(until * 1000)) if until is not None else None
+        with self._lock:
+            periods = sorted(period for period in self._chunks
+                             if (since is None or period + self._chunk_sec > since) and (until is None or period < until))
+            paths = [self._chunks[period] for period in periods]
+            buffered = dict((channel_id, (times[:], values[:])) for channel_id, (times, values) in self._buffer.items()) # at most one period
+        for path in paths:
+            try:
+                chunk = ArchiveChunk(path)
+            except (IOError, OSError, ValueError) as err: # deleted by retention, or corrupt
+                log.warning('Skipping archive chunk %s (%s)', path, err)
+                continue
+            columns = dict((channel_id, chunk.samples(channel_id, since_ms, until_ms)) for channel_id in chunk.index)
+            try:
+                for row in self._merge(columns):
+                    yield row
+            finally:
+                for column in columns.values():
+                    column.close() # releases its views of the map, e.g. if the client went away mid-export
+                chunk.close()
+        columns = {}
+        for channel_id, (times, values) in buffered.items():
+            columns[channel_id] = sorted((t, value) for t, value in zip(times, values)
+                                         if (since_ms is None or t >= since_ms) and (until_ms is None or t < until_ms))
+        for row in self._merge(columns):
+            yield row
+
+    @staticmethod
+    def _tag(channel_id, column):
+        for t, value in column:
+            yield t, channel_id, value
+
+    def _merge(self, columns):
+        """
+        Merge per-channel (time, value) columns back into rows of samples
+        that share a timestamp.
+        """
+        timestamp, samples = None, {}
+        for t, channel_id, value in merge(*[self._tag(channel_id, column) for channel_id, column in columns.items()]):
+            if t != timestamp and samples:
+                yield timestamp / 1000.0, samples
+                samples = {}
+            timestamp = t
+            samples[self._channels[channel_id]] = value
+        if samples:
+            yield timestamp / 1000.0, samples
+
+
+########################################################################
+
+export_formats = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+
+
+def export_lines(rows, units, export_format='csv', rows_per_block=1000, gzip=False):
+    """
+    Return iterator of encoded blocks of export lines, for streaming.
+    Rows are formatted in blocks, so a response is a few hundred writes
+    per month of data rather than one per row.
+    :param rows: Iterator of (timestamp, samples) rows, in canonical
+    units (see SampleArchive.rows).
+    :param units: Dict of channel name to output unit (see
+    units.resolve_units). Only these channels are exported, in this
+    order.
+    :param export_format: 'csv' (header row, empty field for a missing
+    value) or 'ndjson' (one JSON object per row, missing values left
+    out).
+    :param rows_per_block: Number of rows per block.
+    :param gzip: If True blocks are gzip compressed.
+    """
+    if export_format not in export_formats:
+        raise ValueError('Unknown export format "{}", expected one of {}'.format(export_format, ', '.join(sorted(export_formats))))
+    channels = list(units)
+    conversions = [get_conversion(canonical_units[channel], units[channel]) for channel in channels]
+    compressor = compressobj(6, wbits=31) if gzip else None # gzip container
+    exported = rows_exported.labels(export_format)
+
+    def encode(lines):
+        block = ''.join(lines).encode('utf-8')
+        return compressor.compress(block) if compressor is not None else block
+
+    lines = []
+    count = 0 # rows in lines
+    if export_format == 'csv':
+        lines.append('time,{}\n'.format(','.join('{}_{}'.format(channel, units[channel].replace('%', 'pct')) for channel in channels)))
+    for timestamp, samples in rows:
+        values = [samples.get(channel) for channel in channels]
+        if export_format == 'csv':
+            lines.append('{:.3f},{}\n'.format(timestamp, ','.join('{:.6g}'.format(convert(value)) if value is not None else ''
+                                                                   for convert, value in zip(conversions, values))))
+        else:
+            lines.append('{{"time":{:.3f}{}}}\n'.format(timestamp, ''.join(',"{}":{:.6g}'.format(channel, convert(value))
+                                                                           for channel, convert, value in zip(channels, conversions, values) if value is not None)))
+        count += 1
+        if count >= rows_per_block:
+            exported.inc(count)
+            yield encode(lines)
+            lines, count = [], 0
+    if lines:
+        exported.inc(count)
+        yield encode(lines)
+    if compressor is not None:
+        yield compressor.flush()
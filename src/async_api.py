@@ -0,0 +1,256 @@
+#!/usr/bin/python
+import asyncio
+from io import BytesIO
+from logging import getLogger
+from sys import stderr
+from threading import Event
+from time import monotonic
+from urllib.parse import unquote
+
+from responses import request_latency
+
+log = getLogger(__name__)
+
+
+class AsyncApiServer(object):
+    """
+    Asyncio HTTP/1.1 server for the REST API, with keep-alive. The
+    snapshot routes are answered on the event loop from pre-serialized
+    responses (304 if the client's ETag or Last-Modified is current).
+    Every other route is passed to the Flask (WSGI) app in a worker
+    thread, so all endpoints work in this mode. The live event stream
+    is served natively on the event loop, so hundreds of subscribers
+    don't need a thread each.
+    """
+
+    reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 500: 'Internal Server Error'}
+
+    stream_path = '/stream'
+
+    def __init__(self, wsgi_app, response_cache, broadcaster=None, host='0.0.0.0', port=5000, keepalive_sec=75.0, max_header_bytes=16384):
+        """
+        Constructor.
+        :param wsgi_app: WSGI app for routes not in response_cache.
+        :param response_cache: ResponseCache for the snapshot routes.
+        :param broadcaster: Optional SnapshotBroadcaster, whose
+        subscribers are served on the event loop at '/stream'.
+        :param host: Address to listen on.
+        :param port: Port to listen on (0 picks a free port).
+        :param keepalive_sec: Time an idle connection is kept open.
+        :param max_header_bytes: Maximum size of request headers.
+        """
+        self._wsgi_app = wsgi_app
+        self._cache = response_cache
+        self._broadcaster = broadcaster
+        self._streams = {} # Subscriber -> (asyncio.Event, writer)
+        self._host = host
+        self.port = port
+        self._keepalive_sec = keepalive_sec
+        self._max_header_bytes = max_header_bytes
+        self._loop = None
+        self._stopped = None
+        self._connections = {} # handler task -> writer
+        self.ready = Event()
+
+    def run(self):
+        """
+        Serve until stop() is called.
+        """
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+
+    def stop(self):
+        """
+        Stop serving (safe to call from any thread).
+        """
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        if self._broadcaster is not None:
+            loop = self._loop
+            self._broadcaster.add_publish_hook(lambda: loop.call_soon_threadsafe(self._wake_streams)) # one wakeup per update, not per subscriber
+        server = await asyncio.start_server(self._handle, self._host, self.port, limit=self._max_header_bytes)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await self._stopped.wait()
+            server.close()
+            for writer in self._connections.values():
+                writer.close() # wakes handlers waiting for the next request
+            self._wake_streams()
+            if self._connections:
+                _, pending = await asyncio.wait(list(self._connections), timeout=1.0)
+                for task in pending:
+                    task.cancel()
+
+    ####################################################################
+
+    async def _handle(self, reader, writer):
+        """
+        Serve requests on one connection until the client closes it, asks
+        to close it, or it is idle for keepalive_sec.
+        """
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self._keepalive_sec)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                try:
+                    method, target, version, headers = self._parse_head(head)
+                except ValueError:
+                    writer.write(self._simple_response(400, b'Bad Request', close=True))
+                    break
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0: raise ValueError('negative Content-Length')
+                    body = await reader.readexactly(length) if length else b''
+                except (ValueError, asyncio.IncompleteReadError): # bad Content-Length, or body shorter than it
+                    writer.write(self._simple_response(400, b'Bad Request', close=True))
+                    break
+                keep_alive = headers.get('connection', '').lower() != 'close' if version == 'HTTP/1.1' else headers.get('connection', '').lower() == 'keep-alive'
+                start = monotonic()
+                path, _, query = target.partition('?')
+                if path == self.stream_path and method == 'GET' and self._broadcaster is not None:
+                    await self._stream(writer, query, headers)
+                    break
+                try:
+                    cached = self._cache.get(path, query) if method in ('GET', 'HEAD') else None
+                except ValueError as err: # unknown unit
+                    writer.write(self._simple_response(400, str(err).encode('utf-8'), close=not keep_alive))
+                    await writer.drain()
+                    if not keep_alive:
+                        break
+                    continue
+                if cached is not None:
+                    not_modified = cached.is_not_modified(headers.get('if-none-match'), headers.get('if-modified-since'))
+                    raw = cached.raw_not_modified if not_modified else cached.raw_ok
+                    if method == 'HEAD': raw = raw[:raw.index(b'\r\n\r\n') + 4]
+                    if not keep_alive: raw = raw.replace(b'\r\n', b'\r\nConnection: close\r\n', 1)
+                    writer.write(raw)
+                    request_latency.labels(path).observe(monotonic() - start) # Flask routes are timed by the app
+                else:
+                    await self._call_wsgi(writer, method, unquote(path), query, version, headers, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self._connections[asyncio.current_task()]
+            writer.close()
+
+    async def _stream(self, writer, query, headers):
+        """
+        Serve server-sent event stream until the client goes away, the
+        subscriber is evicted for falling behind, or the server stops.
+        Events are encoded once by the broadcaster and written as is.
+        """
+        try:
+            subscriber = self._broadcaster.subscribe(query, headers.get('last-event-id'))
+        except ValueError as err: # unknown unit
+            writer.write(self._simple_response(400, str(err).encode('utf-8'), close=True))
+            return
+        wakeup = asyncio.Event()
+        self._streams[subscriber] = (wakeup, writer)
+        try:
+            writer.write('HTTP/1.1 200 OK\r\nContent-Type: {}\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n'
+                         .format(self._broadcaster.content_type).encode('latin-1') + self._broadcaster.preamble)
+            while not subscriber.evicted and not self._stopped.is_set():
+                events = subscriber.take()
+                writer.write(b''.join(events) if events else self._broadcaster.keepalive)
+                await writer.drain()
+                wakeup.clear()
+                if not subscriber.queue:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), self._broadcaster.keepalive_sec)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            del self._streams[subscriber]
+            self._broadcaster.unsubscribe(subscriber)
+
+    def _wake_streams(self):
+        """
+        Wake every stream after an update. Evicted subscribers have their
+        connection closed, which also ends a write stuck on a slow
+        client.
+        """
+        for subscriber, (wakeup, writer) in list(self._streams.items()):
+            if subscriber.evicted: writer.close()
+            wakeup.set()
+
+    @staticmethod
+    def _parse_head(head):
+        """
+        Return (method, target, version, headers) from request head.
+        Header names are lower case.
+        """
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    def _simple_response(self, status, body, close=False):
+        """
+        Return raw plain text response.
+        """
+        return 'HTTP/1.1 {} {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n{}\r\n'\
+            .format(status, self.reasons.get(status, ''), len(body), 'Connection: close\r\n' if close else '').encode('latin-1') + body
+
+    ####################################################################
+
+    async def _call_wsgi(self, writer, method, path, query, version, headers, body, keep_alive):
+        """
+        Run WSGI app in a worker thread and stream its response. The body
+        is sent with chunked encoding unless the app sets Content-Length,
+        so streaming endpoints work.
+        """
+        environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': query,
+                   'SERVER_NAME': self._host, 'SERVER_PORT': str(self.port), 'SERVER_PROTOCOL': version,
+                   'CONTENT_TYPE': headers.get('content-type', ''), 'CONTENT_LENGTH': headers.get('content-length', ''),
+                   'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(body), 'wsgi.errors': stderr,
+                   'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False}
+        for name, value in headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        started = []
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(None, self._wsgi_app, environ, start_response)
+        except Exception as err:
+            log.error('API request failed (%s)!', err)
+            writer.write(self._simple_response(500, b'Internal Server Error', close=not keep_alive))
+            return
+        iterator = iter(result)
+        try:
+            status, response_headers = started
+            chunked = method != 'HEAD' and not any(name.lower() == 'content-length' for name, _ in response_headers)
+            head = 'HTTP/1.1 {}\r\n'.format(status) + ''.join('{}: {}\r\n'.format(name, value) for name, value in response_headers)
+            if chunked: head += 'Transfer-Encoding: chunked\r\n'
+            if not keep_alive: head += 'Connection: close\r\n'
+            writer.write((head + '\r\n').encode('latin-1'))
+            if method == 'HEAD':
+                return
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain()
+            if chunked: writer.write(b'0\r\n\r\n')
+        finally:
+            if hasattr(result, 'close'): result.close()
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+from collections import namedtuple
+from csv import DictReader
+from math import pi, sin
+from random import Random
+from threading import Event, Lock
+from time import time
+
+from cpu_temp import CpuTempSensor
+from screen import ScreenRenderer, sense_hat_glyphs
+
+
+# Same fields as sense_hat.stick.InputEvent
+InputEvent = namedtuple('InputEvent', ['timestamp', 'direction', 'action'])
+
+
+class SenseBackend(object):
+    """
+    Interface to the Sense HAT sensors, LED matrix and joystick. PiEnviro
+    only talks to the hardware through this, so the real Sense HAT can be
+    swapped for a simulated or replayed one.
+    Sensor reads return raw sensor units: degC, % and mbar.
+    """
+
+    low_light = False
+
+    def get_temperature(self):
+        raise NotImplementedError
+
+    def get_humidity(self):
+        raise NotImplementedError
+
+    def get_pressure(self):
+        raise NotImplementedError
+
+    def get_cpu_temperature(self):
+        """
+        Return temperature (degC) of the CPU heating the sensors, used to
+        calibrate temperature readings, or None to skip calibration.
+        """
+        return None
+
+    def set_rotation(self, rotation):
+        raise NotImplementedError
+
+    def set_pixels(self, pixels):
+        raise NotImplementedError
+
+    def get_glyph(self, char):
+        """
+        Return character as a list of columns, each a tuple of 8
+        booleans (True for lit), see screen.sense_hat_glyphs.
+        """
+        raise NotImplementedError
+
+    @property
+    def stick(self):
+        """
+        Joystick, with a wait_for_event() method returning InputEvent.
+        """
+        raise NotImplementedError
+
+    def clear(self, color=(0, 0, 0)):
+        """
+        Set every pixel to color.
+        """
+        self.set_pixels([tuple(color)] * 64)
+
+    def show_message(self, text, scroll_speed=0.1, text_colour=(255, 255, 255), back_colour=(0, 0, 0)):
+        """
+        Scroll message across screen (blocks until done).
+        """
+        renderer = ScreenRenderer(self.get_glyph)
+        renderer.play(renderer.render(text, text_colour, back_colour), scroll_speed, self.set_pixels)
+
+
+class RealSenseHat(SenseBackend):
+    """
+    Backend for the real Sense HAT.
+    """
+
+    def __init__(self, cpu_temp_ttl_sec=1.0):
+        """
+        Constructor.
+        :param cpu_temp_ttl_sec: Time a CPU temperature reading is reused
+        for, in seconds.
+        """
+        from sense_hat import SenseHat # only available on the Pi
+        self._sense_hat = SenseHat()
+        self._glyph = sense_hat_glyphs(self._sense_hat)
+        self._cpu_temp_sensor = CpuTempSensor(ttl_sec=cpu_temp_ttl_sec)
+
+    @property
+    def low_light(self):
+        return self._sense_hat.low_light
+
+    @low_light.setter
+    def low_light(self, value):
+        self._sense_hat.low_light = value
+
+    def get_temperature(self):
+        return self._sense_hat.get_temperature()
+
+    def get_humidity(self):
+        return self._sense_hat.get_humidity()
+
+    def get_pressure(self):
+        return self._sense_hat.get_pressure()
+
+    def get_cpu_temperature(self):
+        return self._cpu_temp_sensor.read() # thermal zone file, or vcgencmd
+
+    def set_rotation(self, rotation):
+        self._sense_hat.set_rotation(rotation)
+
+    def set_pixels(self, pixels):
+        self._sense_hat.set_pixels(pixels)
+
+    def get_glyph(self, char):
+        return self._glyph(char)
+
+    @property
+    def stick(self):
+        return self._sense_hat.stick
+
+    def clear(self, color=(0, 0, 0)):
+        self._sense_hat.clear(color)
+
+    def show_message(self, text, scroll_speed=0.1, text_colour=(255, 255, 255), back_colour=(0, 0, 0)):
+        self._sense_hat.show_message(text, scroll_speed, text_colour, back_colour)
+
+
+####################################################################
+
+
+class ScriptedStick(object):
+    """
+    Joystick that plays back a script of events.
+    """
+
+    def __init__(self, script=None):
+        """
+        Constructor.
+        :param script: List of (delay_sec, direction, action) tuples.
+        Each event is returned delay_sec after the previous one. Once the
+        script is done, wait_for_event() blocks until close() is called.
+        """
+        self._script = list(script or [])
+        self._closed = Event()
+
+    def wait_for_event(self):
+        """
+        Wait for and return next scripted InputEvent, or None if closed.
+        """
+        if not self._script:
+            self._closed.wait()
+            return None
+        delay_sec, direction, action = self._script.pop(0)
+        if self._closed.wait(delay_sec):
+            return None
+        return InputEvent(time(), direction, action)
+
+    def get_events(self):
+        """
+        Return (and remove) every scripted event, without waiting.
+        """
+        events = [InputEvent(time(), direction, action) for _, direction, action in self._script]
+        del self._script[:]
+        return events
+
+    def close(self):
+        """
+        Release any thread waiting for an event.
+        """
+        self._closed.set()
+
+
+class VirtualBackend(SenseBackend):
+    """
+    Base for off-device backends, with an in-memory LED matrix, scripted
+    joystick and a built-in font.
+    """
+
+    def __init__(self, joystick_script=None):
+        """
+        Constructor.
+        :param joystick_script: List of (delay_sec, direction, action)
+        joystick events (see ScriptedStick).
+        """
+        self.rotation = 0
+        self.pixels = [(0, 0, 0)] * 64 # last frame pushed
+        self.frames_pushed = 0
+        self._stick = ScriptedStick(joystick_script)
+
+    def set_rotation(self, rotation):
+        self.rotation = rotation
+
+    def set_pixels(self, pixels):
+        if len(pixels) != 64:
+            raise ValueError('Pixel lists must have 64 elements')
+        self.pixels = list(pixels)
+        self.frames_pushed += 1
+
+    def get_glyph(self, char):
+        """
+        Return deterministic 5 column glyph built from the character code
+        (not readable text, but the same size and cost as the real font).
+        """
+        if char == ' ':
+            return [(False,) * 8] * 3
+        code = ord(char)
+        return [tuple(bool((code * (col + 3) >> row) & 1) for row in range(8)) for col in range(5)]
+
+    @property
+    def stick(self):
+        return self._stick
+
+
+class SimulatedSenseHat(VirtualBackend):
+    """
+    Deterministic simulated Sense HAT. Each sensor follows a sine wave
+    with gaussian noise and optional spikes. With sample_rate_hz set,
+    each read advances a virtual clock by one sample period instead of
+    using the wall clock, so reads can run at kHz rates and the same
+    seed always gives the same sequence.
+    """
+
+    # Waveform defaults per sensor, in raw sensor units (degC, %, mbar)
+    default_waveforms = {'temperature': {'mean': 21.0, 'amplitude': 2.0, 'period_sec': 24*60*60, 'noise': 0.05},
+                         'humidity': {'mean': 40.0, 'amplitude': 5.0, 'period_sec': 24*60*60, 'noise': 0.2},
+                         'pressure': {'mean': 1013.0, 'amplitude': 3.0, 'period_sec': 3*24*60*60, 'noise': 0.05}}
+
+    def __init__(self, seed=0, waveforms=None, sample_rate_hz=None, cpu_temp=None, joystick_script=None):
+        """
+        Constructor.
+        :param seed: Random seed for noise and spikes.
+        :param waveforms: Dict of sensor name ('temperature', 'humidity'
+        or 'pressure') to dict overriding any of the default_waveforms
+        keys: mean, amplitude, period_sec, noise (std dev), spike_prob
+        (chance a read is a spike) and spike_size.
+        :param sample_rate_hz: If set, each read advances that sensor's
+        virtual clock by 1/sample_rate_hz seconds. If None, reads follow
+        the wall clock.
+        :param cpu_temp: Simulated CPU temperature in degC, or None to
+        skip temperature calibration.
+        :param joystick_script: List of (delay_sec, direction, action)
+        joystick events.
+        """
+        VirtualBackend.__init__(self, joystick_script)
+        self._cpu_temp = cpu_temp
+        self._random = Random(seed)
+        self._waveforms = {}
+        for sensor, defaults in self.default_waveforms.items():
+            self._waveforms[sensor] = dict(defaults, spike_prob=0.0, spike_size=0.0)
+            self._waveforms[sensor].update((waveforms or {}).get(sensor, {}))
+        self._sample_sec = 1.0 / sample_rate_hz if sample_rate_hz else None
+        self._clocks = dict((sensor, 0.0) for sensor in self._waveforms)
+        self._lock = Lock()
+        self.reads = 0
+
+    def _read(self, sensor):
+        """
+        Return next simulated value for sensor.
+        """
+        wave = self._waveforms[sensor]
+        with self._lock:
+            if self._sample_sec is None:
+                now = time()
+            else:
+                now = self._clocks[sensor]
+                self._clocks[sensor] += self._sample_sec
+            value = wave['mean'] + wave['amplitude'] * sin(2 * pi * now / wave['period_sec']) + self._random.gauss(0.0, wave['noise'])
+            if wave['spike_prob'] and self._random.random() < wave['spike_prob']:
+                value += self._random.choice((-1, 1)) * wave['spike_size']
+            self.reads += 1
+        return value
+
+    def get_temperature(self):
+        return self._read('temperature')
+
+    def get_humidity(self):
+        return self._read('humidity')
+
+    def get_pressure(self):
+        return self._read('pressure')
+
+    def get_cpu_temperature(self):
+        return self._cpu_temp
+
+
+class ReplaySenseHat(VirtualBackend):
+    """
+    Sense HAT that replays recorded readings from a CSV file with a
+    header row of: timestamp,temperature,humidity,pressure (raw sensor
+    units), plus an optional cpu_temperature column (degC) used for
+    temperature calibration. Each sensor steps through its column
+    independently, one row per read, looping back to the start at the
+    end of the file.
+    """
+
+    sensors = ('temperature', 'humidity', 'pressure')
+
+    def __init__(self, filename, loop=True, joystick_script=None):
+        """
+        Constructor.
+        :param filename: Recorded samples CSV file.
+        :param loop: If True restart at the end of the file, otherwise
+        raise EOFError.
+        :param joystick_script: List of (delay_sec, direction, action)
+        joystick events.
+        """
+        VirtualBackend.__init__(self, joystick_script)
+        with open(filename) as samples_file:
+            rows = list(DictReader(samples_file))
+        if not rows:
+            raise ValueError('No samples in replay file ({})'.format(filename))
+        sensors = self.sensors + (('cpu_temperature',) if rows[0].get('cpu_temperature') else ()) # recorded CPU temperature is optional
+        self._columns = dict((sensor, [float(row[sensor]) for row in rows]) for sensor in sensors)
+        self._positions = dict((sensor, 0) for sensor in sensors)
+        self._loop = loop
+        self._lock = Lock()
+
+    def _read(self, sensor):
+        """
+        Return next recorded value for sensor.
+        """
+        column = self._columns[sensor]
+        with self._lock:
+            position = self._positions[sensor]
+            if position >= len(column):
+                if not self._loop:
+                    raise EOFError('Replay file finished')
+                position = 0
+            self._positions[sensor] = position + 1
+        return column[position]
+
+    def get_temperature(self):
+        return self._read('temperature')
+
+    def get_humidity(self):
+        return self._read('humidity')
+
+    def get_pressure(self):
+        return self._read('pressure')
+
+    def get_cpu_temperature(self):
+        return self._read('cpu_temperature') if 'cpu_temperature' in self._columns else None
+
+
+####################################################################
+
+
+backends = {'sense_hat': RealSenseHat,
+            'simulated': SimulatedSenseHat,
+            'replay': ReplaySenseHat}
+
+
+def create_backend(name='sense_hat', **kwargs):
+    """
+    Create and return Sense HAT backend by name.
+    :param name: 'sense_hat', 'simulated' or 'replay'.
+    :param kwargs: Passed to the backend constructor.
+    """
+    try:
+        backend_class = backends[name]
+    except KeyError:
+        raise ValueError('Unknown Sense HAT backend "{}" (expected one of: {})'.format(name, ', '.join(sorted(backends))))
+    return backend_class(**kwargs)
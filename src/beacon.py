@@ -1,22 +1,36 @@
 #!/usr/bin/python
-from bluetooth.ble import BeaconService
+from logging import getLogger
+from threading import Event, Lock
+from time import time
+
+log = getLogger(__name__)
 
 
 class Beacon(object):
     """
-    TODO
+    Record for one BLE beacon. Records are updated in place on every
+    scan, so a beacon that is seen repeatedly doesn't allocate.
     """
 
-    def __init__(self, address, data):
+    __slots__ = ('_address', '_uuid', '_major', '_minor', '_power', '_rssi', '_raw_rssi', '_first_seen', '_last_seen', '_seen_count')
+
+    def __init__(self, address, data, timestamp=None):
         """
-        TODO
+        Constructor.
+        :param address: Beacon MAC address.
+        :param data: Scan result: [uuid, major, minor, txpower, rssi].
+        :param timestamp: Time beacon was seen, in seconds since epoch.
+        Defaults to now.
         """
         self._address = address
         self._uuid = data[0]
         self._major = data[1]
         self._minor = data[2]
         self._power = data[3]
-        self._rssi = data[4]
+        self._rssi = float(data[4])
+        self._raw_rssi = data[4]
+        self._first_seen = self._last_seen = timestamp if timestamp is not None else time()
+        self._seen_count = 1
 
     def __str__(self):
         """
@@ -25,8 +39,183 @@ class Beacon(object):
         return 'Beacon: address:{ADDR} uuid:{UUID} major:{MAJOR} minor:{MINOR} txpower:{POWER} rssi:{RSSI}'\
             .format(ADDR=self._address, UUID=self._uuid, MAJOR=self._major, MINOR=self._minor, POWER=self._power, RSSI=self._rssi)
 
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def key(self):
+        """
+        Beacon identity as (uuid, major, minor).
+        """
+        return (self._uuid, self._major, self._minor)
+
+    @property
+    def last_seen(self):
+        return self._last_seen
+
+    def update(self, data, timestamp, rssi_alpha):
+        """
+        Update record from new scan result, smoothing RSSI (EMA).
+        :param data: Scan result: [uuid, major, minor, txpower, rssi].
+        :param timestamp: Time beacon was seen, in seconds since epoch.
+        :param rssi_alpha: EMA weight of the newest RSSI reading.
+        """
+        self._uuid = data[0]
+        self._major = data[1]
+        self._minor = data[2]
+        self._power = data[3]
+        self._raw_rssi = data[4]
+        self._rssi += rssi_alpha * (data[4] - self._rssi)
+        self._last_seen = timestamp
+        self._seen_count += 1
+
+    def to_dict(self):
+        """
+        Return beacon as a dict (e.g. for JSON encoding).
+        """
+        return {'address': self._address, 'uuid': self._uuid, 'major': self._major, 'minor': self._minor,
+                'txpower': self._power, 'rssi': self._rssi, 'raw_rssi': self._raw_rssi,
+                'first_seen': self._first_seen, 'last_seen': self._last_seen, 'seen_count': self._seen_count}
+
+
+class BeaconTable(object):
+    """
+    Table of beacons currently in range, indexed by address and by
+    (uuid, major, minor). Beacons not seen for ttl_sec are evicted.
+    """
+
+    def __init__(self, ttl_sec=60.0, rssi_alpha=0.3):
+        """
+        Constructor.
+        :param ttl_sec: Time after a beacon was last seen that it is
+        dropped from the table, in seconds.
+        :param rssi_alpha: EMA weight of the newest RSSI reading.
+        """
+        self._ttl_sec = ttl_sec
+        self._rssi_alpha = rssi_alpha
+        self._by_address = {}
+        self._by_key = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def update(self, devices, timestamp=None):
+        """
+        Add or update beacons from scan results, then evict beacons that
+        have not been seen within ttl.
+        :param devices: Dict of address to [uuid, major, minor, txpower,
+        rssi], as returned by BeaconService.scan.
+        :param timestamp: Scan time, in seconds since epoch. Defaults to
+        now.
+        """
+        if timestamp is None: timestamp = time()
+        with self._lock:
+            for address, data in devices.items():
+                beacon = self._by_address.get(address)
+                if beacon is None:
+                    beacon = self._by_address[address] = Beacon(address, data, timestamp)
+                else:
+                    if beacon.key != tuple(data[:3]): self._by_key.pop(beacon.key, None)
+                    beacon.update(data, timestamp, self._rssi_alpha)
+                self._by_key[beacon.key] = beacon
+            self._evict(timestamp)
+
+    def _evict(self, now):
+        """
+        Drop beacons last seen more than ttl ago. Must be called with
+        lock held.
+        """
+        for address in [address for address, beacon in self._by_address.items() if now - beacon.last_seen > self._ttl_sec]:
+            beacon = self._by_address.pop(address)
+            if self._by_key.get(beacon.key) is beacon: del self._by_key[beacon.key]
+
+    def get(self, address):
+        """
+        Return beacon with address, or None.
+        """
+        return self._by_address.get(address)
+
+    def find(self, uuid, major, minor):
+        """
+        Return beacon with (uuid, major, minor), or None.
+        """
+        return self._by_key.get((uuid, major, minor))
+
+    def to_list(self):
+        """
+        Return list of beacon dicts, strongest (smoothed) signal first.
+        """
+        with self._lock:
+            beacons = [beacon.to_dict() for beacon in self._by_address.values()]
+        return sorted(beacons, key=lambda beacon: -beacon['rssi'])
+
+
+class BeaconScanner(object):
+    """
+    Long-running beacon scanner. Scans in short windows, with an idle gap
+    between them to leave the radio free, and keeps a BeaconTable of what
+    is in range. pybluez's BeaconService only offers a blocking scan with
+    a timeout (no continuous scan with callbacks), so the radio listens
+    scan_sec out of every scan_sec + idle_sec; set idle_sec to 0 (beacons
+    section of pienviro.yml) to scan back to back.
+    """
+
+    def __init__(self, service, scan_sec=2.0, idle_sec=8.0, ttl_sec=60.0, rssi_alpha=0.3):
+        """
+        Constructor.
+        :param service: Object with a scan(timeout) method returning a
+        dict of address to scan result, e.g. BeaconService('hci0').
+        :param scan_sec: Length of each scan window, in seconds.
+        :param idle_sec: Gap between scan windows, in seconds.
+        :param ttl_sec: Time after a beacon was last seen that it is
+        dropped from the table, in seconds.
+        :param rssi_alpha: EMA weight of the newest RSSI reading.
+        """
+        self._service = service
+        self._scan_sec = scan_sec
+        self._idle_sec = idle_sec
+        self.table = BeaconTable(ttl_sec, rssi_alpha)
+        self._stop_event = Event()
+        self.scans = 0
+        self.scan_errors = 0
+
+    def run(self):
+        """
+        Scanner loop, runs until stop() is called.
+        """
+        while not self._stop_event.is_set():
+            self.scan_once()
+            self._stop_event.wait(self._idle_sec)
+
+    def scan_once(self):
+        """
+        Run one scan window and update table (also evicting beacons
+        that are out of range, even if the scan failed).
+        """
+        try:
+            devices = self._service.scan(self._scan_sec)
+        except (IOError, OSError, RuntimeError) as err:
+            self.scan_errors += 1
+            log.warning('Beacon scan failed (%s)!', err)
+            devices = {}
+        except Exception: # anything else from the BLE stack must not end the scanner thread
+            self.scan_errors += 1
+            log.exception('Unexpected error during beacon scan!')
+            devices = {}
+        self.scans += 1
+        self.table.update(devices)
+
+    def stop(self):
+        """
+        Signal scanner loop to exit after the current scan.
+        """
+        self._stop_event.set()
+
 
 if __name__ == '__main__':
+    from bluetooth.ble import BeaconService # only available with Bluetooth installed
     # Create beacon service and scan for devices (2 seconds)
     service = BeaconService('hci0')
     devices = service.scan(2)
@@ -34,4 +223,4 @@ if __name__ == '__main__':
     for address, data in list(devices.items()):
         beacon = Beacon(address, data)
         print(beacon)
-    print('*** Beacon scan complete! ***')
\ No newline at end of file
+    print('*** Beacon scan complete! ***')
@@ -0,0 +1,586 @@
+#!/usr/bin/python
+"""
+Benchmarks for the PiEnviro hot paths, run against a simulated Sense HAT
+so they work on any Linux box. Results are printed (or written) as JSON,
+one object per benchmark, so runs can be diffed to catch regressions.
+
+Usage: python benchmark.py [--only NAME ...] [--output FILE]
+"""
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
+from gzip import compress
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from json import dumps
+from logging import CRITICAL, NOTSET, disable
+from math import sqrt
+from os import devnull, environ, listdir
+from os.path import getsize, join
+from platform import machine, python_version
+from shutil import rmtree
+from signal import SIGTERM
+from socket import socket
+from subprocess import DEVNULL, Popen
+from sys import executable
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter, sleep, time
+from yaml import safe_dump
+
+from archive import SampleArchive, export_lines
+from async_api import AsyncApiServer
+from backends import SimulatedSenseHat
+from beacon import Beacon
+from compression import SampleCompressor
+from filters import SampleFilter, create_filters
+from fleet import FleetAggregator
+from influxdb import format_line
+from pi_enviro import PiEnviro
+from screen import ScreenRenderer
+from spool import SpoolSegment
+from units import canonical_units, convert, display_units, get_conversion
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    Return dict of 'pN' to Nth percentile of samples (nearest rank).
+    """
+    ordered = sorted(samples)
+    return dict(('p{}'.format(point), ordered[min(len(ordered) - 1, int(len(ordered) * point / 100.0))]) for point in points)
+
+
+@contextmanager
+def quiet():
+    """
+    Silence stdout and logging, so per-sample logging doesn't skew
+    timings.
+    """
+    disable(CRITICAL)
+    try:
+        with open(devnull, 'w') as null, redirect_stdout(null):
+            yield
+    finally:
+        disable(NOTSET)
+
+
+@contextmanager
+def simulated_pi_enviro():
+    """
+    Yield PiEnviro on a simulated Sense HAT, with first readings taken
+    and its spool and archive in a temporary directory.
+    """
+    spool_dir = mkdtemp(prefix='pienviro-bench-')
+    try:
+        with quiet():
+            pi_enviro = PiEnviro(sense_hat=SimulatedSenseHat(sample_rate_hz=1000), spool_dir=spool_dir, archive_dir=join(spool_dir, 'archive'))
+            for channel in ('temp', 'humidity', 'press'): # first snapshot, normally taken by the sampling thread
+                getattr(pi_enviro, 'get_' + channel)(force_update=True)
+        yield pi_enviro
+    finally:
+        rmtree(spool_dir, ignore_errors=True)
+
+
+####################################################################
+
+
+def bench_ingest(args):
+    """
+    Sample batches per second through the full update path (sensor
+    read, snapshot publish, history, spool), every channel read on
+    every tick.
+    """
+    with simulated_pi_enviro() as pi_enviro:
+        for channel in ('temp', 'humidity', 'press'):
+            pi_enviro._scheduler.set_interval(channel, pi_enviro._sample_tick_sec)
+        with quiet():
+            start = perf_counter()
+            for tick in range(args.samples):
+                pi_enviro._scheduler.run_pending(tick=tick)
+            elapsed = perf_counter() - start
+    return {'batches': args.samples,
+            'batches_per_sec': args.samples / elapsed,
+            'samples_per_sec': 3 * args.samples / elapsed,
+            'usec_per_batch': 1e6 * elapsed / args.samples}
+
+
+def bench_api(args):
+    """
+    REST API latency percentiles with concurrent keep-alive clients, for
+    the Flask development server and the async server (including
+    conditional requests answered with 304).
+    """
+    import rest_api
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    class RequestHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive
+        def log_request(self, *args, **kwargs):
+            pass
+    results = OrderedDict()
+    with simulated_pi_enviro() as pi_enviro:
+        rest_api.pi_enviro = pi_enviro
+        etag = rest_api.response_cache.get('/env').etag
+        server = make_server('127.0.0.1', 0, rest_api.rest_api, threaded=True, request_handler=RequestHandler)
+        server_thread = Thread(target=server.serve_forever)
+        server_thread.start()
+        try:
+            results['flask'] = OrderedDict((route, run_http_clients(server.server_port, route, args.clients, args.requests))
+                                           for route in ('/temp', '/env'))
+        finally:
+            server.shutdown()
+            server_thread.join()
+        server = AsyncApiServer(rest_api.rest_api, rest_api.response_cache, host='127.0.0.1', port=0)
+        server_thread = Thread(target=server.run)
+        server_thread.start()
+        server.ready.wait()
+        try:
+            results['async'] = OrderedDict((route, run_http_clients(server.port, route, args.clients, args.requests))
+                                           for route in ('/temp', '/env'))
+            results['async']['/env 304'] = run_http_clients(server.port, '/env', args.clients, args.requests, {'If-None-Match': etag})
+        finally:
+            server.stop()
+            server_thread.join()
+    return results
+
+
+def run_http_clients(port, route, clients, requests, headers=None):
+    """
+    Request route from clients concurrent connections, requests times
+    each, and return throughput and latency percentiles (in ms).
+    """
+    latencies = [[] for _ in range(clients)]
+    def client(latency):
+        connection = HTTPConnection('127.0.0.1', port)
+        for _ in range(requests):
+            start = perf_counter()
+            connection.request('GET', route, headers=headers or {})
+            response = connection.getresponse()
+            response.read()
+            latency.append(1000 * (perf_counter() - start))
+        connection.close()
+    threads = [Thread(target=client, args=[latency]) for latency in latencies]
+    start = perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = perf_counter() - start
+    all_latencies = [value for latency in latencies for value in latency]
+    result = OrderedDict([('clients', clients), ('requests', len(all_latencies)), ('requests_per_sec', len(all_latencies) / elapsed)])
+    result.update(('{}_ms'.format(key), value) for key, value in sorted(percentiles(all_latencies).items()))
+    return result
+
+
+def bench_screen(args):
+    """
+    Cost of rendering the scrolling screen message: from scratch, after
+    one digit changed, and unchanged (cached).
+    """
+    sense_hat = SimulatedSenseHat()
+    message = 'Temp: {:.1f} degF, Humidity: {:.1f} %, Press: {:.2f} inHg'
+    color, background = (0, 0, 255), (0, 0, 0)
+    runs = args.renders
+    start = perf_counter()
+    for i in range(runs):
+        frames = ScreenRenderer(sense_hat.get_glyph).render(message.format(70.1, 40.0, 29.92), color, background, 270)
+    cold = perf_counter() - start
+    renderer = ScreenRenderer(sense_hat.get_glyph)
+    start = perf_counter()
+    for i in range(runs):
+        renderer.render(message.format(70.0 + i * 0.1, 40.0, 29.92), color, background, 270)
+    changed = perf_counter() - start
+    start = perf_counter()
+    for i in range(runs):
+        renderer.render(message.format(70.1, 40.0, 29.92), color, background, 270)
+    cached = perf_counter() - start
+    return {'frames_per_message': len(frames),
+            'cold_msec_per_message': 1000 * cold / runs,
+            'digit_changed_msec_per_message': 1000 * changed / runs,
+            'cached_usec_per_message': 1e6 * cached / runs}
+
+
+def bench_export(args):
+    """
+    Cost of formatting samples as InfluxDB line protocol and compressing
+    a batch.
+    """
+    start = perf_counter()
+    lines = [format_line('env_data[192.168.1.48]', {'temp': 70.0 + i * 0.01, 'humidity': 40.0, 'press': 29.92}, 1.5e9 + i)
+             for i in range(args.samples)]
+    formatted = perf_counter() - start
+    payload = '\n'.join(lines).encode('utf-8')
+    start = perf_counter()
+    compressed = compress(payload)
+    compressed_sec = perf_counter() - start
+    return {'points': len(lines),
+            'points_per_sec': len(lines) / formatted,
+            'gzip_msec_per_1000_points': 1000 * compressed_sec * 1000 / len(lines),
+            'bytes_per_point': len(payload) / float(len(lines)),
+            'gzip_bytes_per_point': len(compressed) / float(len(lines))}
+
+
+def bench_beacon(args):
+    """
+    Beacon scan result parsing (and formatting) throughput.
+    """
+    results = dict(('AA:BB:CC:DD:EE:{:02X}'.format(i), ['e2c56db5-dffb-48d2-b060-d0f5a71096e0', i, i * 2, -59, -70 - i % 20])
+                   for i in range(256))
+    start = perf_counter()
+    rounds = max(1, args.samples // len(results))
+    for _ in range(rounds):
+        for address, data in results.items():
+            str(Beacon(address, data))
+    elapsed = perf_counter() - start
+    return {'beacons': rounds * len(results), 'beacons_per_sec': rounds * len(results) / elapsed}
+
+
+def bench_filter(args):
+    """
+    Filter pipeline throughput and noise reduction on a stub sensor with
+    a constant true value, gaussian noise and occasional spikes, for
+    each smoothing method (burst of 5). Error is RMS against the true
+    value, for single raw reads and for filtered reads.
+    """
+    waveform = {'mean': 21.0, 'amplitude': 0.0, 'noise': 0.2, 'spike_prob': 0.01, 'spike_size': 10.0}
+    raw_sensor = SimulatedSenseHat(seed=1, waveforms={'temperature': waveform}, sample_rate_hz=1000)
+    raw_error = sqrt(sum((raw_sensor.get_temperature() - waveform['mean']) ** 2 for _ in range(args.samples)) / args.samples)
+    results = OrderedDict([('reads', args.samples), ('raw_rms_error', raw_error)])
+    for method in SampleFilter.methods:
+        sensor = SimulatedSenseHat(seed=1, waveforms={'temperature': waveform}, sample_rate_hz=1000)
+        sample_filter = SampleFilter('bench', burst_size=5, method=method, measurement_var=waveform['noise'] ** 2)
+        start = perf_counter()
+        values = [sample_filter.read(sensor.get_temperature) for _ in range(args.samples)]
+        elapsed = perf_counter() - start
+        settled = values[len(values) // 10:] # skip filter warm up
+        results[method] = {'reads_per_sec': args.samples / elapsed,
+                           'raw_reads_per_sec': sensor.reads / elapsed,
+                           'rms_error': sqrt(sum((value - waveform['mean']) ** 2 for value in settled) / len(settled)),
+                           'max_error': max(abs(value - waveform['mean']) for value in settled)}
+    return results
+
+
+def bench_units(args):
+    """
+    Unit conversion cost: compiled (scale, offset) conversion, looked up
+    conversion, and pint (if installed), converting degC to degF and
+    mbar to inHg.
+    """
+    values = [20.0 + i * 0.001 for i in range(args.samples)]
+    results = OrderedDict([('conversions', 2 * len(values))])
+    to_degf, to_inhg = get_conversion('degC', 'degF'), get_conversion('mbar', 'inHg')
+    start = perf_counter()
+    for value in values:
+        to_degf(value)
+        to_inhg(value)
+    results['compiled_per_sec'] = 2 * len(values) / (perf_counter() - start)
+    start = perf_counter()
+    for value in values:
+        convert(value, 'degC', 'degF')
+        convert(value, 'mbar', 'inHg')
+    results['lookup_per_sec'] = 2 * len(values) / (perf_counter() - start)
+    try:
+        start = perf_counter()
+        from pint import UnitRegistry
+        ureg = UnitRegistry()
+        results['pint_import_and_registry_sec'] = perf_counter() - start
+    except ImportError:
+        results['pint_per_sec'] = None # pint not installed
+        return results
+    start = perf_counter()
+    for value in values:
+        ureg.Quantity(value, 'degC').to('degF').magnitude
+        ureg.Quantity(value, 'mbar').to('inHg').magnitude
+    results['pint_per_sec'] = 2 * len(values) / (perf_counter() - start)
+    results['pint_max_abs_diff_degF'] = max(abs(ureg.Quantity(value, 'degC').to('degF').magnitude - to_degf(value)) for value in values[:1000])
+    results['pint_max_abs_diff_inHg'] = max(abs(ureg.Quantity(value, 'mbar').to('inHg').magnitude - to_inhg(value)) for value in values[:1000])
+    return results
+
+
+def bench_compression(args):
+    """
+    Export compression ratio and worst reconstruction error (linear
+    interpolation between kept points, in canonical units) over one
+    simulated day of filtered samples at the default 15 second rate,
+    with the default per-channel compression settings.
+    """
+    with simulated_pi_enviro() as pi_enviro:
+        filter_config, compression_config = pi_enviro._filter_config, pi_enviro._compression_config
+        sensor_conversions = pi_enviro._sensor_conversions
+    burst_size = max(options.get('burst_size', 1) for options in filter_config.values())
+    sensor = SimulatedSenseHat(seed=2, sample_rate_hz=burst_size / 15.0)
+    filters = create_filters(filter_config)
+    reads = {'temp': sensor.get_temperature, 'humidity': sensor.get_humidity, 'press': sensor.get_pressure}
+    batches = [(15.0 * i, dict((channel, sensor_conversions[channel](filters[channel].read(read))) for channel, read in reads.items()))
+               for i in range(24 * 60 * 4)]
+    compressor = SampleCompressor(compression_config)
+    start = perf_counter()
+    points = [point for timestamp, samples in batches for point in compressor.add(timestamp, samples)] + compressor.flush()
+    elapsed = perf_counter() - start
+    results = OrderedDict([('batches', len(batches)), ('points', len(points)), ('usec_per_batch', 1e6 * elapsed / len(batches))])
+    for channel in reads:
+        kept = [(timestamp, samples[channel]) for timestamp, samples in points if channel in samples]
+        kept_times = [timestamp for timestamp, _ in kept]
+        max_error = 0.0
+        for timestamp, samples in batches:
+            index = min(bisect_left(kept_times, timestamp), len(kept) - 1)
+            (t0, v0), (t1, v1) = kept[max(0, index - 1)], kept[index]
+            expected = v1 if t1 == t0 or timestamp >= t1 else v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+            max_error = max(max_error, abs(samples[channel] - expected))
+        results[channel] = {'samples': len(batches), 'points': len(kept), 'ratio': len(batches) / float(len(kept)),
+                            'deviation': compression_config[channel]['deviation'], 'max_error': max_error}
+    return results
+
+
+def bench_archive(args):
+    """
+    Archive size and export throughput for --days of samples at the
+    default 15 second rate, all channels. Size is compared with the
+    spool (which keeps the same samples as fixed 24 byte records), and
+    export bandwidth with and without gzip.
+    """
+    sensor = SimulatedSenseHat(seed=3, sample_rate_hz=1 / 15.0)
+    conversions = dict((channel, get_conversion(unit, canonical_units[channel])) for channel, unit in PiEnviro.sensor_units.items())
+    reads = {'temp': sensor.get_temperature, 'humidity': sensor.get_humidity, 'press': sensor.get_pressure}
+    start_time = int(time()) // 86400 * 86400 - args.days * 86400
+    batches = [(start_time + 15.0 * i, dict((channel, conversions[channel](read())) for channel, read in reads.items()))
+               for i in range(args.days * 24 * 60 * 4)]
+    samples = sum(len(samples) for _, samples in batches)
+    archive_dir = mkdtemp(prefix='pienviro-bench-')
+    try:
+        archive = SampleArchive(archive_dir, ('temp', 'humidity', 'press'))
+        start = perf_counter()
+        for timestamp, batch in batches:
+            archive.append(timestamp, batch)
+        append_sec = perf_counter() - start
+        archive_bytes = sum(getsize(join(archive_dir, name)) for name in listdir(archive_dir))
+        results = OrderedDict([('days', args.days), ('samples', samples), ('chunks', len(listdir(archive_dir))),
+                               ('usec_per_batch', 1e6 * append_sec / len(batches)),
+                               ('archive_bytes_per_sample', archive_bytes / float(samples)),
+                               ('spool_bytes_per_sample', float(SpoolSegment.record.size))])
+        for export_format in ('csv', 'ndjson'):
+            for gzip in (False, True):
+                start = perf_counter()
+                size = sum(len(block) for block in export_lines(archive.rows(), display_units, export_format, gzip=gzip))
+                elapsed = perf_counter() - start
+                results['{}{}'.format(export_format, '_gzip' if gzip else '')] = {'bytes_per_row': size / float(len(batches)),
+                                                                                  'rows_per_sec': len(batches) / elapsed}
+        return results
+    finally:
+        rmtree(archive_dir, ignore_errors=True)
+
+
+def bench_stream(args):
+    """
+    Live stream fan-out on the async server: --subscribers concurrent
+    SSE clients, --updates snapshots published 20 ms apart. Reports
+    delivery latency (publish to client read, in ms), time taken to fan
+    out each update, and that subscribers which stop reading are
+    evicted instead of queueing without bound. Clients run in this
+    process, so at high counts latency includes their own parsing.
+    """
+    import asyncio
+    import rest_api
+    published = {} # snapshot version -> publish time
+    publish_ms = []
+    received = [] # (snapshot version, arrival time)
+    connected = []
+    def timed_publish(snapshot):
+        published[snapshot.version] = perf_counter()
+        rest_api.broadcaster.publish(snapshot)
+        publish_ms.append(1000 * (perf_counter() - published[snapshot.version]))
+    async def subscriber(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: bench\r\n\r\n')
+        await reader.readuntil(b'\r\n\r\n')
+        connected.append(1)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.startswith(b'id: '): received.append((int(line[4:].split(b'.')[1].split(b'-')[0]), perf_counter())) # id is boot.version
+        writer.close()
+    async def subscribers(port):
+        await asyncio.gather(*[subscriber(port) for _ in range(args.subscribers)], return_exceptions=True)
+    with simulated_pi_enviro() as pi_enviro:
+        rest_api.pi_enviro = pi_enviro
+        pi_enviro.add_snapshot_listener(timed_publish)
+        server = AsyncApiServer(rest_api.rest_api, rest_api.response_cache, rest_api.broadcaster, host='127.0.0.1', port=0)
+        server_thread = Thread(target=server.run)
+        server_thread.start()
+        server.ready.wait()
+        client_thread = Thread(target=asyncio.run, args=[subscribers(server.port)])
+        client_thread.start()
+        try:
+            while len(connected) < args.subscribers:
+                sleep(0.05)
+            stalled = [rest_api.broadcaster.subscribe() for _ in range(5)] # never read
+            with quiet():
+                for _ in range(args.updates):
+                    pi_enviro.get_temp(force_update=True)
+                    sleep(0.02)
+            sleep(0.5)
+        finally:
+            server.stop()
+            server_thread.join()
+            client_thread.join()
+    latencies = [1000 * (arrival - published[version]) for version, arrival in received if version in published]
+    result = OrderedDict([('subscribers', args.subscribers), ('updates', args.updates), ('events_expected', args.subscribers * args.updates),
+                          ('events_received', len(latencies)), ('stalled_subscribers', len(stalled)),
+                          ('stalled_evicted', sum(1 for subscriber in stalled if subscriber.evicted)),
+                          ('publish_ms_mean', sum(publish_ms) / len(publish_ms))])
+    result.update(('latency_{}_ms'.format(key), value) for key, value in sorted(percentiles(latencies).items()))
+    return result
+
+
+def bench_startup(args):
+    """
+    Process startup and shutdown: runs rest_api.py on a simulated Sense
+    HAT --starts times, and reports time from spawn until the API
+    answers (/metrics), until the first snapshot is served (/env stops
+    answering 503), and from SIGTERM until the process exits. Startup
+    is compared with the api.startup_budget_sec default.
+    """
+    from config import default_config
+    budget_sec = default_config()['api']['startup_budget_sec']
+    def status(port, route):
+        connection = HTTPConnection('127.0.0.1', port, timeout=1.0)
+        try:
+            connection.request('GET', route)
+            return connection.getresponse().status
+        except OSError:
+            return None # not listening yet
+        finally:
+            connection.close()
+    api_up, first_snapshot, shutdown, exit_codes = [], [], [], []
+    for _ in range(args.starts):
+        work_dir = mkdtemp(prefix='pienviro-bench-')
+        with socket() as probe: # free port for this run
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        config = {'sampling': {'spool_dir': join(work_dir, 'spool')},
+                  'sinks': {'archive': {'dir': join(work_dir, 'archive')}},
+                  'api': {'host': '127.0.0.1', 'port': port},
+                  'logging': {'level': 'WARNING'}}
+        config_file = join(work_dir, 'pienviro.yml')
+        with open(config_file, 'w') as config_stream:
+            safe_dump(config, config_stream)
+        env = dict(environ, PIENVIRO_BACKEND='simulated', PIENVIRO_CONFIG=config_file)
+        try:
+            start = perf_counter()
+            process = Popen([executable, 'rest_api.py'], env=env, stdout=DEVNULL, stderr=DEVNULL)
+            while status(port, '/metrics') is None and process.poll() is None:
+                sleep(0.005)
+            api_up.append(perf_counter() - start)
+            while status(port, '/env') not in (200, None) and process.poll() is None:
+                sleep(0.005)
+            first_snapshot.append(perf_counter() - start)
+            start = perf_counter()
+            process.send_signal(SIGTERM)
+            exit_codes.append(process.wait(timeout=30))
+            shutdown.append(perf_counter() - start)
+        finally:
+            if process.poll() is None: process.kill()
+            rmtree(work_dir, ignore_errors=True)
+    return OrderedDict([('starts', args.starts), ('budget_sec', budget_sec),
+                        ('api_up_sec_max', max(api_up)), ('api_up_sec_mean', sum(api_up) / len(api_up)),
+                        ('first_snapshot_sec_max', max(first_snapshot)), ('shutdown_sec_max', max(shutdown)),
+                        ('within_budget', max(api_up) <= budget_sec), ('clean_exits', exit_codes.count(0))])
+
+
+def stub_node(slow_every=0, slow_sec=0.0):
+    """
+    Start stub PiEnviro node serving a fixed /env snapshot, and return
+    its server. Every slow_every-th request is held for slow_sec.
+    """
+    requests = count(1)
+    body = dumps({'version': 1, 'temp': 70.0, 'temp_time': time(), 'humidity': 40.0, 'humidity_time': time(),
+                  'press': 29.92, 'press_time': time()}).encode('utf-8')
+    class StubNodeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive
+        def do_GET(self):
+            if slow_every and next(requests) % slow_every == 0: sleep(slow_sec)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNodeHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_fleet(args):
+    """
+    Fleet poll round latency against local stub nodes, where one node
+    is slow on every other request (answered by the hedged request) and
+    one node is down (costs one retry, never the round deadline).
+    """
+    servers = [stub_node() for _ in range(args.nodes - 1)] + [stub_node(slow_every=2, slow_sec=0.5)]
+    nodes = [{'name': 'node{}'.format(i), 'url': 'http://127.0.0.1:{}'.format(server.server_port)} for i, server in enumerate(servers)]
+    nodes.append({'name': 'down', 'url': 'http://127.0.0.1:9'}) # discard port, connection refused
+    aggregator = FleetAggregator(nodes, timeout_sec=1.0, hedge_sec=0.05)
+    latencies = []
+    try:
+        with quiet():
+            for _ in range(args.rounds):
+                start = perf_counter()
+                view = aggregator.poll_once()
+                latencies.append(1000 * (perf_counter() - start))
+    finally:
+        for server in servers: server.shutdown()
+    result = OrderedDict([('nodes', len(nodes)), ('rounds', args.rounds),
+                          ('rooms_with_values', view.summary('temp')['count']),
+                          ('dashboard_requests_per_refresh', 1),
+                          ('dashboard_requests_per_refresh_without_fleet', 3 * len(nodes))]) # one per node per panel
+    result.update(('round_{}_ms'.format(key), value) for key, value in sorted(percentiles(latencies).items()))
+    return result
+
+
+benchmarks = OrderedDict([('ingest', bench_ingest),
+                          ('api', bench_api),
+                          ('screen', bench_screen),
+                          ('export', bench_export),
+                          ('beacon', bench_beacon),
+                          ('filter', bench_filter),
+                          ('units', bench_units),
+                          ('compression', bench_compression),
+                          ('archive', bench_archive),
+                          ('stream', bench_stream),
+                          ('startup', bench_startup),
+                          ('fleet', bench_fleet)])
+
+
+####################################################################
+
+
+def main():
+    parser = ArgumentParser(description='Run PiEnviro benchmarks and print results as JSON.')
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), help='benchmarks to run (default: all)')
+    parser.add_argument('--samples', type=int, default=20000, help='samples per ingest/export/beacon run')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent API clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per API client')
+    parser.add_argument('--nodes', type=int, default=8, help='stub nodes per fleet run')
+    parser.add_argument('--rounds', type=int, default=20, help='poll rounds per fleet run')
+    parser.add_argument('--subscribers', type=int, default=400, help='live stream clients per stream run')
+    parser.add_argument('--updates', type=int, default=100, help='snapshots published per stream run')
+    parser.add_argument('--days', type=int, default=30, help='days of samples per archive run')
+    parser.add_argument('--starts', type=int, default=5, help='process starts per startup run')
+    parser.add_argument('--renders', type=int, default=50, help='messages rendered per screen run')
+    parser.add_argument('--output', help='write JSON to this file instead of stdout')
+    args = parser.parse_args()
+    results = OrderedDict([('time', time()), ('python', python_version()), ('machine', machine())])
+    for name in args.only or benchmarks:
+        results[name] = benchmarks[name](args)
+    output = dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
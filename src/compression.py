@@ -0,0 +1,184 @@
+#!/usr/bin/python
+from metrics import Counter, Gauge
+
+samples_in = Counter('pienviro_export_samples_total', 'Samples passed to export compression.', ('channel',))
+points_out = Counter('pienviro_export_points_total', 'Points kept by export compression.', ('channel',))
+compression_ratio = Gauge('pienviro_export_compression_ratio', 'Samples per exported point.', ('channel',))
+
+
+def _check_bounds(deviation, heartbeat_sec):
+    """
+    Return deviation and heartbeat_sec as floats. Raises ValueError if
+    either is negative.
+    """
+    for name, value in (('deviation', deviation), ('heartbeat_sec', heartbeat_sec)):
+        if float(value) < 0:
+            raise ValueError('{} must be 0 or greater, not {!r}'.format(name, value))
+    return float(deviation), float(heartbeat_sec)
+
+
+class DeadBand(object):
+    """
+    Dead-band filter for one channel. A sample is kept only if it
+    differs from the last kept sample by more than deviation, or if
+    heartbeat_sec has passed since then. Holding the last kept value
+    (step interpolation) reconstructs the series to within deviation.
+    """
+
+    def __init__(self, deviation, heartbeat_sec=600.0):
+        """
+        Constructor.
+        :param deviation: Change smaller than or equal to this is
+        suppressed.
+        :param heartbeat_sec: Maximum time between kept samples.
+        """
+        self._deviation, self._heartbeat_sec = _check_bounds(deviation, heartbeat_sec)
+        self._kept = None # (timestamp, value) of last kept sample
+
+    def add(self, timestamp, value):
+        """
+        Return list of (timestamp, value) samples to keep (empty or the
+        passed sample).
+        """
+        if self._kept is None or abs(value - self._kept[1]) > self._deviation or timestamp - self._kept[0] >= self._heartbeat_sec:
+            self._kept = (timestamp, value)
+            return [self._kept]
+        return []
+
+    def flush(self):
+        """
+        Return samples held back (none, the dead-band holds nothing).
+        """
+        return []
+
+
+class SwingingDoor(object):
+    """
+    Swinging-door compression for one channel. Samples are dropped while
+    a straight line from the last kept sample can pass within deviation
+    of every sample since. When a new sample would break that, the
+    previous sample is kept and becomes the new line start. Linear
+    interpolation between kept samples reconstructs the series to within
+    deviation. A sample is also kept at least every heartbeat_sec. State
+    is the line start, the last sample and the range of slopes still
+    allowed by the samples in between.
+    """
+
+    def __init__(self, deviation, heartbeat_sec=600.0):
+        """
+        Constructor.
+        :param deviation: Maximum error of reconstructed samples.
+        :param heartbeat_sec: Maximum time between kept samples.
+        """
+        self._deviation, self._heartbeat_sec = _check_bounds(deviation, heartbeat_sec)
+        self._start = None # (timestamp, value) of last kept sample, where the line starts
+        self._last = None # (timestamp, value) of last sample, not kept yet
+        self._reset_slopes()
+
+    def _reset_slopes(self):
+        self._min_slope = float('-inf')
+        self._max_slope = float('inf')
+
+    def add(self, timestamp, value):
+        """
+        Return list of (timestamp, value) samples to keep (zero, one or
+        two samples, oldest first).
+        """
+        if self._start is None:
+            self._start = (timestamp, value)
+            return [self._start]
+        kept = []
+        dt = timestamp - self._start[0]
+        if dt <= 0:
+            return kept # out of order or repeated timestamp
+        slope = (value - self._start[1]) / dt
+        if not self._min_slope <= slope <= self._max_slope: # line to this sample would miss a dropped sample
+            kept.append(self._last)
+            self._start = self._last
+            self._last = None
+            self._reset_slopes()
+            dt = timestamp - self._start[0]
+        if timestamp - self._start[0] >= self._heartbeat_sec:
+            self._start = (timestamp, value)
+            self._last = None
+            self._reset_slopes()
+            kept.append(self._start)
+            return kept
+        # Sample may be dropped later, so every future line must pass within deviation of it
+        self._min_slope = max(self._min_slope, (value - self._deviation - self._start[1]) / dt)
+        self._max_slope = min(self._max_slope, (value + self._deviation - self._start[1]) / dt)
+        self._last = (timestamp, value)
+        return kept
+
+    def flush(self):
+        """
+        Keep and return the last sample, if it is being held back (e.g.
+        before shutdown).
+        """
+        if self._last is None:
+            return []
+        self._start, self._last = self._last, None
+        self._reset_slopes()
+        return [self._start]
+
+
+class SampleCompressor(object):
+    """
+    Per-channel export compression. Batches of samples go in, and the
+    points worth writing come out, grouped by timestamp.
+    """
+
+    methods = {'deadband': DeadBand, 'swinging_door': SwingingDoor}
+
+    def __init__(self, config):
+        """
+        Constructor.
+        :param config: Dict of channel name to dict with method
+        ('deadband' or 'swinging_door'), deviation (in the units the
+        samples are in) and heartbeat_sec. Channels not in config are
+        passed through uncompressed.
+        """
+        self._channels = {}
+        self._samples_in = {}
+        self._points_out = {}
+        for channel, options in config.items():
+            options = dict(options)
+            method = options.pop('method', 'swinging_door')
+            if method not in self.methods:
+                raise ValueError('Unknown compression method "{}", expected one of {}'.format(method, ', '.join(sorted(self.methods))))
+            self._channels[channel] = self.methods[method](**options)
+            self._samples_in[channel] = samples_in.labels(channel)
+            self._points_out[channel] = points_out.labels(channel)
+            compression_ratio.labels(channel).set_function(lambda i=self._samples_in[channel], o=self._points_out[channel]: i.value / o.value if o.value else 0.0)
+
+    def add(self, timestamp, samples):
+        """
+        Return list of (timestamp, samples) points to write, oldest
+        first. A kept sample may be from an earlier batch (swinging door
+        keeps the sample before the one that broke the line).
+        :param timestamp: Time the samples were read, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        """
+        points = {}
+        for channel, value in samples.items():
+            compressor = self._channels.get(channel)
+            if compressor is None:
+                points.setdefault(timestamp, {})[channel] = value
+                continue
+            self._samples_in[channel].inc()
+            for kept_time, kept_value in compressor.add(timestamp, value):
+                points.setdefault(kept_time, {})[channel] = kept_value
+                self._points_out[channel].inc()
+        return sorted(points.items())
+
+    def flush(self):
+        """
+        Return list of (timestamp, samples) points held back by any
+        channel.
+        """
+        points = {}
+        for channel, compressor in self._channels.items():
+            for kept_time, kept_value in compressor.flush():
+                points.setdefault(kept_time, {})[channel] = kept_value
+                self._points_out[channel].inc()
+        return sorted(points.items())
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+"""
+PiEnviro runtime config: one YAML file with sampling, sinks, display,
+beacons, API and logging sections (see config/pienviro.yml). Every
+option has a type, a default and a check, and is marked live (applied
+to the running process on reload) or not (needs a restart).
+"""
+from collections import namedtuple
+from logging import getLogger
+from os import stat
+from os.path import dirname, isabs, join
+from threading import Event
+
+from yaml import YAMLError, safe_load
+
+from compression import SampleCompressor
+from filters import SampleFilter
+
+log = getLogger(__name__)
+
+
+class Option(namedtuple('Option', ['types', 'default', 'live', 'check'])):
+    """
+    Schema entry for one config option.
+    """
+
+    __slots__ = ()
+
+    def validate(self, value, path):
+        """
+        Return value if it is valid, raise ValueError otherwise. Dict
+        values are merged over the default, so a partial dict only
+        overrides the keys it has.
+        """
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types): # bool is an int subclass
+            raise ValueError('{} must be {}, not {!r}'.format(path, ' or '.join(t.__name__ for t in self.types), value))
+        if isinstance(value, dict):
+            value = dict(self.default, **value)
+        elif isinstance(value, int) and float in self.types:
+            value = float(value)
+        error = self.check(value) if self.check is not None and value is not None else None
+        if error:
+            raise ValueError('{} {}'.format(path, error))
+        return value
+
+
+def option(types, default, live=True, check=None):
+    """
+    Return Option. types is a type or tuple of types (an int is accepted
+    for a float).
+    """
+    types = types if isinstance(types, tuple) else (types,)
+    if float in types: types += (int,)
+    return Option(types, default, live, check)
+
+
+def positive(value):
+    return 'must be greater than 0' if value <= 0 else None
+
+
+def non_negative(value):
+    return 'must be 0 or greater' if value < 0 else None
+
+
+def fraction(value):
+    return 'must be between 0 and 1' if not 0 <= value <= 1 else None
+
+
+def one_of(*choices):
+    def check(value):
+        return 'must be one of {}'.format(', '.join(str(choice) for choice in choices)) if value not in choices else None
+    return check
+
+
+def in_range(low, high):
+    def check(value):
+        return 'must be between {} and {}'.format(low, high) if not low <= value <= high else None
+    return check
+
+
+def builds(factory):
+    """
+    Return check that value is a valid set of keyword arguments for
+    factory (e.g. a SampleFilter).
+    """
+    def check(value):
+        try:
+            factory(value)
+        except Exception as err: # any option the factory can't take
+            return 'is invalid ({})'.format(err)
+        return None
+    return check
+
+
+channels = ('temp', 'humidity', 'press')
+
+# Filter settings are in raw sensor units (degC, %, mbar), compression in canonical units (K, %, Pa)
+default_filters = {'temp': {'burst_size': 5, 'method': 'kalman', 'process_var': 1e-4, 'measurement_var': 1e-2, 'outlier_min': 1.0},
+                   'humidity': {'burst_size': 5, 'method': 'kalman', 'process_var': 1e-3, 'measurement_var': 1e-1, 'outlier_min': 3.0},
+                   'press': {'burst_size': 5, 'method': 'kalman', 'process_var': 1e-4, 'measurement_var': 1e-2, 'outlier_min': 1.0}}
+default_compression = {'temp': {'method': 'swinging_door', 'deviation': 0.05, 'heartbeat_sec': 600.0},
+                       'humidity': {'method': 'swinging_door', 'deviation': 0.25, 'heartbeat_sec': 600.0},
+                       'press': {'method': 'swinging_door', 'deviation': 5.0, 'heartbeat_sec': 600.0}}
+
+schema = {'sampling': {'tick_sec': option(float, 0.5, live=False, check=positive),
+                       'intervals': dict((channel, option(float, 15.0, check=positive)) for channel in channels),
+                       'history_sec': option(float, 7*24*60*60, live=False, check=positive),
+                       'spool_dir': option((str, type(None)), None, live=False),
+                       'cpu_temp_ttl_sec': option(float, 1.0, live=False, check=positive),
+                       'temp_correction_alpha': option(float, 0.1, check=fraction),
+                       'filters': dict((channel, option(dict, default_filters[channel], check=builds(lambda options: SampleFilter('check', **options))))
+                                       for channel in channels)},
+          'sinks': {'influxdb': {'config': option((str, type(None)), None, live=False),
+                                 'flush_sec': option(float, 60.0, check=positive),
+                                 'batch_size': option(int, 500, check=positive),
+                                 'max_queue': option(int, 5000, check=positive)},
+                    'archive': {'dir': option((str, type(None)), None, live=False),
+                                'chunk_sec': option(int, 3600, live=False, check=one_of(3600, 86400)),
+                                'retention_sec': option(float, 365*24*60*60, check=positive)},
+                    'compression': dict((channel, option(dict, default_compression[channel], check=builds(lambda options, channel=channel: SampleCompressor({channel: options}))))
+                                        for channel in channels)},
+          'display': {'rotation': option(int, 270, check=one_of(0, 90, 180, 270)),
+                      'speed_index': option(int, 2, check=in_range(0, 4)),
+                      'text_color': option(int, 4, check=in_range(0, 7)),
+                      'background_color': option(int, 0, check=in_range(0, 7)),
+                      'low_light': option(bool, True)},
+          'beacons': {'scan_sec': option(float, 2.0, live=False, check=positive),
+                      'idle_sec': option(float, 8.0, live=False, check=non_negative),
+                      'ttl_sec': option(float, 60.0, live=False, check=positive)},
+          'api': {'host': option(str, '0.0.0.0', live=False),
+                  'port': option(int, 5000, live=False, check=in_range(1, 65535)),
+                  'server': option(str, 'async', live=False, check=one_of('async', 'flask')),
+                  'startup_budget_sec': option(float, 2.0, live=False, check=positive)},
+          'logging': {'level': option(str, 'INFO', check=one_of('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'))}}
+
+
+def validate(config, section=schema, path=''):
+    """
+    Return copy of config with defaults filled in. Raises ValueError for
+    unknown keys and invalid values, naming the option (e.g.
+    'sampling.intervals.temp must be greater than 0').
+    :param config: Dict read from config file (may be partial).
+    """
+    if config is None: config = {}
+    if not isinstance(config, dict):
+        raise ValueError('{} must be a mapping'.format(path.rstrip('.') or 'Config'))
+    unknown = sorted(set(config) - set(section))
+    if unknown:
+        raise ValueError('Unknown config option {}'.format(', '.join(path + key for key in unknown)))
+    result = {}
+    for key, entry in section.items():
+        if isinstance(entry, Option):
+            result[key] = entry.validate(config[key], path + key) if key in config else entry.default
+        else:
+            result[key] = validate(config.get(key), entry, path + key + '.')
+    return result
+
+
+def default_config():
+    """
+    Return config with every option at its default.
+    """
+    return validate({})
+
+
+def load_config(config_file):
+    """
+    Read and validate config file, return it as a dict. An empty file is
+    rejected rather than read as all defaults, as it is most likely
+    being rewritten.
+    :param config_file: String containing config filename, relative to
+    this directory (e.g. 'pienviro.yml').
+    """
+    if not isabs(config_file): config_file = join(dirname(__file__), config_file)
+    try:
+        with open(config_file) as config_stream:
+            config = safe_load(config_stream)
+    except (IOError, YAMLError) as err:
+        raise ValueError('Invalid config file ({}): {}'.format(config_file, err))
+    if config is None:
+        raise ValueError('Invalid config file ({}): file is empty'.format(config_file))
+    try:
+        return validate(config)
+    except ValueError as err:
+        raise ValueError('Invalid config file ({}): {}'.format(config_file, err))
+
+
+def changed_options(old, new, section=schema, path=''):
+    """
+    Return list of (option path, live) for options that differ between
+    two validated configs.
+    """
+    changed = []
+    for key, entry in section.items():
+        if isinstance(entry, Option):
+            if old[key] != new[key]: changed.append((path + key, entry.live))
+        else:
+            changed.extend(changed_options(old[key], new[key], entry, path + key + '.'))
+    return changed
+
+
+class ConfigWatcher(object):
+    """
+    Watches config file by polling its mtime (and size), and passes each
+    new valid version to on_change. A change is only read once the file
+    has stayed the same for two polls, so a file still being written is
+    not picked up half way. Invalid versions are logged and ignored, so
+    a bad edit never takes down a running device.
+    """
+
+    def __init__(self, config_file, on_change, poll_sec=2.0):
+        """
+        Constructor.
+        :param config_file: String containing config filename, relative
+        to this directory.
+        :param on_change: Function called with the new validated config.
+        :param poll_sec: Time between checks, in seconds.
+        """
+        self._config_file = config_file if isabs(config_file) else join(dirname(__file__), config_file)
+        self._on_change = on_change
+        self._poll_sec = poll_sec
+        self._stop_event = Event()
+        self._signature = self._stat() # of the applied version
+        self._pending = None # signature of changed file seen on last poll
+
+    def _stat(self):
+        try:
+            info = stat(self._config_file)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    def run(self):
+        """
+        Watch loop, runs until stop() is called.
+        """
+        while not self._stop_event.wait(self._poll_sec):
+            self.check()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def check(self):
+        """
+        Reload config if the file changed. Returns True if a new config
+        was applied.
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            self._pending = None
+            return False
+        if signature != self._pending: # changed since last poll, may still be being written
+            self._pending = signature
+            return False
+        self._pending = None
+        self._signature = signature
+        try:
+            config = load_config(self._config_file)
+        except ValueError as err:
+            log.error('Ignoring config change, %s', err)
+            return False
+        log.info('Config file changed, applying')
+        try:
+            self._on_change(config)
+        except Exception: # keep watching, a later edit may fix it
+            log.exception('Failed to apply config change!')
+            return False
+        return True
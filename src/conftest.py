@@ -0,0 +1,10 @@
+#!/usr/bin/python
+"""
+pytest setup: modules in this directory import each other by name (as
+when run with python from here), so put it on the path when pytest is
+run from the repo root.
+"""
+from os.path import dirname
+from sys import path
+
+if dirname(__file__) not in path: path.insert(0, dirname(__file__))
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+from glob import glob
+from logging import getLogger
+from os import O_RDONLY, close, open as os_open, pread
+from re import search
+from subprocess import CalledProcessError, check_output
+from time import monotonic
+
+log = getLogger(__name__)
+
+
+class CpuTempSensor(object):
+    """
+    CPU temperature source. Reads the kernel thermal zone file directly,
+    keeping it open and re-reading it with pread, so a read is one
+    syscall instead of a vcgencmd fork/exec. Falls back to vcgencmd only
+    if there is no thermal zone file or it can't be read, and returns
+    None (skipping calibration) if that fails too. Readings are cached
+    for ttl_sec.
+    """
+
+    thermal_zone_glob = '/sys/class/thermal/thermal_zone*/temp'
+
+    def __init__(self, ttl_sec=1.0, zone_path=None):
+        """
+        Constructor.
+        :param ttl_sec: Time a reading is reused for, in seconds.
+        :param zone_path: Thermal zone temp file to read. Defaults to
+        the first thermal zone (the SoC on a Pi).
+        """
+        self._ttl_sec = ttl_sec
+        self._fd = None
+        if zone_path is None:
+            zone_paths = sorted(glob(self.thermal_zone_glob))
+            zone_path = zone_paths[0] if zone_paths else None
+        if zone_path is not None:
+            try:
+                self._fd = os_open(zone_path, O_RDONLY)
+            except OSError as err:
+                log.warning('Could not open CPU thermal zone (%s), using vcgencmd!', err)
+        self._has_vcgencmd = True # cleared if vcgencmd is not installed
+        self._last_temp = None
+        self._last_read = None
+
+    def read(self):
+        """
+        Return CPU temperature in degC, or None if it can't be read.
+        """
+        now = monotonic()
+        if self._last_read is None or now - self._last_read >= self._ttl_sec:
+            self._last_temp = self._read_sysfs() if self._fd is not None else self._read_vcgencmd()
+            self._last_read = now
+        return self._last_temp
+
+    def _read_sysfs(self):
+        """
+        Read thermal zone file, which holds millidegrees C. If the read
+        fails the file is closed and vcgencmd is used from then on.
+        """
+        try:
+            return int(pread(self._fd, 16, 0)) / 1000.0
+        except (OSError, ValueError) as err:
+            log.warning('Could not read CPU thermal zone (%s), using vcgencmd!', err)
+            self.close()
+            return self._read_vcgencmd()
+
+    def _read_vcgencmd(self):
+        """
+        Query vcgencmd, which returns the format: temp=41.7'C
+        """
+        if not self._has_vcgencmd:
+            return None
+        try:
+            match = search(r'temp=([-\d.]+)', check_output(['vcgencmd', 'measure_temp']).decode())
+        except OSError as err:
+            log.warning('Could not read CPU temperature (%s), skipping temperature calibration!', err)
+            self._has_vcgencmd = False
+            return None
+        except CalledProcessError:
+            return None
+        return float(match.group(1)) if match else None
+
+    def close(self):
+        """
+        Close thermal zone file.
+        """
+        if self._fd is not None:
+            close(self._fd)
+            self._fd = None
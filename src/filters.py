@@ -0,0 +1,130 @@
+#!/usr/bin/python
+from math import sqrt
+
+from metrics import Counter
+
+outliers_rejected = Counter('pienviro_filter_outliers_total', 'Sensor readings rejected as outliers.', ('channel',))
+
+
+class SampleFilter(object):
+    """
+    Streaming noise filter for one sensor channel. Each read takes a
+    burst of raw readings and keeps their median, so a spike inside the
+    burst is dropped. The burst median is then checked against the
+    filter estimate: values further off than outlier_sigma standard
+    deviations of recent residuals are rejected, unless max_rejects
+    values in a row are off, which is taken as a real step change and
+    the filter restarts from it. Accepted values are smoothed with an
+    EMA or a 1-D Kalman filter. State is a handful of floats, so cost
+    per read doesn't grow with history.
+    """
+
+    methods = ('median', 'ema', 'kalman')
+
+    def __init__(self, name='', burst_size=5, method='kalman', alpha=0.3, process_var=1e-4, measurement_var=1e-2,
+                 outlier_sigma=4.0, outlier_min=1.0, max_rejects=3, residual_alpha=0.05):
+        """
+        Constructor.
+        :param name: Channel name, used for metrics.
+        :param burst_size: Raw readings taken per read (1 disables
+        oversampling).
+        :param method: Smoothing method: 'median' (burst median only),
+        'ema' or 'kalman'.
+        :param alpha: EMA weight of the newest value.
+        :param process_var: Kalman process noise variance, i.e. how much
+        the true value is expected to drift between reads.
+        :param measurement_var: Kalman measurement noise variance of one
+        burst median.
+        :param outlier_sigma: Residuals larger than this many standard
+        deviations are outliers (0 disables outlier rejection).
+        :param outlier_min: Residuals smaller than this are never
+        outliers, in raw sensor units.
+        :param max_rejects: Number of outliers in a row after which the
+        filter restarts from the new value.
+        :param residual_alpha: EMA weight used to track residual
+        variance.
+        """
+        if method not in self.methods:
+            raise ValueError('Unknown filter method "{}", expected one of {}'.format(method, ', '.join(self.methods)))
+        self._burst_size = max(1, int(burst_size))
+        self._method = method
+        self._alpha = float(alpha)
+        self._process_var = float(process_var)
+        self._measurement_var = float(measurement_var)
+        self._outlier_sigma = float(outlier_sigma)
+        self._outlier_min = float(outlier_min)
+        self._max_rejects = int(max_rejects)
+        self._residual_alpha = float(residual_alpha)
+        self._outliers_rejected = outliers_rejected.labels(name)
+        self.reset()
+
+    def reset(self, value=None):
+        """
+        Restart filter, optionally from value.
+        """
+        self._estimate = value
+        self._estimate_var = self._measurement_var # Kalman estimate variance
+        self._residual_var = 0.0
+        self._rejects = 0 # outliers in a row
+
+    @property
+    def estimate(self):
+        return self._estimate
+
+    def read(self, read_func):
+        """
+        Take a burst of raw readings and return the filtered value.
+        :param read_func: Function called with no arguments to take one
+        raw reading.
+        """
+        if self._burst_size == 1:
+            return self.update(read_func())
+        burst = sorted(read_func() for _ in range(self._burst_size))
+        middle = self._burst_size // 2
+        return self.update(burst[middle] if self._burst_size % 2 else (burst[middle - 1] + burst[middle]) / 2.0)
+
+    def update(self, value):
+        """
+        Feed one value (e.g. a burst median) to the filter and return the
+        filtered value.
+        """
+        if self._estimate is None:
+            self.reset(value)
+            return value
+        residual = value - self._estimate
+        if self._is_outlier(residual):
+            self._rejects += 1
+            self._outliers_rejected.inc()
+            if self._rejects < self._max_rejects:
+                return self._estimate
+            self.reset(value) # sustained change, not an outlier
+            return value
+        self._rejects = 0
+        self._residual_var += self._residual_alpha * (residual * residual - self._residual_var)
+        if self._method == 'median':
+            self._estimate = value
+        elif self._method == 'ema':
+            self._estimate += self._alpha * residual
+        else:
+            self._estimate_var += self._process_var
+            gain = self._estimate_var / (self._estimate_var + self._measurement_var)
+            self._estimate += gain * residual
+            self._estimate_var *= 1.0 - gain
+        return self._estimate
+
+    def _is_outlier(self, residual):
+        """
+        Return True if residual is too large to be noise.
+        """
+        if not self._outlier_sigma:
+            return False
+        return abs(residual) > max(self._outlier_min, self._outlier_sigma * sqrt(self._residual_var))
+
+
+def create_filters(config):
+    """
+    Return dict of channel name to SampleFilter.
+    :param config: Dict of channel name to dict of SampleFilter keyword
+    arguments.
+    """
+    return dict((channel, SampleFilter(channel, **options)) for channel, options in config.items())
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+"""
+Fleet aggregator: polls the /env route of many PiEnviro nodes and serves
+one merged, time-aligned view of every room, so a dashboard makes one
+request instead of one per node per panel.
+
+Usage: python fleet.py (reads fleet.yml, see config/fleet.yml)
+"""
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from json import dumps
+from logging import getLogger
+from os import environ
+from os.path import dirname, isabs, join
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+from flask import Flask, Response, abort, request
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from yaml import YAMLError, safe_load
+
+from async_api import AsyncApiServer
+from logs import setup_logging
+from metrics import Counter, Histogram, content_type as metrics_content_type, default_registry
+from responses import CachedResponse, ResponseCache
+from snapshot import Snapshot
+from units import display_units, get_conversion
+
+log = getLogger(__name__)
+
+poll_latency = Histogram('pienviro_fleet_poll_seconds', 'Time taken to fetch each node snapshot.', ('node',))
+poll_errors = Counter('pienviro_fleet_poll_errors_total', 'Node polls that failed or timed out.', ('node',))
+hedged_requests = Counter('pienviro_fleet_hedged_requests_total', 'Extra requests sent to nodes that were slow to answer.')
+
+
+def load_fleet_config(fleet_config):
+    """
+    Read fleet config file and return it as a dict.
+    :param fleet_config: String containing fleet config filename,
+    relative to this directory (e.g. 'fleet.yml').
+    Expected keys: nodes (list of name and url) -- optional: poll_sec,
+    timeout_sec, hedge_sec, max_age_sec, port.
+    """
+    if not isabs(fleet_config): fleet_config = join(dirname(__file__), fleet_config)
+    try:
+        with open(fleet_config) as config_file:
+            config = safe_load(config_file)
+    except (IOError, YAMLError) as err:
+        raise ValueError('Invalid fleet config file ({}): {}'.format(fleet_config, err))
+    if not isinstance(config, dict) or not isinstance(config.get('nodes'), list) or \
+            not all(isinstance(node, dict) and 'name' in node and 'url' in node for node in config['nodes']):
+        raise ValueError('Fleet config file ({}) must contain a list of nodes, each with name and url'.format(fleet_config))
+    return config
+
+
+class FleetNode(object):
+    """
+    One polled PiEnviro node (usually one room).
+    """
+
+    def __init__(self, name, url):
+        """
+        Constructor.
+        :param name: Node name, shown as the room (e.g. 'Office').
+        :param url: Node REST API URL (e.g. 'http://192.168.1.53:5000').
+        """
+        self.name = name
+        self.env_url = '{}/env'.format(url.rstrip('/'))
+        self.etag = None # ETag of last snapshot, so unchanged snapshots come back as 304
+        self.env = None # last /env response
+        self.last_success = None # time of last successful poll, in seconds since epoch
+        self.latency_sec = None
+        self.errors = 0 # consecutive failed polls
+        self.poll_latency = poll_latency.labels(name)
+        self.poll_errors = poll_errors.labels(name)
+
+
+class FleetView(namedtuple('FleetView', ['version', 'time', 'nodes'])):
+    """
+    Immutable, versioned view of every node, aligned to one reference
+    time. nodes is an OrderedDict of node name to dict of readings;
+    readings older than the aggregator's max_age_sec at the reference
+    time are None, so stale rooms never skew fleet-wide values.
+    """
+
+    __slots__ = ()
+
+    def current(self, channel):
+        """
+        Return OrderedDict of node name to current channel value.
+        """
+        return OrderedDict((name, node[channel]) for name, node in self.nodes.items())
+
+    def summary(self, channel):
+        """
+        Return dict with fleet-wide min, max (each with its room) and
+        mean of channel, over nodes that have a current value.
+        """
+        values = [(value, name) for name, value in self.current(channel).items() if value is not None]
+        if not values:
+            return {'channel': channel, 'time': self.time, 'count': 0, 'min': None, 'max': None, 'mean': None}
+        low, high = min(values), max(values)
+        return {'channel': channel, 'time': self.time, 'count': len(values),
+                'min': {'room': low[1], 'value': low[0]},
+                'max': {'room': high[1], 'value': high[0]},
+                'mean': sum(value for value, _ in values) / len(values)}
+
+    def in_units(self, units):
+        """
+        Return view with readings converted from display units (what
+        nodes serve by default) to units.
+        :param units: Dict of channel name to unit.
+        """
+        conversions = [(channel, get_conversion(display_units[channel], unit)) for channel, unit in units.items() if unit != display_units[channel]]
+        if not conversions:
+            return self
+        nodes = OrderedDict()
+        for name, node in self.nodes.items():
+            nodes[name] = dict(node)
+            for channel, convert in conversions:
+                nodes[name][channel] = convert(node[channel])
+        return self._replace(nodes=nodes)
+
+    def to_dict(self):
+        """
+        Return view as a dict (e.g. for JSON encoding).
+        """
+        return {'time': self.time, 'nodes': self.nodes}
+
+
+class FleetAggregator(object):
+    """
+    Polls every node concurrently over one pooled keep-alive session.
+    Each poll round has a hard deadline (timeout_sec). A node that has
+    not answered after hedge_sec gets a second, hedged request, and a
+    node whose request fails early is retried once, so one slow or
+    dropped request doesn't make a room go missing for a whole round.
+    """
+
+    def __init__(self, nodes, poll_sec=15.0, timeout_sec=2.0, hedge_sec=0.5, max_age_sec=None, session=None):
+        """
+        Constructor.
+        :param nodes: List of dicts with node name and url.
+        :param poll_sec: Time between poll rounds, in seconds.
+        :param timeout_sec: Deadline for each poll round (and each
+        request), in seconds.
+        :param hedge_sec: Time after which a node that has not answered
+        gets a second request, in seconds.
+        :param max_age_sec: Readings older than this at the view time
+        are treated as missing. Defaults to 4 poll rounds.
+        :param session: Optional requests Session to use.
+        """
+        self._nodes = [FleetNode(node['name'], node['url']) for node in nodes]
+        self._poll_sec = float(poll_sec)
+        self._timeout_sec = float(timeout_sec)
+        self._hedge_sec = float(hedge_sec)
+        self._max_age_sec = float(max_age_sec) if max_age_sec is not None else 4 * self._poll_sec
+        pool_size = 2 * max(1, len(self._nodes)) # room for a hedged request per node
+        self._session = session or Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._stop_event = Event()
+        self._lock = Lock() # serializes poll rounds
+        self._view = FleetView(0, None, OrderedDict())
+        self.rounds = 0
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        Return aggregator created from fleet config file.
+        :param config: Fleet config filename (see load_fleet_config).
+        """
+        config = load_fleet_config(config)
+        for key in ('poll_sec', 'timeout_sec', 'hedge_sec', 'max_age_sec'):
+            if key in config: kwargs.setdefault(key, config[key])
+        return cls(config['nodes'], **kwargs)
+
+    def get_view(self):
+        """
+        Return current FleetView.
+        """
+        return self._view
+
+    ####################################################################
+
+    def run(self):
+        """
+        Poll loop, runs until stop() is called.
+        """
+        while not self._stop_event.is_set():
+            start = monotonic()
+            self.poll_once()
+            self._stop_event.wait(max(0.0, self._poll_sec - (monotonic() - start)))
+        self._executor.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Signal poll loop to exit after the current round.
+        """
+        self._stop_event.set()
+
+    def poll_once(self):
+        """
+        Poll every node once (concurrently) and publish a new view.
+        Returns the view.
+        """
+        with self._lock:
+            start = monotonic()
+            hedge_at = start + self._hedge_sec
+            deadline = start + self._timeout_sec
+            pending = {} # future -> node
+            attempts = dict((node, 1) for node in self._nodes)
+            done_nodes = set()
+            for node in self._nodes:
+                pending[self._executor.submit(self._fetch, node)] = node
+            hedged = False
+            while pending and len(done_nodes) < len(self._nodes): # stragglers of answered nodes are left to finish on their own
+                now = monotonic()
+                if now >= deadline:
+                    break
+                if not hedged and now >= hedge_at:
+                    hedged = True
+                    for node in self._nodes:
+                        if node not in done_nodes and attempts[node] == 1:
+                            attempts[node] += 1
+                            hedged_requests.inc()
+                            pending[self._executor.submit(self._fetch, node)] = node
+                    continue
+                done, _ = wait(list(pending), timeout=(deadline if hedged else min(hedge_at, deadline)) - now, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = pending.pop(future)
+                    if node in done_nodes:
+                        continue
+                    try:
+                        self._apply(node, *future.result())
+                        done_nodes.add(node)
+                    except (RequestException, ValueError) as err:
+                        if attempts[node] == 1: # failed fast, retry now rather than waiting to hedge
+                            attempts[node] += 1
+                            pending[self._executor.submit(self._fetch, node)] = node
+                        elif node not in pending.values():
+                            self._poll_failed(node, err)
+                            done_nodes.add(node)
+            for node in self._nodes:
+                if node not in done_nodes:
+                    self._poll_failed(node, 'no response within {} seconds'.format(self._timeout_sec))
+            self._view = self._merge(time())
+            self.rounds += 1
+            return self._view
+
+    def _fetch(self, node):
+        """
+        GET node's /env, conditional on its last ETag. Runs in a worker
+        thread. Returns (env dict or None if unchanged, etag, latency).
+        """
+        start = monotonic()
+        headers = {'If-None-Match': node.etag} if node.etag else {}
+        resp = self._session.get(node.env_url, headers=headers, timeout=self._timeout_sec)
+        latency_sec = monotonic() - start
+        if resp.status_code == 304:
+            return None, node.etag, latency_sec
+        resp.raise_for_status()
+        return resp.json(), resp.headers.get('ETag'), latency_sec
+
+    def _apply(self, node, env, etag, latency_sec):
+        """
+        Save successful poll result to node.
+        """
+        if env is not None:
+            node.env = env
+            node.etag = etag
+        node.last_success = time()
+        node.latency_sec = latency_sec
+        node.errors = 0
+        node.poll_latency.observe(latency_sec)
+
+    def _poll_failed(self, node, err):
+        """
+        Record failed poll of node.
+        """
+        node.errors += 1
+        node.poll_errors.inc()
+        log.warning('Failed to poll fleet node %s (%s)!', node.name, err)
+
+    def _merge(self, view_time):
+        """
+        Return new FleetView of every node's readings at view_time.
+        Node clocks are assumed to be in sync (e.g. NTP), since readings
+        carry the time they were taken on the node.
+        """
+        nodes = OrderedDict()
+        for node in self._nodes:
+            env = node.env or {}
+            readings = {'online': node.errors == 0 and node.last_success is not None,
+                        'last_success': node.last_success,
+                        'latency_sec': node.latency_sec}
+            for channel in Snapshot.channels:
+                read_time = env.get(channel + '_time')
+                fresh = read_time is not None and view_time - read_time <= self._max_age_sec
+                readings[channel] = env.get(channel) if fresh else None
+                readings[channel + '_time'] = read_time
+                readings[channel + '_age_sec'] = view_time - read_time if read_time is not None else None
+            nodes[node.name] = readings
+        return FleetView(self._view.version + 1, view_time, nodes)
+
+
+class FleetResponseCache(ResponseCache):
+    """
+    Pre-serialized fleet route responses (/fleet, and /fleet/<channel>
+    for each channel), encoded once per view version.
+    """
+
+    def __init__(self, get_view):
+        """
+        Constructor.
+        :param get_view: Function returning the current FleetView.
+        """
+        ResponseCache.__init__(self, get_view)
+        self._routes = {'/fleet': self._fleet_response}
+        self._route_channels = {'/fleet': Snapshot.channels}
+        for channel in Snapshot.channels:
+            self._routes['/fleet/' + channel] = self._summary_response(channel)
+            self._route_channels['/fleet/' + channel] = (channel,)
+
+    def _fleet_response(self, view, units):
+        fleet = view.in_units(units).to_dict()
+        fleet['units'] = units
+        return CachedResponse.build(dumps(fleet, sort_keys=True).encode('utf-8'), self.json_type, self._version(view, units), view.time)
+
+    def _summary_response(self, channel):
+        """
+        Return builder for single channel response: value per room, and
+        fleet-wide min, max and mean.
+        """
+        def build(view, units):
+            view_in_units = view.in_units(units)
+            summary = view_in_units.summary(channel)
+            summary['rooms'] = view_in_units.current(channel)
+            summary['unit'] = units[channel]
+            return CachedResponse.build(dumps(summary, sort_keys=True).encode('utf-8'), self.json_type, self._version(view, units), view.time)
+        return build
+
+
+# Initialize fleet API (aggregator is initialized in main, or by the importer)
+fleet_aggregator = None
+fleet_api = Flask(__name__)
+fleet_cache = FleetResponseCache(lambda: fleet_aggregator.get_view())
+
+
+@fleet_api.route('/fleet')
+@fleet_api.route('/fleet/<channel>')
+def fleet(channel=None):
+    """
+    API endpoint for '/fleet' (every room) and '/fleet/<channel>'
+    (channel value per room, with fleet-wide min, max and mean). Values
+    are in display units (degF, %, inHg) unless other units are
+    requested with '?unit='.
+    """
+    try:
+        cached = fleet_cache.get(request.path, request.query_string.decode('latin-1'))
+    except ValueError as err:
+        abort(400, str(err))
+    if cached is None:
+        abort(404, 'Unknown channel "{}"'.format(channel))
+    if cached.is_not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        return Response(status=304, headers=cached.headers)
+    return Response(cached.body, status=cached.status, content_type=cached.content_type, headers=cached.headers)
+
+
+@fleet_api.route('/metrics')
+def metrics():
+    """
+    API endpoint for '/metrics', returns fleet poll metrics in Prometheus
+    text format.
+    """
+    return Response(default_registry.render(), content_type=metrics_content_type)
+
+
+if __name__ == '__main__':
+    setup_logging(environ.get('PIENVIRO_LOG_LEVEL', 'INFO'))
+    config_file = environ.get('PIENVIRO_FLEET_CONFIG', 'fleet.yml')
+    port = load_fleet_config(config_file).get('port', 5000)
+    fleet_aggregator = FleetAggregator.from_config(config_file)
+    fleet_aggregator.poll_once() # serve a full view from the first request
+    Thread(target=fleet_aggregator.run, name='fleet', daemon=True).start()
+    log.info('*** PiEnviro fleet aggregator initialized! ***')
+    AsyncApiServer(fleet_api, fleet_cache, port=port).run()
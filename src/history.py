@@ -0,0 +1,187 @@
+#!/usr/bin/python
+from array import array
+from math import ceil
+from threading import Lock
+
+
+class RingBuffer(object):
+    """
+    Fixed-size history of (timestamp, value) samples for one channel.
+    Samples are kept in two preallocated array('d') buffers, so memory
+    use is fixed at 16 bytes per sample no matter how long the process
+    runs. Once full, the oldest sample is overwritten. Timestamps are
+    expected to be appended in increasing order, which lets range
+    queries find their start with a binary search.
+    """
+
+    def __init__(self, capacity):
+        """
+        Constructor.
+        :param capacity: Maximum number of samples kept.
+        """
+        self.capacity = int(capacity)
+        self._times = array('d', [0.0]) * self.capacity
+        self._values = array('d', [0.0]) * self.capacity
+        self._start = 0 # physical index of oldest sample
+        self._count = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        """
+        Add sample, overwriting the oldest sample if buffer is full.
+        :param timestamp: Sample time, in seconds since epoch.
+        :param value: Sample value.
+        """
+        with self._lock:
+            if self._count < self.capacity:
+                index = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                index = self._start
+                self._start = (self._start + 1) % self.capacity
+            self._times[index] = timestamp
+            self._values[index] = value
+
+    def resize(self, capacity):
+        """
+        Change maximum number of samples kept. When shrinking, the
+        newest samples are kept.
+        :param capacity: New maximum number of samples kept.
+        """
+        capacity = int(capacity)
+        with self._lock:
+            keep = min(self._count, capacity)
+            first = self._count - keep
+            times = array('d', [0.0]) * capacity
+            values = array('d', [0.0]) * capacity
+            for i in range(keep):
+                index = (self._start + first + i) % self.capacity
+                times[i] = self._times[index]
+                values[i] = self._values[index]
+            self.capacity = capacity
+            self._times, self._values = times, values
+            self._start = 0
+            self._count = keep
+
+    def _bisect(self, timestamp):
+        """
+        Return logical index of first sample at or after timestamp.
+        Must be called with lock held.
+        """
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._times[(self._start + mid) % self.capacity] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def samples(self, since=None, until=None):
+        """
+        Return list of (timestamp, value) samples in time range.
+        :param since: Earliest sample time to include. If None starts
+        at oldest sample.
+        :param until: Latest sample time to include. If None ends at
+        newest sample.
+        """
+        with self._lock:
+            first = self._bisect(since) if since is not None else 0
+            last = self._bisect(until + 1e-9) if until is not None else self._count # include samples at until
+            return [(self._times[(self._start + i) % self.capacity], self._values[(self._start + i) % self.capacity])
+                    for i in range(first, last)]
+
+    def downsample(self, step, since=None, until=None):
+        """
+        Return list of (bucket_time, min, max, mean, count) tuples, one
+        per step second bucket in time range that contains samples.
+        Buckets are aligned to multiples of step.
+        :param step: Bucket width, in seconds.
+        :param since: Earliest sample time to include.
+        :param until: Latest sample time to include.
+        """
+        buckets = []
+        bucket = None
+        for timestamp, value in self.samples(since, until):
+            bucket_time = (timestamp // step) * step
+            if bucket is None or bucket[0] != bucket_time:
+                if bucket is not None: buckets.append(self._close_bucket(bucket))
+                bucket = [bucket_time, value, value, 0.0, 0]
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            bucket[4] += 1
+        if bucket is not None: buckets.append(self._close_bucket(bucket))
+        return buckets
+
+    @staticmethod
+    def _close_bucket(bucket):
+        """
+        Convert running bucket totals to (bucket_time, min, max, mean,
+        count) tuple.
+        """
+        return (bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4], bucket[4])
+
+
+class HistoryStore(object):
+    """
+    Ring buffer history for each environment channel.
+    """
+
+    def __init__(self, channel_intervals, retention_sec=7*24*60*60):
+        """
+        Constructor.
+        :param channel_intervals: Dict of channel name to sample
+        interval, in seconds, used to size each channel's buffer.
+        :param retention_sec: Minimum amount of history to keep, in
+        seconds. Default is 7 days.
+        """
+        self._retention_sec = retention_sec
+        self._buffers = dict((channel, RingBuffer(self._capacity(interval_sec)))
+                             for channel, interval_sec in channel_intervals.items())
+
+    def _capacity(self, interval_sec):
+        return ceil(self._retention_sec / float(interval_sec)) + 1
+
+    @property
+    def channels(self):
+        """
+        Names of channels in store.
+        """
+        return sorted(self._buffers)
+
+    def set_interval(self, channel, interval_sec):
+        """
+        Resize channel's buffer for a new sample interval, so it still
+        holds retention_sec of history (e.g. after a config change).
+        :param channel: Channel name.
+        :param interval_sec: New sample interval, in seconds.
+        """
+        capacity = self._capacity(interval_sec)
+        if capacity != self._buffers[channel].capacity: self._buffers[channel].resize(capacity)
+
+    def append(self, timestamp, samples):
+        """
+        Add batch of samples that were read at the same time.
+        :param timestamp: Sample time, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        """
+        for channel, value in samples.items():
+            if channel in self._buffers: self._buffers[channel].append(timestamp, value)
+
+    def query(self, channel, since=None, until=None, step=None):
+        """
+        Return samples for channel in time range. If step is passed,
+        returns (bucket_time, min, max, mean, count) tuples instead of
+        raw (timestamp, value) samples.
+        :param channel: Channel name.
+        :param since: Earliest sample time to include.
+        :param until: Latest sample time to include.
+        :param step: Bucket width, in seconds, to downsample to.
+        """
+        if step:
+            return self._buffers[channel].downsample(step, since, until)
+        return self._buffers[channel].samples(since, until)
@@ -0,0 +1,364 @@
+#!/usr/bin/python
+from collections import deque
+from glob import glob
+from gzip import compress
+from logging import getLogger
+from os import makedirs, remove
+from os.path import dirname, isabs, join
+from random import random
+from tempfile import gettempdir
+from threading import Condition, Event
+from time import monotonic, time
+
+from yaml import YAMLError, safe_load
+
+from metrics import Counter, Gauge, Histogram
+
+log = getLogger(__name__)
+
+queue_depth = Gauge('pienviro_export_queue_depth', 'Points waiting in memory to be written to InfluxDB.')
+flush_latency = Histogram('pienviro_export_flush_seconds', 'Time taken by each InfluxDB write request.')
+failed_flushes = Counter('pienviro_export_failed_flushes_total', 'InfluxDB write requests that failed and will be retried.')
+
+
+def load_influxdb_config(influxdb_config):
+    """
+    Read InfluxDB config file and return it as a dict.
+    :param influxdb_config: String containing InfluxDB config filename,
+    relative to this directory (e.g. 'jwm_influxdb.yml').
+    Expected keys: url, db -- optional: username, password, batch_size,
+    flush_sec, max_queue, spill_dir, spill_after_failures. PiEnviro
+    passes batch_size, flush_sec and max_queue from its own config
+    (sinks.influxdb in pienviro.yml), which take precedence.
+    """
+    if not isabs(influxdb_config): influxdb_config = join(dirname(__file__), influxdb_config)
+    try:
+        with open(influxdb_config) as config_file:
+            config = safe_load(config_file)
+    except (IOError, YAMLError) as err:
+        raise ValueError('Invalid InfluxDB config file ({}): {}'.format(influxdb_config, err))
+    if not isinstance(config, dict) or 'url' not in config or 'db' not in config:
+        raise ValueError('InfluxDB config file ({}) must contain url and db'.format(influxdb_config))
+    return config
+
+
+def format_line(measurement, fields, timestamp, tags=None):
+    """
+    Return single InfluxDB line protocol point, with millisecond
+    timestamp precision.
+    :param measurement: Measurement name.
+    :param fields: Dict of field name to float value.
+    :param timestamp: Point time, in seconds since epoch.
+    :param tags: Optional dict of tag name to string value.
+    """
+    key = _escape(measurement)
+    if tags: key += ''.join(',{}={}'.format(_escape(k), _escape(v)) for k, v in sorted(tags.items()))
+    field_set = ','.join('{}={!r}'.format(_escape(k), float(v)) for k, v in sorted(fields.items()))
+    return '{} {} {}'.format(key, field_set, int(round(timestamp * 1000)))
+
+
+def _escape(value):
+    """
+    Escape line protocol special characters in measurement, tag or
+    field key.
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\=')
+
+
+class InfluxDBWriter(object):
+    """
+    Buffered InfluxDB writer. Points are queued in memory and written in
+    batches (every batch_size points or flush_sec seconds, whichever
+    comes first) as one gzip-compressed line protocol POST over a
+    keep-alive session. Failed writes are retried with exponential
+    backoff. While the server stays down, queued points are spilled to
+    disk so memory stays bounded, and spilled points are sent once the
+    server is back. Points can carry an ack token, which is passed to
+    ack_callback once the point has left memory (written, spilled, or
+    rejected by the server), so callers know what is safe to forget.
+    """
+
+    headers = {'Content-Encoding': 'gzip', 'Content-Type': 'text/plain; charset=utf-8'}
+
+    def __init__(self, url, db, username=None, password=None, batch_size=500, flush_sec=60.0, max_queue=5000,
+                 spill_dir=None, spill_after_failures=3, retry_base_sec=1.0, retry_max_sec=300.0, timeout_sec=10.0,
+                 session=None, ack_callback=None):
+        """
+        Constructor.
+        :param url: InfluxDB server URL (e.g. 'http://localhost:8086').
+        :param db: Database name.
+        :param username: Optional database username.
+        :param password: Optional database password.
+        :param batch_size: Maximum number of points per POST.
+        :param flush_sec: Maximum time a point waits before being sent.
+        :param max_queue: Maximum number of points held in memory, any
+        more are spilled to disk.
+        :param spill_dir: Directory for spilled points. Defaults to a
+        directory in the system temp dir.
+        :param spill_after_failures: Number of consecutive failed writes
+        after which queued points are spilled to disk.
+        :param retry_base_sec: Wait before first retry, doubled for each
+        consecutive failure.
+        :param retry_max_sec: Maximum wait between retries.
+        :param timeout_sec: HTTP request timeout.
+        :param session: Optional requests Session to use.
+        :param ack_callback: Optional function called with the ack token
+        of the newest point that has left memory. Points leave memory in
+        the order they were written.
+        """
+        self._write_url = '{}/write'.format(url.rstrip('/'))
+        self._params = {'db': db, 'precision': 'ms'}
+        if username and password:
+            self._params['u'] = username
+            self._params['p'] = password
+        self._batch_size = int(batch_size)
+        self._flush_sec = float(flush_sec)
+        self._max_queue = int(max_queue)
+        self._spill_dir = spill_dir or join(gettempdir(), 'pienviro', 'influxdb')
+        self._spill_after_failures = int(spill_after_failures)
+        self._retry_base_sec = float(retry_base_sec)
+        self._retry_max_sec = float(retry_max_sec)
+        self._timeout_sec = float(timeout_sec)
+        self._session = session # created on first post, see _get_session
+        if session is not None: session.headers.update(self.headers)
+        self._ack_callback = ack_callback
+        self._queue = deque() # (line, ack token) tuples
+        self._queue_cond = Condition()
+        queue_depth.set_function(self.queue_depth)
+        self._stop_event = Event()
+        self._deadline = None # monotonic time of next flush, set by run()
+        self._failures = 0 # consecutive failed writes
+        # Stats
+        self._points_sent = 0
+        self._points_spilled = 0
+        self._points_dropped = 0
+        self._flushes = 0
+        self._failed_flushes = 0
+        self._last_flush_sec = 0.0
+
+    @classmethod
+    def from_config(cls, influxdb_config, **kwargs):
+        """
+        Create writer from InfluxDB config file.
+        :param influxdb_config: String containing InfluxDB config
+        filename (see load_influxdb_config).
+        """
+        config = load_influxdb_config(influxdb_config)
+        for key in ('username', 'password', 'batch_size', 'flush_sec', 'max_queue', 'spill_dir', 'spill_after_failures'):
+            if key in config: kwargs.setdefault(key, config[key])
+        return cls(config['url'], config['db'], **kwargs)
+
+    ####################################################################
+
+    def write(self, line, ack=None):
+        """
+        Queue line protocol point to be written. Never blocks on the
+        network; if the queue is full it is spilled to disk.
+        :param line: Line protocol point (see format_line).
+        :param ack: Optional token passed to ack_callback once the point
+        has left memory.
+        """
+        with self._queue_cond:
+            self._queue.append((line, ack))
+            if len(self._queue) >= self._max_queue:
+                self._spill_queue()
+            elif len(self._queue) >= self._batch_size:
+                self._queue_cond.notify()
+
+    def queue_depth(self):
+        """
+        Return number of points waiting in memory.
+        """
+        return len(self._queue)
+
+    def run(self):
+        """
+        Writer loop, sends batches until stop() is called, then makes a
+        final attempt to send (or spill) everything still queued.
+        """
+        self._deadline = monotonic() + self._flush_sec
+        while not self._stop_event.is_set():
+            with self._queue_cond:
+                wait_sec = self._deadline - monotonic()
+                if wait_sec > 0 and (self._failures or len(self._queue) < self._batch_size): # always wait out backoff
+                    self._queue_cond.wait(wait_sec)
+            if self._stop_event.is_set():
+                break
+            if monotonic() >= self._deadline or (not self._failures and len(self._queue) >= self._batch_size):
+                if self.flush():
+                    self._deadline = monotonic() + self._flush_sec
+                else:
+                    self._deadline = monotonic() + self._backoff_sec()
+        if not self.flush():
+            with self._queue_cond:
+                self._spill_queue()
+
+    def configure(self, batch_size=None, flush_sec=None, max_queue=None):
+        """
+        Change batching while running. Queued points are kept; a shorter
+        flush_sec takes effect right away.
+        :param batch_size: Maximum number of points per POST.
+        :param flush_sec: Maximum time a point waits before being sent.
+        :param max_queue: Maximum number of points held in memory.
+        """
+        with self._queue_cond:
+            if batch_size is not None: self._batch_size = int(batch_size)
+            if max_queue is not None: self._max_queue = int(max_queue)
+            if flush_sec is not None:
+                self._flush_sec = float(flush_sec)
+                if self._deadline is not None and not self._failures: self._deadline = min(self._deadline, monotonic() + self._flush_sec)
+            self._queue_cond.notify()
+
+    def stop(self):
+        """
+        Signal writer loop to do a final flush and exit.
+        """
+        self._stop_event.set()
+        with self._queue_cond:
+            self._queue_cond.notify()
+
+    def flush(self):
+        """
+        Send everything that is queued (and anything previously spilled
+        to disk), in batches. Return True if all batches were written.
+        """
+        while True:
+            with self._queue_cond:
+                batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+            if not batch:
+                break
+            if not self._post([line for line, _ in batch]):
+                self._requeue(batch)
+                return False
+            self._ack(batch)
+        return self._flush_spilled()
+
+    def _backoff_sec(self):
+        """
+        Return wait before next retry, doubling with each consecutive
+        failure, with jitter so many devices don't retry in lockstep.
+        """
+        wait_sec = min(self._retry_max_sec, self._retry_base_sec * 2 ** min(self._failures - 1, 16))
+        return wait_sec * (0.5 + random() / 2)
+
+    def _get_session(self):
+        """
+        Return requests Session, creating it on first use. requests is
+        imported here, on the writer thread, to keep it off the startup
+        path.
+        """
+        if self._session is None:
+            from requests import Session
+            self._session = Session()
+            self._session.headers.update(self.headers)
+        return self._session
+
+    def _post(self, batch):
+        """
+        POST batch of points, return True if the server accepted them
+        (or rejected them as invalid, in which case retrying is useless).
+        """
+        session = self._get_session()
+        from requests.exceptions import RequestException # already loaded by _get_session
+        start = monotonic()
+        self._flushes += 1
+        try:
+            resp = session.post(self._write_url, params=self._params, data=compress('\n'.join(batch).encode('utf-8')), timeout=self._timeout_sec)
+        except RequestException as err:
+            return self._post_failed('Failed to post InfluxDB update (%s)!', err)
+        self._last_flush_sec = monotonic() - start
+        flush_latency.observe(self._last_flush_sec)
+        if resp.status_code >= 500:
+            return self._post_failed('Failed to post InfluxDB update, server error %s!', resp.status_code)
+        self._failures = 0
+        if resp.status_code >= 400:
+            self._points_dropped += len(batch)
+            log.error('InfluxDB rejected %d points (%s: %s), dropping them!', len(batch), resp.status_code, resp.text.strip())
+        else:
+            self._points_sent += len(batch)
+        return True
+
+    def _post_failed(self, message, *args):
+        """
+        Record and log failed POST and return False.
+        """
+        self._failures += 1
+        self._failed_flushes += 1
+        failed_flushes.inc()
+        log.warning(message, *args)
+        return False
+
+    def _requeue(self, batch):
+        """
+        Put batch back at the front of the queue after a failed POST.
+        Spills to disk instead if memory would go over the limit or the
+        server has been down for several retries.
+        """
+        with self._queue_cond:
+            self._queue.extendleft(reversed(batch))
+            if len(self._queue) >= self._max_queue or self._failures >= self._spill_after_failures:
+                self._spill_queue()
+
+    ####################################################################
+
+    def _spill_queue(self):
+        """
+        Move everything queued in memory to a new spill file. Must be
+        called with queue lock held.
+        """
+        if not self._queue:
+            return
+        try:
+            makedirs(self._spill_dir, exist_ok=True)
+            spill_file = join(self._spill_dir, 'spill-{:.6f}.lp'.format(time()))
+            with open(spill_file, 'w') as spill:
+                spill.write('\n'.join(line for line, _ in self._queue) + '\n')
+            self._points_spilled += len(self._queue)
+        except (IOError, OSError) as err:
+            self._points_dropped += len(self._queue)
+            log.error('Could not spill %d InfluxDB points to disk (%s), dropping them!', len(self._queue), err)
+        self._ack(self._queue)
+        self._queue.clear()
+
+    def _ack(self, points):
+        """
+        Pass ack token of newest point that has one to ack_callback.
+        :param points: (line, ack token) tuples that have left memory.
+        """
+        if self._ack_callback is None:
+            return
+        for _, ack in reversed(points):
+            if ack is not None:
+                self._ack_callback(ack)
+                return
+
+    def _flush_spilled(self):
+        """
+        Send spilled points, oldest file first, deleting each file once
+        it is written. Return True if all spilled points were written.
+        """
+        for spill_file in sorted(glob(join(self._spill_dir, 'spill-*.lp'))):
+            with open(spill_file) as spill:
+                lines = spill.read().splitlines()
+            for i in range(0, len(lines), self._batch_size):
+                if not self._post(lines[i:i + self._batch_size]):
+                    if i: # rewrite file with what is left, so sent points aren't sent twice
+                        with open(spill_file, 'w') as spill:
+                            spill.write('\n'.join(lines[i:]) + '\n')
+                    return False
+            remove(spill_file)
+        return True
+
+    ####################################################################
+
+    def get_stats(self):
+        """
+        Return dict of writer stats.
+        """
+        return {'queue_depth': len(self._queue),
+                'points_sent': self._points_sent,
+                'points_spilled': self._points_spilled,
+                'points_dropped': self._points_dropped,
+                'flushes': self._flushes,
+                'failed_flushes': self._failed_flushes,
+                'last_flush_sec': self._last_flush_sec}
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+from logging import Filter, Formatter, StreamHandler, getLogger
+from threading import Lock
+from time import monotonic
+
+
+class RateLimitFilter(Filter):
+    """
+    Logging filter that lets through at most burst records with the same
+    message template every period_sec seconds, and reports how many were
+    suppressed once the period is over. This keeps a failing sensor or an
+    unreachable server from flooding the log.
+    """
+
+    def __init__(self, burst=5, period_sec=60.0):
+        """
+        Constructor.
+        :param burst: Records allowed per message template per period.
+        :param period_sec: Length of rate limit period, in seconds.
+        """
+        Filter.__init__(self)
+        self._burst = burst
+        self._period_sec = period_sec
+        self._windows = {} # (logger, template) -> [window start, count]
+        self._lock = Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self._period_sec:
+                suppressed = window[1] - self._burst if window is not None and window[1] > self._burst else 0
+                self._windows[key] = [now, 1]
+                if suppressed:
+                    record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+                return True
+            window[1] += 1
+            return window[1] <= self._burst
+
+
+def setup_logging(level='INFO', burst=5, period_sec=60.0):
+    """
+    Configure root logger to write leveled, rate-limited log lines to
+    stderr.
+    :param level: Log level name or number (e.g. 'DEBUG' to see every
+    sample update).
+    :param burst: Records allowed per message template per period.
+    :param period_sec: Length of rate limit period, in seconds.
+    """
+    handler = StreamHandler()
+    handler.setFormatter(Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(RateLimitFilter(burst, period_sec))
+    root = getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+from bisect import bisect_left
+from threading import Lock
+
+
+class Metric(object):
+    """
+    Base for metrics. A metric with label names holds one child per set
+    of label values; one without labels is its own (only) child.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=(), registry=None):
+        """
+        Constructor, registers metric with registry.
+        :param name: Metric name (e.g. 'pienviro_sensor_reads_total').
+        :param help_text: One line description.
+        :param label_names: Names of labels (e.g. ('channel',)).
+        :param registry: Registry to add metric to. Defaults to the
+        module registry.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = Lock()
+        if not self.label_names: self._children[()] = self
+        (registry if registry is not None else default_registry).register(self)
+
+    def labels(self, *label_values):
+        """
+        Return child metric for label values (created on first use).
+        Callers on hot paths should keep the child rather than calling
+        this each time.
+        """
+        label_values = tuple(str(value) for value in label_values)
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, label_values, extra=None):
+        """
+        Return '{name="value",...}' label string ('' if no labels).
+        """
+        pairs = list(zip(self.label_names, label_values))
+        if extra: pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs) + '}'
+
+    def render(self):
+        """
+        Return metric in Prometheus text exposition format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for label_values, child in sorted(self._children.items()):
+            lines.extend(child._samples(self.name, self._label_text, label_values))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Value that only goes up.
+    """
+
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_names=(), registry=None):
+        self._value = 0.0
+        self._value_lock = Lock()
+        Metric.__init__(self, name, help_text, label_names, registry)
+
+    def _new_child(self):
+        child = Counter.__new__(Counter)
+        child._value = 0.0
+        child._value_lock = Lock()
+        return child
+
+    def inc(self, amount=1.0):
+        with self._value_lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def _samples(self, name, label_text, label_values):
+        return ['{}{} {!r}'.format(name, label_text(label_values), self._value)]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, either set directly or read from a
+    function when metrics are rendered.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), registry=None):
+        self._value = 0.0
+        self._function = None
+        Metric.__init__(self, name, help_text, label_names, registry)
+
+    def _new_child(self):
+        child = Gauge.__new__(Gauge)
+        child._value = 0.0
+        child._function = None
+        return child
+
+    def set(self, value):
+        self._value = float(value)
+
+    def set_function(self, function):
+        """
+        Read gauge value from function (called with no arguments) each
+        time metrics are rendered.
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        return float(self._function()) if self._function is not None else self._value
+
+    def _samples(self, name, label_text, label_values):
+        return ['{}{} {!r}'.format(name, label_text(label_values), self.value)]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted into cumulative buckets.
+    """
+
+    metric_type = 'histogram'
+
+    # Default buckets, in seconds, suited to I/O latencies on a Pi
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets, registry=None):
+        """
+        Constructor.
+        :param buckets: Upper bounds of buckets, in increasing order
+        (+Inf is added automatically).
+        """
+        self._init_values(buckets)
+        Metric.__init__(self, name, help_text, label_names, registry)
+
+    def _init_values(self, buckets):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._value_lock = Lock()
+
+    def _new_child(self):
+        child = Histogram.__new__(Histogram)
+        child._init_values(self._buckets)
+        return child
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        with self._value_lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def _samples(self, name, label_text, label_values):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float('inf'),), self._counts):
+            cumulative += count
+            samples.append('{}_bucket{} {}'.format(name, label_text(label_values, ('le', '+Inf' if bound == float('inf') else repr(bound))), cumulative))
+        samples.append('{}_sum{} {!r}'.format(name, label_text(label_values), self._sum))
+        samples.append('{}_count{} {}'.format(name, label_text(label_values), cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Set of metrics, rendered together for the /metrics endpoint.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric "{}" is already registered'.format(metric.name))
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Return every metric in Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+default_registry = MetricsRegistry()
+
+# Content-Type of render() output
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
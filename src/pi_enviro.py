@@ -1,19 +1,29 @@
 #!/usr/bin/python
-from datetime import datetime
-from netifaces import ifaddresses, AF_INET
-from os import popen
-from os.path import dirname, join
-#FIXME from pint import UnitRegistry
-#FIXME from pint.converters import ScaleConverter
-#FIXME from pint.unit import UnitDefinition
-#FIXME from requests import post
-#FIXME from requests.exceptions import ConnectionError, MissingSchema
-from sense_hat import SenseHat
-from threading import Thread
-from time import sleep
-#FIXME from yaml import load, YAMLError
-
-# TODO: Remove InfluxDB stuff and put in separate class, which can call PiEnviro getters to post to database
+from archive import SampleArchive
+from backends import RealSenseHat
+from compression import SampleCompressor
+from config import ConfigWatcher, changed_options, default_config, load_config
+from filters import create_filters
+from os import environ
+from os.path import join
+from history import HistoryStore
+from influxdb import InfluxDBWriter, format_line
+from logging import getLogger
+from logs import setup_logging
+from metrics import Gauge
+from scheduler import SampleScheduler
+from screen import ScreenRenderer
+from snapshot import Snapshot
+from spool import SampleSpool
+from signal import SIGINT, SIGTERM, signal
+from tempfile import gettempdir
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from units import canonical_units, display_units, get_conversion
+
+log = getLogger(__name__)
+
+startup_time = Gauge('pienviro_startup_seconds', 'Time from start to each startup milestone.', ('phase',))
 
 
 class PiEnviro(object):
@@ -41,75 +51,264 @@ class PiEnviro(object):
     # Scroll speeds (lower is faster)
     scroll_speeds = [0.15, 0.125, 0.1, 0.075, 0.05]
 
-    # Environment data
-    curr_temp = None
-    curr_humidity = None
-    curr_press = None
+    # Units of raw Sense HAT readings
+    sensor_units = {'temp': 'degC', 'humidity': '%', 'press': 'mbar'}
 
     ####################################################################
 
-    def __init__(self, influxdb_config=None):
+    def __init__(self, influxdb_config=None, sense_hat=None, spool_dir=None, config_file=None, archive_dir=None):
         """
         Constructor.
         :param influxdb_config: String containing InfluxDB config
         filename, which should be located in /scripts directory.
-        """
-        self._init_defaults()
-        self._init_sense_hat()
+        Overrides sinks.influxdb.config in config file.
+        :param sense_hat: Sense HAT backend (see backends.py), e.g. a
+        SimulatedSenseHat for running off-device. If None will connect
+        to the real Sense HAT.
+        :param spool_dir: Directory for the sample spool. Overrides
+        sampling.spool_dir in config file, which defaults to a
+        directory in the system temp dir.
+        :param config_file: String containing PiEnviro config filename
+        (see config.py), e.g. 'pienviro.yml'. The file is watched and
+        changes are applied while running. If None defaults are used.
+        :param archive_dir: Directory for archive chunks. Overrides
+        sinks.archive.dir in config file.
+        """
+        self._started = monotonic()
+        self._stop_event = Event()
+        self._init_defaults(load_config(config_file) if config_file else default_config())
+        if spool_dir: self._spool_dir = spool_dir
+        if archive_dir: self._archive_dir = archive_dir
+        if influxdb_config is None: influxdb_config = self._config['sinks']['influxdb']['config']
+        self._init_sense_hat(sense_hat)
+        self._init_scheduler()
         # Initialize control threads
         self._screen_thread_obj = self._init_screen_thread()
         self._joystick_thread_obj = self._init_joystick_thread()
-        self._temp_thread_obj = self._init_temp_thread()
-        self._humidity_thread_obj = self._init_humidity_thread()
-        self._press_thread_obj = self._init_press_thread()
-        if influxdb_config: self._influxdb_thread_obj = self._init_influxdb_thread(influxdb_config) # only initialize this thread if config is passed in
-
-    def _init_defaults(self):
-        """
-        Initialize default values.
-        """
-        # Initialize unit registry, percent unit (for humidity)
-        #FIXME self._ureg = UnitRegistry()
-        #FIXME self._ureg.define(UnitDefinition('%', 'pct', (), ScaleConverter(1/100.0)))
+        self._scheduler_thread_obj = self._init_scheduler_thread()
+        if influxdb_config: # only initialize this thread if config is passed in
+            try:
+                self._influxdb_thread_obj = self._init_influxdb_thread(influxdb_config)
+            except ValueError as err: # a bad InfluxDB config shouldn't stop the screen, API or spool
+                log.error('Could not create InfluxDB writer (%s), InfluxDB export disabled!', err)
+        if config_file: self._config_thread_obj = self._init_config_thread(config_file) # only watch config if there is a file
+        self._init_archive()
+        self._init_spool()
+
+    def _init_defaults(self, config):
+        """
+        Initialize default values from validated config (see config.py).
+        """
+        self._config = config
+        sampling = config['sampling']
+        influxdb = config['sinks']['influxdb']
+        display = config['display']
+        # Initialize unit conversions: sensor units -> canonical SI (stored) -> display units (screen, API, InfluxDB)
+        self._sensor_conversions = dict((channel, get_conversion(unit, canonical_units[channel])) for channel, unit in self.sensor_units.items())
+        self._display_conversions = dict((channel, get_conversion(canonical_units[channel], unit)) for channel, unit in display_units.items())
+        # Initialize environment data (replaced, never modified, on update, in canonical units)
+        self._snapshot = Snapshot.empty()
+        self._snapshot_lock = Lock() # serializes writers only, readers never block
+        self._snapshot_listeners = []
         # Initialize timing defaults
-        self._read_temp_wait_sec = 15.0
-        self._read_humidity_wait_sec = 15.0
-        self._read_press_wait_sec = 15.0
-        self._post_influxdb_wait_sec = 60.0
+        self._sample_tick_sec = sampling['tick_sec'] # resolution of shared sampling timeline
+        self._read_temp_wait_sec = sampling['intervals']['temp']
+        self._read_humidity_wait_sec = sampling['intervals']['humidity']
+        self._read_press_wait_sec = sampling['intervals']['press']
+        self._post_influxdb_wait_sec = influxdb['flush_sec'] # max time a sample waits in the InfluxDB write buffer
+        self._post_influxdb_batch_size = influxdb['batch_size']
+        self._post_influxdb_max_queue = influxdb['max_queue']
+        # Initialize export compression defaults, in canonical units (see compression.py)
+        self._compression_config = config['sinks']['compression']
+        self._history_sec = sampling['history_sec'] # samples kept in memory
+        self._spool_dir = sampling['spool_dir'] or join(gettempdir(), 'pienviro', 'spool')
+        self._archive_dir = config['sinks']['archive']['dir'] or join(gettempdir(), 'pienviro', 'archive')
+        self._archive_chunk_sec = config['sinks']['archive']['chunk_sec']
+        self._archive_retention_sec = config['sinks']['archive']['retention_sec']
+        # Initialize temperature calibration defaults
+        self._cpu_temp_ttl_sec = sampling['cpu_temp_ttl_sec']
+        self._temp_correction_alpha = sampling['temp_correction_alpha'] # EMA weight of newest CPU temperature correction
+        # Initialize sensor filter defaults, in raw sensor units (see filters.py)
+        self._filter_config = sampling['filters']
         # Initialize screen defaults
-        self._screen_rotation = self.screen_rotations[3]
+        self._screen_rotation = display['rotation']
         self._screen_message = '' # This is set by _update_screen_message
-        self._screen_speed_index = 2 # middle
+        self._screen_speed_index = display['speed_index']
         self._screen_speed = self.scroll_speeds[self._screen_speed_index]
-        self._screen_text_color_index = 4 # blue
+        self._screen_text_color_index = display['text_color']
         self._screen_text_color = self.colors[self._screen_text_color_index]
-        self._screen_background_color = self.colors[0] # black
+        self._screen_background_color = self.colors[display['background_color']]
+        self._screen_low_light = display['low_light'] # make screen a little dimmer
 
-    def _init_sense_hat(self):
+    def _init_sense_hat(self, sense_hat=None):
         """
         Initialize connection with Sense HAT.
-        """
-        # Initialize SenseHat object
-        self._sense_hat = SenseHat()
-        self._sense_hat.low_light = True # make screen a little dimmer
-        self._sense_hat.set_rotation(self._screen_rotation)
-        # Initialize environment defaults
-        self.curr_temp = self._read_temp()
-        self.curr_humidity = self._read_humidity()
-        self.curr_press = self._read_press()
+        :param sense_hat: Sense HAT backend. If None will connect to the
+        real Sense HAT.
+        """
+        # Initialize SenseHat backend
+        self._sense_hat = sense_hat if sense_hat is not None else RealSenseHat(cpu_temp_ttl_sec=self._cpu_temp_ttl_sec)
+        self._sense_hat.low_light = self._screen_low_light
+        self._sense_hat.set_rotation(0) # screen rotation is applied by the renderer
+        self._screen_renderer = ScreenRenderer(self._sense_hat.get_glyph)
+        self._temp_correction = None # smoothed CPU temperature correction, set by _read_temp
+        self._filters = create_filters(self._filter_config) # oversample and denoise raw sensor readings
+        # First readings are taken by the sampling thread, so startup doesn't wait on the sensors
+
+    def _init_scheduler(self):
+        """
+        Initialize shared sampling scheduler, which reads every sensor
+        channel on one timeline and serializes access to the sensor bus.
+        """
+        self._scheduler = SampleScheduler(tick_sec=self._sample_tick_sec)
+        self._scheduler.add_channel('temp', self._read_temp, self._read_temp_wait_sec)
+        self._scheduler.add_channel('humidity', self._read_humidity, self._read_humidity_wait_sec)
+        self._scheduler.add_channel('press', self._read_press, self._read_press_wait_sec)
+        self._scheduler.add_batch_listener(self._update_samples)
+        # Initialize in-memory history, sized from sample rates
+        self._history = HistoryStore({'temp': self._read_temp_wait_sec,
+                                      'humidity': self._read_humidity_wait_sec,
+                                      'press': self._read_press_wait_sec},
+                                     retention_sec=self._history_sec)
+        self._scheduler.add_batch_listener(self._history.append)
 
     ####################################################################
 
     def run(self):
         """
-        Run application, which starts all initialized threads.
+        Run application, which starts all initialized threads. Returns
+        right away, the first snapshot is published once the sampling
+        thread has read the sensors.
         """
         self._screen_thread_obj.start()
         self._joystick_thread_obj.start()
-        self._temp_thread_obj.start()
-        self._humidity_thread_obj.start()
-        self._press_thread_obj.start()
+        self._scheduler_thread_obj.start()
         if hasattr(self, '_influxdb_thread_obj'): self._influxdb_thread_obj.start() # only start this thread if it was initialized
+        if hasattr(self, '_config_thread_obj'): self._config_thread_obj.start() # only start this thread if it was initialized
+
+    def stop(self, timeout_sec=10.0):
+        """
+        Stop application: signal every thread, flush samples held back by
+        export compression, let the InfluxDB writer send (or spill) what
+        is queued, and sync the spool. Waits up to timeout_sec in total.
+        Anything not written in time is still in the spool and is sent
+        after the next start. Returns True if every thread stopped in
+        time.
+        :param timeout_sec: Time allowed for stopping, in seconds.
+        """
+        deadline = monotonic() + timeout_sec
+        self._stop_event.set() # screen and sampling threads
+        self._scheduler.stop()
+        if hasattr(self, '_config_watcher'): self._config_watcher.stop()
+        if hasattr(self._sense_hat.stick, 'close'): self._sense_hat.stick.close() # the real joystick can't be woken, its thread is a daemon
+        stopped = True
+        for thread in (self._scheduler_thread_obj, self._screen_thread_obj):
+            stopped = self._join_thread(thread, deadline) and stopped
+        if hasattr(self, '_influxdb_writer'):
+            with self._export_lock:
+                for point_time, fields in self._compressor.flush():
+                    self._queue_influxdb_point(point_time, fields, self._export_ack)
+            self._influxdb_writer.stop()
+            if self._join_thread(self._influxdb_thread_obj, deadline):
+                # Every point has been written or spilled, so the last batch is done with even if the
+                # compressor kept nothing from it
+                if self._export_ack is not None and not self._influxdb_writer.queue_depth(): self._spool.ack(self._export_ack)
+            else:
+                stopped = False
+        if stopped:
+            self._spool.close()
+        else:
+            self._spool.sync() # a thread may still be writing or acking
+        self._sense_hat.clear()
+        log.info('PiEnviro stopped%s', '' if stopped else ' (some threads did not stop in time)')
+        return stopped
+
+    @staticmethod
+    def _join_thread(thread, deadline):
+        """
+        Join thread (if started) until deadline (monotonic time). Returns
+        True if it stopped.
+        """
+        if thread.ident is None:
+            return True
+        thread.join(max(0.0, deadline - monotonic()))
+        if thread.is_alive():
+            log.warning('Thread %s did not stop in time!', thread.name)
+            return False
+        return True
+
+    ####################################################################
+
+    def _init_config_thread(self, config_file, start_thread=False):
+        """
+        Initialize config file watcher thread and return it.
+        :param config_file: String containing PiEnviro config filename.
+        :param start_thread: If True will also start thread.
+        """
+        self._config_watcher = ConfigWatcher(config_file, self.apply_config)
+        config_thread = Thread(target=self._config_watcher.run, name='config', daemon=True)
+        if start_thread: config_thread.start()
+        return config_thread
+
+    def get_config(self):
+        """
+        Get config last applied (see config.py). Options that need a
+        restart may not be in effect yet.
+        """
+        return self._config
+
+    def apply_config(self, config):
+        """
+        Apply validated config to the running application. Live options
+        are swapped in place, so no thread is restarted and no queued or
+        spooled sample is lost. Options that need a restart are logged
+        and left as they are.
+        :param config: Validated config dict (see config.load_config).
+        """
+        changed = changed_options(self._config, config)
+        restart = [path for path, live in changed if not live]
+        if restart: log.warning('Config options %s changed, restart to apply', ', '.join(restart))
+        changed = set(path for path, live in changed if live)
+        if not changed:
+            return
+        sampling = config['sampling']
+        # Sampling: intervals take effect after each channel's next read (history is resized to keep history_sec),
+        # new filters start from the next reading
+        for channel, interval_sec in sampling['intervals'].items():
+            if 'sampling.intervals.' + channel in changed:
+                self._scheduler.set_interval(channel, interval_sec)
+                self._history.set_interval(channel, interval_sec)
+        if any(path.startswith('sampling.filters.') for path in changed):
+            filters = create_filters(sampling['filters'])
+            with self._scheduler.bus_lock: # don't swap filters mid-read
+                self._filters = filters
+        self._temp_correction_alpha = sampling['temp_correction_alpha']
+        # Sinks: batching changes keep queued points, the old compressor hands over what it held back
+        if hasattr(self, '_influxdb_writer'):
+            influxdb = config['sinks']['influxdb']
+            self._influxdb_writer.configure(batch_size=influxdb['batch_size'], flush_sec=influxdb['flush_sec'], max_queue=influxdb['max_queue'])
+            if any(path.startswith('sinks.compression.') for path in changed):
+                compressor = SampleCompressor(config['sinks']['compression'])
+                with self._export_lock:
+                    for point_time, fields in self._compressor.flush():
+                        self._queue_influxdb_point(point_time, fields, self._export_ack)
+                    self._compressor = compressor
+        self._archive.retention_sec = config['sinks']['archive']['retention_sec']
+        # Display: picked up by the screen thread on its next message. Only changed options are applied, so
+        # unrelated reloads don't undo joystick changes
+        display = config['display']
+        if 'display.rotation' in changed: self._screen_rotation = display['rotation']
+        if 'display.speed_index' in changed:
+            self._screen_speed_index = display['speed_index']
+            self._screen_speed = self.scroll_speeds[self._screen_speed_index]
+        if 'display.text_color' in changed:
+            self._screen_text_color_index = display['text_color']
+            self._screen_text_color = self.colors[self._screen_text_color_index]
+        if 'display.background_color' in changed: self._screen_background_color = self.colors[display['background_color']]
+        if 'display.low_light' in changed: self._sense_hat.low_light = display['low_light']
+        if 'logging.level' in changed: getLogger().setLevel(config['logging']['level'])
+        self._config = config
+        log.info('Applied config changes: %s', ', '.join(sorted(changed)))
 
     ####################################################################
 
@@ -118,32 +317,39 @@ class PiEnviro(object):
         Initialize screen update thread and return it.
         :param start_thread: If True will also start thread.
         """
-        screen_thread = Thread(target=self._screen_thread)
+        screen_thread = Thread(target=self._screen_thread, name='screen', daemon=True)
         if start_thread: screen_thread.start()
         return screen_thread
 
     def _screen_thread(self):
         """
-        Screen update thread loop.
+        Screen update thread loop, runs until stop() is called.
         """
-        while True:
+        while not self._stop_event.is_set():
             self._update_screen_message()
-            self._sense_hat.show_message(self._screen_message, self._screen_speed, self._screen_text_color, self._screen_background_color)
+            frames = self._screen_renderer.render(self._screen_message, self._screen_text_color, self._screen_background_color, self._screen_rotation)
+            self._screen_renderer.play(frames, self._screen_speed, self._sense_hat.set_pixels, self._stop_event)
 
     def _update_screen_message(self):
         """
         Generate and save screen message.
         """
-        self._screen_message = self._generate_screen_message()
-        print('Screen message updated to "{}"'.format(self._screen_message))
+        screen_message = self._generate_screen_message()
+        if screen_message != self._screen_message:
+            self._screen_message = screen_message
+            log.info('Screen message updated to "%s"', self._screen_message)
 
     def _generate_screen_message(self):
         """
         Generate and return screen message.
         """
-        #FIXME screen_message = 'Temp: {:.1f}, Humidity: {:.1f}, Press: {:.2f}'.format(self.curr_temp.to('degF'), self.curr_humidity, self.curr_press.to('inHg'))
-        #FIXME screen_message = screen_message.replace('_', '') # strip '_' from 'in_Hg' -- this can be removed if pint updates to output string as 'inHg' instead of inserting the extra '_'
-        screen_message = 'Temp: {:.1f} degF, Humidity: {:.1f} %, Press: {:.2f} inHg'.format(self.curr_temp, self.curr_humidity, self.curr_press)
+        snapshot = self._snapshot # use one snapshot so all values are from the same update
+        if not snapshot.version:
+            return 'Warming up...'
+        convert = self._display_conversions
+        screen_message = 'Temp: {:.1f} {}, Humidity: {:.1f} {}, Press: {:.2f} {}'.format(convert['temp'](snapshot.temp), display_units['temp'],
+                                                                                        convert['humidity'](snapshot.humidity), display_units['humidity'],
+                                                                                        convert['press'](snapshot.press), display_units['press'])
         return screen_message
 
     ####################################################################
@@ -159,7 +365,7 @@ class PiEnviro(object):
         except IndexError: # loop
             self._screen_text_color_index = 0
             self._screen_text_color = self.colors[self._screen_text_color_index]
-        print('Screen color changed to {}'.format(self._screen_text_color))
+        log.info('Screen color changed to %s', self._screen_text_color)
         self._sense_hat.clear(self._screen_text_color) # flash current color for feedback (scrolling text will overwrite it immediately)
 
     def dec_screen_color(self):
@@ -173,7 +379,7 @@ class PiEnviro(object):
         except IndexError: # loop
             self._screen_text_color_index = len(self.colors) - 1 # max
             self._screen_text_color = self.colors[self._screen_text_color_index]
-        print('Screen color changed to {}'.format(self._screen_text_color))
+        log.info('Screen color changed to %s', self._screen_text_color)
         self._sense_hat.clear(self._screen_text_color) # flash current color for feedback (scrolling text will overwrite it immediately)
 
     def inc_screen_speed(self):
@@ -187,7 +393,7 @@ class PiEnviro(object):
         except IndexError: # loop
             self._screen_speed_index = len(self.scroll_speeds) - 1 # max
             self._screen_speed = self.scroll_speeds[self._screen_speed_index]
-        print('Screen speed changed to {}'.format(self._screen_speed))
+        log.info('Screen speed changed to %s', self._screen_speed)
         self._sense_hat.clear(self._screen_text_color) # flash current color for feedback (scrolling text will overwrite it immediately)
 
     def dec_screen_speed(self):
@@ -201,7 +407,7 @@ class PiEnviro(object):
         except IndexError: # loop
             self._screen_speed_index = 0
             self._screen_speed = self.scroll_speeds[self._screen_speed_index]
-        print('Screen speed changed to {}'.format(self._screen_speed))
+        log.info('Screen speed changed to %s', self._screen_speed)
         self._sense_hat.clear(self._screen_text_color) # flash current color for feedback (scrolling text will overwrite it immediately)
 
     def _init_joystick_thread(self, start_thread=False):
@@ -209,7 +415,7 @@ class PiEnviro(object):
         Initialize joystick input thread and return it.
         :param start_thread: If True will also start thread.
         """
-        joystick_thread = Thread(target=self._joystick_thread)
+        joystick_thread = Thread(target=self._joystick_thread, name='joystick', daemon=True)
         if start_thread: joystick_thread.start()
         return joystick_thread
 
@@ -224,7 +430,8 @@ class PiEnviro(object):
         """
         while True:
             event = self._sense_hat.stick.wait_for_event()
-            print('Detected joystick event: {} was {} at {}'.format(event.action, event.direction, event.timestamp))
+            if event is None: return # joystick closed (simulated backends only)
+            log.debug('Detected joystick event: %s was %s at %s', event.action, event.direction, event.timestamp)
             if event.action == "pressed":
                 if event.direction == "up": # TODO: handle correct joystick orientation per self._screen_rotation
                     self.inc_screen_color()
@@ -235,214 +442,380 @@ class PiEnviro(object):
                 elif event.direction == "right":
                     self.dec_screen_speed()
                 else:
-                    print('Unrecognized direction!')
+                    log.warning('Unrecognized direction!')
             else:
-                print('Ignoring event ...')
+                log.debug('Ignoring event ...')
 
     ####################################################################
 
-    def get_temp(self, force_update=False):
+    def _init_scheduler_thread(self, start_thread=False):
         """
-        Get current temperature reading, in degF.
-        :param force_update: Force update before return.
+        Initialize sampling thread and return it.
+        :param start_thread: If True will also start thread.
         """
-        if force_update: self._update_temp()
-        return self.curr_temp #FIXME self.curr_temp.to('degF').magnitude # return as float using units degF
+        scheduler_thread = Thread(target=self._sampling_thread, name='sampling', daemon=True)
+        if start_thread: scheduler_thread.start()
+        return scheduler_thread
 
-    def _init_temp_thread(self, start_thread=False):
+    def _sampling_thread(self):
         """
-        Initialize temperature update thread and return it.
-        :param start_thread: If True will also start thread.
+        Sampling thread: publishes first readings, restores history from
+        the spool, saves the first readings (history, spool, archive and
+        export, after the replayed samples so they stay in order), then
+        runs the scheduler until stop() is called. Until the first
+        readings are in, the API answers 'warming up'.
         """
-        temp_thread = Thread(target=self._temp_thread)
-        if start_thread: temp_thread.start()
-        return temp_thread
+        timestamp, samples = self._scheduler.read_first()
+        if samples:
+            self._update_samples(timestamp, samples)
+            startup_time.labels('first_snapshot').set(monotonic() - self._started)
+            log.info('First readings after %.2f s', monotonic() - self._started)
+        self._replay_spool()
+        startup_time.labels('spool_replay').set(monotonic() - self._started)
+        if samples: self._scheduler.notify(timestamp, samples, skip=(self._update_samples,))
+        if not self._stop_event.is_set():
+            self._scheduler.run()
 
-    def _temp_thread(self):
+    def _update_samples(self, timestamp, samples):
         """
-        Temperature update thread loop.
+        Save batch of samples read by the scheduler on the same tick.
+        :param timestamp: Time the batch was read, in seconds since epoch.
+        :param samples: Dict of channel name to value.
         """
-        while True:
-            self._update_temp()
-            sleep(self._read_temp_wait_sec)
+        self._publish_samples(timestamp, samples)
+
+    def _publish_samples(self, timestamp, samples):
+        """
+        Publish new snapshot containing samples. The snapshot is swapped
+        in with a single assignment, so readers never see a partial
+        update.
+        :param timestamp: Time the samples were read, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        """
+        with self._snapshot_lock:
+            snapshot = self._snapshot.update(timestamp, samples)
+            self._snapshot = snapshot
+        for listener in self._snapshot_listeners:
+            listener(snapshot)
+        if 'temp' in samples: log.debug('Updated current temperature to %.1f %s', self._display_conversions['temp'](snapshot.temp), display_units['temp'])
+        if 'humidity' in samples: log.debug('Updated current humidity to %.1f %s', self._display_conversions['humidity'](snapshot.humidity), display_units['humidity'])
+        if 'press' in samples: log.debug('Updated current pressure to %.2f %s', self._display_conversions['press'](snapshot.press), display_units['press'])
+
+    def add_snapshot_listener(self, listener):
+        """
+        Register function to be called with each new snapshot, after it
+        is published (e.g. to push it to live stream subscribers).
+        """
+        self._snapshot_listeners.append(listener)
+
+    def get_snapshot(self):
+        """
+        Get current snapshot of all environment readings. Values in one
+        snapshot are always from the same update.
+        """
+        return self._snapshot
+
+    @property
+    def curr_temp(self):
+        """
+        Current temperature reading, in K.
+        """
+        return self._snapshot.temp
+
+    @property
+    def curr_humidity(self):
+        """
+        Current humidity reading, in %.
+        """
+        return self._snapshot.humidity
+
+    @property
+    def curr_press(self):
+        """
+        Current pressure reading, in Pa.
+        """
+        return self._snapshot.press
+
+    def get_history(self, channel, since=None, until=None, step=None, unit=None):
+        """
+        Get sample history for channel. If step is passed returns list
+        of (bucket_time, min, max, mean, count) tuples, otherwise list of
+        (timestamp, value) tuples.
+        :param channel: Channel name ('temp', 'humidity' or 'press').
+        :param since: Earliest sample time, in seconds since epoch.
+        :param until: Latest sample time, in seconds since epoch.
+        :param step: Bucket width, in seconds, to downsample to.
+        :param unit: Unit to return values in. Defaults to the channel's
+        canonical unit.
+        """
+        samples = self._history.query(channel, since, until, step)
+        if unit is None:
+            return samples
+        convert = get_conversion(canonical_units[channel], unit) # affine with positive scale, so min/max/mean convert directly
+        if step:
+            return [(t, convert(low), convert(high), convert(mean), count) for t, low, high, mean, count in samples]
+        return [(t, convert(value)) for t, value in samples]
+
+    def get_sampling_stats(self):
+        """
+        Get sampling scheduler timing stats (jitter, missed deadlines).
+        """
+        return self._scheduler.get_stats()
+
+    ####################################################################
+
+    def get_temp(self, force_update=False, unit='degF'):
+        """
+        Get current temperature reading.
+        :param force_update: Force update before return.
+        :param unit: Unit to return reading in.
+        """
+        if force_update: self._update_temp()
+        return get_conversion(canonical_units['temp'], unit)(self.curr_temp)
 
     def _update_temp(self):
         """
         Query and save current temperature.
         """
-        self.curr_temp = self._read_temp()
-        #FIXME print('Updated current temperature to {:.1f}'.format(self.curr_temp.to('degF')))
-        print('Updated current temperature to {:.1f}'.format(self.curr_temp))
+        with self._scheduler.bus_lock:
+            temp = self._read_temp()
+        self._publish_samples(time(), {'temp': temp})
 
-    def _read_temp(self, calibrate_temp=False): # FIXME: Calibrate should default to True
+    def _read_temp(self, calibrate_temp=True):
         """
-        Query and return current temperature.
+        Query and return current temperature (filtered burst of readings).
         :param calibrate_temp: If True will also query CPU temperature
         and use this to return calibrated temperature, not raw sensor
-        temperature.
+        temperature. The correction is smoothed (EMA) so CPU load spikes
+        don't show up as temperature spikes. Falls back to raw sensor
+        temperature if the backend has no CPU temperature.
         """
-        raw_temp = self._sense_hat.get_temperature() * 1.8 + 32 #FIXME self._ureg.Quantity(self._sense_hat.get_temperature(), 'degC')
+        raw_temp = self._sensor_conversions['temp'](self._filters['temp'].read(self._sense_hat.get_temperature))
         if calibrate_temp:
-            return raw_temp - ((self._read_cpu_temp() - raw_temp) / 1.556) # https://github.com/initialstate/wunderground-sensehat/wiki/Part-3.-Sense-HAT-Temperature-Correction
-        else:
-            return raw_temp
+            cpu_temp = self._read_cpu_temp()
+            if cpu_temp is not None:
+                correction = (cpu_temp - raw_temp) / 1.556 # https://github.com/initialstate/wunderground-sensehat/wiki/Part-3.-Sense-HAT-Temperature-Correction
+                if self._temp_correction is None:
+                    self._temp_correction = correction
+                else:
+                    self._temp_correction += self._temp_correction_alpha * (correction - self._temp_correction)
+                return raw_temp - self._temp_correction
+        return raw_temp
 
     def _read_cpu_temp(self):
         """
-        Query and return current CPU temperature.
+        Query and return current CPU temperature from the backend, or None
+        if it is not available.
         """
-        rtn_str = popen('vcgencmd measure_temp').readline() # rtn in the format of: temp=41.7'C
-        rtn_float = float(rtn_str.replace("temp=","").replace("'C\n","")) # rtn in the format of: 41.7
-        return rtn_float * 1.8 + 32 #FIXME self._ureg.Quantity(rtn_float, 'degC')
+        return self._sensor_conversions['temp'](self._sense_hat.get_cpu_temperature()) # backend returns degC
 
     ####################################################################
 
-    def get_humidity(self, force_update=False):
+    def get_humidity(self, force_update=False, unit='%'):
         """
-        Get current humidity reading, in %.
+        Get current humidity reading.
         :param force_update: Force update before return.
+        :param unit: Unit to return reading in.
         """
         if force_update: self._update_humidity()
-        return self.curr_humidity #FIXME self.curr_humidity.magnitude # return as flaot
-
-    def _init_humidity_thread(self, start_thread=False):
-        """
-        Initialize humidity update thread and return it.
-        :param start_thread: If True will also start thread.
-        """
-        humidity_thread = Thread(target=self._humidity_thread)
-        if start_thread: humidity_thread.start()
-        return humidity_thread
-
-    def _humidity_thread(self):
-        """
-        Humidity update thread loop.
-        """
-        while True:
-            self._update_humidity()
-            sleep(self._read_humidity_wait_sec)
+        return get_conversion(canonical_units['humidity'], unit)(self.curr_humidity)
 
     def _update_humidity(self):
         """
         Query and save current humidity.
         """
-        self.curr_humidity = self._read_humidity()
-        print('Updated current humidity to {:.1f}'.format(self.curr_humidity))
+        with self._scheduler.bus_lock:
+            humidity = self._read_humidity()
+        self._publish_samples(time(), {'humidity': humidity})
 
     def _read_humidity(self):
         """
-        Query and return current humidity.
+        Query and return current humidity (filtered burst of readings).
         """
-        return self._sense_hat.get_humidity() # FIXME self._ureg.Quantity(self._sense_hat.get_humidity(), 'pct')
+        return self._sensor_conversions['humidity'](self._filters['humidity'].read(self._sense_hat.get_humidity))
 
     ####################################################################
 
-    def get_press(self, force_update=False):
+    def get_press(self, force_update=False, unit='inHg'):
         """
-        Get current pressure reading, in inHg.
+        Get current pressure reading.
         :param force_update: Force update before return.
+        :param unit: Unit to return reading in.
         """
         if force_update: self._update_press()
-        return self.curr_press #FIXME self.curr_press.to('inHg').magnitude # return as float using units inHg
-
-    def _init_press_thread(self, start_thread=False):
-        """
-        Initialize pressure update thread and return it.
-        :param start_thread: If True will also start thread.
-        """
-        press_thread = Thread(target=self._press_thread)
-        if start_thread: press_thread.start()
-        return press_thread
-
-    def _press_thread(self):
-        """
-        Pressure update thread loop.
-        """
-        while True:
-            self._update_press()
-            sleep(self._read_press_wait_sec)
+        return get_conversion(canonical_units['press'], unit)(self.curr_press)
 
     def _update_press(self):
         """
         Query and save current pressure.
         """
-        self.curr_press = self._read_press()
-        #FIXME print('Updated current pressure to {:.2f}'.format(self.curr_press.to('inHg')))
-        print('Updated current pressure to {:.2f}'.format(self.curr_press))
+        with self._scheduler.bus_lock:
+            press = self._read_press()
+        self._publish_samples(time(), {'press': press})
 
     def _read_press(self):
         """
-        Query and return current pressure.
+        Query and return current pressure (filtered burst of readings).
         """
-        return self._sense_hat.get_pressure() * 0.02953 # FIXME self._ureg.Quantity(self._sense_hat.get_pressure(), 'mbar')
+        return self._sensor_conversions['press'](self._filters['press'].read(self._sense_hat.get_pressure))
 
     ####################################################################
 
-    def generate_influxdb_post_url(self, influxdb_config):
-        '''
-        Read config file to generate and return InfluxDB POST URL.
-        :param influxdb_config: String containing InfluxDB config
-        filename, which should be located in /scripts directory.
-        '''
-        post_url=''
-        # FIXME try:
-        # FIXME     with open(join(dirname(__file__), influxdb_config)) as config_file:
-        # FIXME         config = load(config_file) # expected: url, db -- optional: username, password
-        # FIXME         if 'username' in config and 'password' in config:
-        # FIXME             post_url = '{url}/write?db={db}&u={username}&p={password}'.format(url=config['url'], db=config['db'], username=config['username'], password=config['password'])
-        # FIXME         else: # no credentials needed
-        # FIXME             post_url = '{url}/write?db={db}'.format(url=config['url'], db=config['db'])
-        # FIXME except (IOError, YAMLError) as err:
-        # FIXME     print('Could not create InfluxDB post url path, invalid config file ({})!'.format(influxdb_config))
-        # FIXME print('Generated InfluxDB post url: {}'.format(post_url))
-        return post_url
-
     def _init_influxdb_thread(self, influxdb_config, start_thread=False):
         """
-        Initialize InfluxDB update thread and return it.
+        Initialize InfluxDB writer and its update thread and return the
+        thread. Sample batches are compressed (see _export_samples) and
+        the points that are kept are sent in large batches.
         :param influxdb_config: String containing InfluxDB config
-        filename, which should be located in /scripts directory.
+        filename, which should be located in /scripts directory. Raises
+        ValueError if it is invalid.
         :param start_thread: If True will also start thread.
         """
-        influxdb_thread = Thread(target=self._influxdb_thread, args=[influxdb_config])
+        self._influxdb_writer = InfluxDBWriter.from_config(influxdb_config, flush_sec=self._post_influxdb_wait_sec, batch_size=self._post_influxdb_batch_size,
+                                                           max_queue=self._post_influxdb_max_queue, ack_callback=self._ack_spooled)
+        self._influxdb_measurement = None # set by _get_influxdb_measurement, off the startup path
+        self._influxdb_measurement_lock = Lock()
+        self._compressor = SampleCompressor(self._compression_config)
+        self._export_lock = Lock() # held while a batch is compressed, so the compressor can be swapped
+        self._export_ack = None # spool token of the previous batch
+        influxdb_thread = Thread(target=self._influxdb_thread, name='influxdb', daemon=True)
         if start_thread: influxdb_thread.start()
         return influxdb_thread
 
-    def _influxdb_thread(self, influxdb_config):
+    def _influxdb_thread(self):
         """
-        InfluxDB update thread loop.
-        :param influxdb_config: String containing InfluxDB config
-        filename, which should be located in /scripts directory.
+        Thread for writing to InfluxDB. Looks up the measurement name
+        first, since that queries the network interfaces.
+        """
+        self._get_influxdb_measurement()
+        self._influxdb_writer.run()
+
+    def _get_influxdb_measurement(self):
+        """
+        Return InfluxDB measurement name, which includes the IP address.
+        Only generated once, by whichever thread needs it first.
+        """
+        if self._influxdb_measurement is None:
+            with self._influxdb_measurement_lock:
+                if self._influxdb_measurement is None: self._influxdb_measurement = 'env_data[{}]'.format(self._get_ipaddr())
+        return self._influxdb_measurement
+
+    def _queue_influxdb_point(self, timestamp, samples, ack=None):
+        """
+        Queue batch of samples to be written to InfluxDB "env_data"
+        series, in display units (degF, %, inHg) as the dashboard expects.
+        :param timestamp: Time the samples were read, in seconds since epoch.
+        :param samples: Dict of channel name to value, in canonical units.
+        :param ack: Spool token to ack once the point is written.
+        """
+        fields = dict((channel, self._display_conversions[channel](value)) for channel, value in samples.items())
+        self._influxdb_writer.write(format_line(self._get_influxdb_measurement(), fields, timestamp), ack)
+
+    ####################################################################
+
+    def _init_archive(self):
+        """
+        Initialize long-term columnar archive (see archive.py), which
+        /export streams from.
+        """
+        self._archive = SampleArchive(self._archive_dir, Snapshot.channels, chunk_sec=self._archive_chunk_sec, retention_sec=self._archive_retention_sec)
+
+    def get_archive(self, since=None, until=None):
+        """
+        Get iterator of archived (timestamp, samples) rows, oldest first,
+        in canonical units.
+        :param since: Skip samples older than this, in seconds since
+        epoch.
+        :param until: Stop at samples this new or newer, in seconds since
+        epoch.
+        """
+        return self._archive.rows(since, until)
+
+    def _init_spool(self):
+        """
+        Initialize write-ahead spool that every sample is appended to.
+        It is replayed by the sampling thread (see _replay_spool).
+        """
+        self._spool = SampleSpool(self._spool_dir, Snapshot.channels, retention_sec=self._history_sec)
+        self._scheduler.add_batch_listener(self._archive.append)
+        self._scheduler.add_batch_listener(self._spool_samples)
+
+    def _replay_spool(self):
+        """
+        Restore in-memory history and the archive's current chunk from
+        the spool, and queue samples that were not written to InfluxDB
+        before the last shutdown. Runs before the scheduler starts, so
+        replayed samples stay in order with new ones.
+        """
+        for timestamp, samples in self._spool.replay(since=time() - self._history_sec):
+            self._history.append(timestamp, samples)
+            self._archive.append(timestamp, samples) # skips chunks already written
+        if hasattr(self, '_influxdb_writer'):
+            for ack, timestamp, samples in self._spool.pending():
+                self._export_samples(timestamp, samples, ack)
+
+    def _spool_samples(self, timestamp, samples):
+        """
+        Append batch of samples to spool, then hand it to the InfluxDB
+        export, which acks it once written. Acked right away if there
+        is no InfluxDB writer.
+        :param timestamp: Time the samples were read, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        """
+        ack = self._spool.append(timestamp, samples)
+        if hasattr(self, '_influxdb_writer'):
+            self._export_samples(timestamp, samples, ack)
+        else:
+            self._spool.ack(ack)
+
+    def _export_samples(self, timestamp, samples, ack):
+        """
+        Pass batch of samples through export compression, and queue the
+        points that are kept. Points are acked with the spool token of
+        the previous batch, since the compressor may still be holding
+        back samples from this one.
+        :param timestamp: Time the samples were read, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        :param ack: Spool token of this batch.
+        """
+        with self._export_lock:
+            for point_time, fields in self._compressor.add(timestamp, samples):
+                self._queue_influxdb_point(point_time, fields, self._export_ack)
+            self._export_ack = ack
+
+    def _ack_spooled(self, ack):
+        """
+        Mark spooled samples up to ack token as written downstream.
         """
-        pass #FIXME 
-        # FIXME post_url = self.generate_influxdb_post_url(influxdb_config) # only need to generate this once
-        #FIXME while True:
-        #FIXME     try:
-        #FIXME         post_data = 'env_data[{}] temp={},humidity={},press={}'.format(self._get_ipaddr(), self.get_temp(), self.get_humidity(), self.get_press())
-        #FIXME         post_resp = post(post_url, data=post_data)
-        #FIXME     except (ConnectionError, MissingSchema):
-        #FIXME         print('{} Failed to post InfluxDB update to "env_data" series!'.format(str(datetime.now())))
-        #FIXME     sleep(self._post_influxdb_wait_sec)
+        self._spool.ack(ack)
 
     def _get_ipaddr(self):
         """
         Query and return current IP address.
         """
+        from netifaces import ifaddresses, AF_INET # imported here, only needed once for InfluxDB export
         # prefer ethernet ip_addr (if available)
         try:
             return ifaddresses('eth0')[AF_INET][0]['addr'] # physical ethernet cable
         except KeyError:
-            print('Unable to determine ip_addr from ethernet connection')
+            log.info('Unable to determine ip_addr from ethernet connection')
         # use wifi ip_addr if no ethernet
         try:
             return ifaddresses('wlan0')[AF_INET][0]['addr'] # wifi connection
         except KeyError:
-            print('Unable to determine ip_addr from WiFi connection')
+            log.warning('Unable to determine ip_addr from WiFi connection')
         # no connection
         return ''
 
 
 if __name__ == '__main__':
-    pi = PiEnviro()
+    config_file = environ.get('PIENVIRO_CONFIG', 'pienviro.yml')
+    setup_logging(environ.get('PIENVIRO_LOG_LEVEL', load_config(config_file)['logging']['level']))
+    pi = PiEnviro(config_file=config_file)
     pi.run()
-    print('*** PiEnviro initialized! ***')
+    log.info('*** PiEnviro initialized! ***')
+    stopping = Event()
+    signal(SIGTERM, lambda signum, frame: stopping.set()) # e.g. docker stop
+    signal(SIGINT, lambda signum, frame: stopping.set())
+    stopping.wait()
+    pi.stop()
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+from collections import namedtuple
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from json import dumps
+from time import time
+from urllib.parse import parse_qs
+
+from metrics import Histogram
+from units import canonical_units, display_units, get_conversion, resolve_units
+
+request_latency = Histogram('pienviro_http_request_seconds', 'Time taken to answer each API request.', ('route',))
+
+boot_id = '{:x}'.format(int(time() * 1000)) # process start time, so ETags (and event ids) from before a restart never match
+
+
+class CachedResponse(namedtuple('CachedResponse', ['body', 'content_type', 'etag', 'last_modified', 'last_modified_ts', 'raw_ok', 'raw_not_modified', 'status'])):
+    """
+    Pre-serialized response for one snapshot version. raw_ok and
+    raw_not_modified are complete HTTP/1.1 keep-alive responses, so an
+    async server can send them with a single write. status is 200,
+    except for the 503 'warming up' response sent before the first
+    snapshot (see unavailable).
+    """
+
+    __slots__ = ()
+
+    def is_not_modified(self, if_none_match=None, if_modified_since=None):
+        """
+        Return True if request conditional headers show the client
+        already has this version.
+        :param if_none_match: If-None-Match header value.
+        :param if_modified_since: If-Modified-Since header value.
+        """
+        if self.status != 200:
+            return False
+        if if_none_match:
+            return if_none_match.strip() == '*' or self.etag in [tag.strip() for tag in if_none_match.split(',')]
+        if if_modified_since and self.last_modified_ts is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and int(self.last_modified_ts) <= mktime_tz(since)
+        return False
+
+    @property
+    def headers(self):
+        """
+        Caching headers, as a dict.
+        """
+        if self.status != 200:
+            return {'Retry-After': '1', 'Cache-Control': 'no-store'}
+        headers = {'ETag': self.etag}
+        if self.last_modified: headers['Last-Modified'] = self.last_modified
+        return headers
+
+    @classmethod
+    def build(cls, body, content_type, version, last_modified_ts):
+        """
+        Return CachedResponse for body.
+        :param body: Response body, as bytes.
+        :param content_type: Content-Type header value.
+        :param version: Snapshot version (and representation, e.g.
+        units), used with the boot id as ETag.
+        :param last_modified_ts: Time the data was read, in seconds since
+        epoch (or None).
+        """
+        etag = '"{}.{}"'.format(boot_id, version)
+        last_modified = formatdate(last_modified_ts, usegmt=True) if last_modified_ts is not None else None
+        head = 'ETag: {}\r\n'.format(etag)
+        if last_modified: head += 'Last-Modified: {}\r\n'.format(last_modified)
+        raw_ok = 'HTTP/1.1 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}\r\n'.format(content_type, len(body), head).encode('latin-1') + body
+        raw_not_modified = 'HTTP/1.1 304 Not Modified\r\n{}\r\n'.format(head).encode('latin-1')
+        return cls(body, content_type, etag, last_modified, last_modified_ts, raw_ok, raw_not_modified, 200)
+
+    @classmethod
+    def unavailable(cls, message):
+        """
+        Return 503 plain text response, asking the client to retry in a
+        second.
+        :param message: Response body, as str.
+        """
+        body = message.encode('utf-8')
+        raw = 'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {}\r\nRetry-After: 1\r\nCache-Control: no-store\r\n\r\n'\
+            .format(len(body)).encode('latin-1') + body
+        return cls(body, 'text/plain; charset=utf-8', None, None, None, raw, raw, 503)
+
+
+class ResponseCache(object):
+    """
+    Pre-serialized responses for the snapshot routes (/temp, /humidity,
+    /press and /env). Each response is encoded once per snapshot version
+    (and set of requested units, e.g. '?unit=degC&unit=hPa') and reused
+    for every request until the next update.
+    """
+
+    text_type = 'text/html; charset=utf-8' # what Flask uses for str responses
+    json_type = 'application/json'
+    warming_up = CachedResponse.unavailable('Warming up, no readings yet')
+
+    def __init__(self, get_snapshot):
+        """
+        Constructor.
+        :param get_snapshot: Function returning the current Snapshot.
+        """
+        self._get_snapshot = get_snapshot
+        self._routes = {'/temp': self._channel_response('temp'),
+                        '/humidity': self._channel_response('humidity'),
+                        '/press': self._channel_response('press'),
+                        '/env': self._env_response}
+        self._route_channels = {'/temp': ('temp',), '/humidity': ('humidity',), '/press': ('press',), '/env': tuple(canonical_units)}
+        self._cache = {} # (path, units) -> (version, CachedResponse)
+        self._query_units = {} # (path, query string) -> units, so repeated queries aren't parsed again
+
+    def __contains__(self, path):
+        return path in self._routes
+
+    def get(self, path, query=''):
+        """
+        Return CachedResponse for path at current snapshot version (503
+        'warming up' before the first snapshot), or None if path is not a
+        snapshot route. Raises ValueError if query asks for an unknown
+        unit.
+        :param path: Request path.
+        :param query: Request query string, may hold 'unit' parameters.
+        """
+        build = self._routes.get(path)
+        if build is None:
+            return None
+        units = self._units(path, query)
+        snapshot = self._get_snapshot()
+        if not snapshot.version:
+            return self.warming_up
+        cached = self._cache.get((path, units))
+        if cached is None or cached[0] != snapshot.version:
+            cached = (snapshot.version, build(snapshot, dict(units)))
+            self._cache[(path, units)] = cached # single assignment, safe to race
+        return cached[1]
+
+    def _units(self, path, query):
+        """
+        Return (channel, unit) tuples of path's channels, in the units
+        requested in query.
+        """
+        units = self._query_units.get((path, query))
+        if units is None:
+            units = tuple(sorted(resolve_units(parse_qs(query).get('unit', []), self._route_channels[path]).items()))
+            if len(self._query_units) >= 256: self._query_units.clear() # bound memory if queries carry other junk
+            self._query_units[(path, query)] = units
+        return units
+
+    @staticmethod
+    def _version(snapshot, units):
+        """
+        Return ETag version for snapshot in units. Each unit choice is a
+        different representation, so it gets its own ETag.
+        """
+        if all(unit == display_units[channel] for channel, unit in units.items()):
+            return snapshot.version
+        return '{}-{}'.format(snapshot.version, '-'.join(units[channel] for channel in sorted(units)).replace('%', 'pct'))
+
+    def _channel_response(self, channel):
+        """
+        Return builder for single channel plain text response.
+        """
+        def build(snapshot, units):
+            value = get_conversion(canonical_units[channel], units[channel])(getattr(snapshot, channel))
+            return CachedResponse.build(str(value).encode('utf-8'), self.text_type,
+                                        self._version(snapshot, units), getattr(snapshot, channel + '_time'))
+        return build
+
+    def _env_response(self, snapshot, units):
+        """
+        Return all channel JSON response, with the unit of each channel.
+        """
+        env = snapshot.to_dict()
+        for channel, unit in units.items():
+            env[channel] = get_conversion(canonical_units[channel], unit)(env[channel])
+        env['units'] = units
+        times = [t for t in (snapshot.temp_time, snapshot.humidity_time, snapshot.press_time) if t is not None]
+        return CachedResponse.build(dumps(env, sort_keys=True).encode('utf-8'), self.json_type,
+                                    self._version(snapshot, units), max(times) if times else None)
@@ -1,11 +1,184 @@
 #!/usr/bin/python
-from flask import Flask
-from pi_enviro import PiEnviro
+from archive import export_formats, export_lines
+from async_api import AsyncApiServer
+from backends import create_backend
+from beacon import BeaconScanner
+from config import load_config
+from flask import Flask, Response, abort, g, jsonify, request
+from logging import getLogger
+from logs import setup_logging
+from math import isfinite
+from metrics import content_type as metrics_content_type, default_registry
+from os import environ
+from pi_enviro import PiEnviro, startup_time
+from responses import ResponseCache, request_latency
+from signal import SIGINT, SIGTERM, signal
+from snapshot import Snapshot
+from stream import SnapshotBroadcaster
+from sys import exit
+from threading import Thread
+from time import monotonic
+from units import resolve_units
+from werkzeug.serving import make_server
 
+log = getLogger(__name__)
 
-# Initialize PiEnviro and API
-pi_enviro = PiEnviro(influxdb_config='jwm_influxdb.yml') # initialize PiEnviro (using personal database)
+
+# Initialize API (PiEnviro is initialized in main, or by the importer)
+pi_enviro = None
+beacon_scanner = None # only initialized if Bluetooth is available
 rest_api = Flask(__name__)
+response_cache = ResponseCache(lambda: pi_enviro.get_snapshot()) # pre-serialized snapshot route responses
+broadcaster = SnapshotBroadcaster(response_cache) # pushes each new snapshot to '/stream' subscribers
+
+
+def cached_response(path):
+    """
+    Return pre-serialized response for snapshot route, or 304 if the
+    client already has the current version. Values are in display units
+    (degF, %, inHg) unless other units are requested with
+    '?unit=' (e.g. '/env?unit=degC&unit=hPa').
+    """
+    try:
+        cached = response_cache.get(path, request.query_string.decode('latin-1'))
+    except ValueError as err:
+        abort(400, str(err))
+    if cached.is_not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        return Response(status=304, headers=cached.headers)
+    return Response(cached.body, status=cached.status, content_type=cached.content_type, headers=cached.headers)
+
+
+@rest_api.before_request
+def start_timer():
+    g.request_start = monotonic()
+
+
+@rest_api.after_request
+def record_latency(response):
+    """
+    Record request latency, by route (not raw path, so the number of
+    label values stays bounded).
+    """
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_latency.labels(route).observe(monotonic() - g.request_start)
+    return response
+
+
+@rest_api.route('/env')
+def env():
+    """
+    API endpoint for '/env', returns all readings (and the time each
+    was read) from one consistent snapshot.
+    """
+    return cached_response('/env')
+
+
+def float_arg(name):
+    """
+    Return query parameter as float, or None if not passed. Aborts with
+    400 if it is not a finite number.
+    :param name: Query parameter name.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+        if isfinite(number): return number
+    except ValueError:
+        pass
+    abort(400, 'Invalid {} "{}", expected a number'.format(name, value))
+
+
+@rest_api.route('/history')
+def history():
+    """
+    API endpoint for '/history?channel=&since=&until=&step=&unit=',
+    returns channel history. If step (seconds) is passed, history is
+    downsampled to min, max and mean per step bucket. Values are in the
+    channel's display unit unless unit is passed.
+    """
+    channel = request.args.get('channel', 'temp')
+    since = float_arg('since')
+    until = float_arg('until')
+    step = float_arg('step')
+    if channel not in ('temp', 'humidity', 'press'):
+        abort(400, 'Unknown channel "{}"'.format(channel))
+    if step is not None and step <= 0:
+        abort(400, 'Step must be greater than 0')
+    try:
+        unit = resolve_units(request.args.getlist('unit'), channels=(channel,))[channel]
+    except ValueError as err:
+        abort(400, str(err))
+    samples = pi_enviro.get_history(channel, since, until, step, unit)
+    if step:
+        points = [{'time': t, 'min': low, 'max': high, 'mean': mean, 'count': count} for t, low, high, mean, count in samples]
+    else:
+        points = [{'time': t, 'value': value} for t, value in samples]
+    return jsonify({'channel': channel, 'step': step, 'unit': unit, 'points': points})
+
+
+@rest_api.route('/stream')
+def stream():
+    """
+    API endpoint for '/stream?unit=', server-sent event stream with an
+    'env' event (the '/env' response) for each new snapshot. Served
+    natively by the async server, this route is used with the Flask
+    development server.
+    """
+    try:
+        subscriber = broadcaster.subscribe(request.query_string.decode('latin-1'), request.headers.get('Last-Event-ID'))
+    except ValueError as err:
+        abort(400, str(err))
+    return Response(broadcaster.events(subscriber), content_type=broadcaster.content_type, headers={'Cache-Control': 'no-cache'})
+
+
+@rest_api.route('/export')
+def export():
+    """
+    API endpoint for '/export?from=&to=&format=&channel=&unit=', streams
+    archived samples between from and to (seconds since epoch) as CSV
+    (default) or NDJSON, gzip compressed if the client accepts it. The
+    range is read one chunk at a time, never held in memory. Values are
+    in display units unless unit is passed.
+    """
+    since = float_arg('from')
+    until = float_arg('to')
+    export_format = request.args.get('format', 'csv')
+    channels = request.args.getlist('channel') or Snapshot.channels
+    if export_format not in export_formats:
+        abort(400, 'Unknown export format "{}", expected one of {}'.format(export_format, ', '.join(sorted(export_formats))))
+    for channel in channels:
+        if channel not in Snapshot.channels:
+            abort(400, 'Unknown channel "{}"'.format(channel))
+    try:
+        units = resolve_units(request.args.getlist('unit'), channels=tuple(channels))
+    except ValueError as err:
+        abort(400, str(err))
+    gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    headers = {'Content-Disposition': 'attachment; filename="pienviro.{}"'.format(export_format), 'Vary': 'Accept-Encoding'}
+    if gzip: headers['Content-Encoding'] = 'gzip'
+    return Response(export_lines(pi_enviro.get_archive(since, until), units, export_format, gzip=gzip),
+                    content_type=export_formats[export_format], headers=headers)
+
+
+@rest_api.route('/beacons')
+def beacons():
+    """
+    API endpoint for '/beacons', returns beacons currently in range.
+    """
+    if beacon_scanner is None:
+        abort(404, 'Beacon scanning is not enabled')
+    return jsonify(beacon_scanner.table.to_list())
+
+
+@rest_api.route('/metrics')
+def metrics():
+    """
+    API endpoint for '/metrics', returns sensor, scheduler, screen,
+    export and API metrics in Prometheus text format.
+    """
+    return Response(default_registry.render(), content_type=metrics_content_type)
 
 
 @rest_api.route('/temp')
@@ -13,7 +186,7 @@ def temp():
     """
     API endpoint for '/temp'
     """
-    return str(pi_enviro.get_temp())
+    return cached_response('/temp')
 
 
 @rest_api.route('/humidity')
@@ -21,7 +194,7 @@ def humidity():
     """
     API endpoint for '/humidity'
     """
-    return str(pi_enviro.get_humidity())
+    return cached_response('/humidity')
 
 
 @rest_api.route('/press')
@@ -29,10 +202,56 @@ def press():
     """
     API endpoint for '/press'
     """
-    return str(pi_enviro.get_press())
+    return cached_response('/press')
+
+
+def report_startup(started, budget_sec, ready=None):
+    """
+    Log time taken for the API to come up (once ready is set, if
+    passed), and warn if it took longer than budget_sec.
+    """
+    if ready is not None: ready.wait()
+    startup_sec = monotonic() - started
+    startup_time.labels('api').set(startup_sec)
+    if startup_sec > budget_sec:
+        log.warning('API up after %.2f s, over startup budget of %.2f s!', startup_sec, budget_sec)
+    else:
+        log.info('*** PiEnviroApi initialized! *** (API up after %.2f s)', startup_sec)
 
 
 if __name__ == '__main__':
-    pi_enviro.run()
-    rest_api.run(host='0.0.0.0')
-    print('*** PiEnviroApi initialized! ***')
+    started = monotonic()
+    config_file = environ.get('PIENVIRO_CONFIG', 'pienviro.yml') # sampling, sinks, display and API settings, applied live on change
+    config = load_config(config_file)
+    setup_logging(environ.get('PIENVIRO_LOG_LEVEL', config['logging']['level']))
+    backend = environ.get('PIENVIRO_BACKEND', 'sense_hat') # 'simulated' or 'replay' to run off-device
+    backend_args = {}
+    if backend == 'sense_hat': backend_args['cpu_temp_ttl_sec'] = config['sampling']['cpu_temp_ttl_sec']
+    if backend == 'replay': backend_args['filename'] = environ['PIENVIRO_REPLAY_FILE']
+    pi_enviro = PiEnviro(sense_hat=create_backend(backend, **backend_args), config_file=config_file)
+    pi_enviro.add_snapshot_listener(broadcaster.publish)
+    pi_enviro.run() # API answers 'warming up' until the first readings are in
+    try:
+        from bluetooth.ble import BeaconService # only available with Bluetooth installed
+        scan = config['beacons']
+        beacon_scanner = BeaconScanner(BeaconService('hci0'), scan_sec=scan['scan_sec'], idle_sec=scan['idle_sec'], ttl_sec=scan['ttl_sec'])
+        Thread(target=beacon_scanner.run, name='beacon', daemon=True).start()
+    except ImportError:
+        log.info('Bluetooth not available, beacon scanning disabled')
+    api = config['api']
+    try:
+        if environ.get('PIENVIRO_SERVER', api['server']) == 'async':
+            server = AsyncApiServer(rest_api, response_cache, broadcaster, host=api['host'], port=api['port']) # production server
+            signal(SIGTERM, lambda signum, frame: server.stop()) # e.g. docker stop
+            signal(SIGINT, lambda signum, frame: server.stop())
+            Thread(target=report_startup, args=[started, api['startup_budget_sec'], server.ready], daemon=True).start()
+            server.run()
+        else:
+            server = make_server(api['host'], api['port'], rest_api, threaded=True) # Flask development server, listening once created
+            signal(SIGTERM, lambda signum, frame: exit(0)) # stops on SystemExit
+            report_startup(started, api['startup_budget_sec'])
+            server.serve_forever()
+    finally:
+        log.info('Shutting down')
+        if beacon_scanner is not None: beacon_scanner.stop()
+        pi_enviro.stop()
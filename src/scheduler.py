@@ -0,0 +1,245 @@
+#!/usr/bin/python
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, Lock
+from time import monotonic, time
+
+from metrics import Counter, Histogram
+
+log = getLogger(__name__)
+
+read_latency = Histogram('pienviro_sensor_read_seconds', 'Time taken by each sensor read.', ('channel',))
+read_errors = Counter('pienviro_sensor_read_errors_total', 'Sensor reads that failed.', ('channel',))
+schedule_lag = Histogram('pienviro_scheduler_lag_seconds', 'How late each batch of reads started relative to its tick.')
+listener_errors = Counter('pienviro_scheduler_listener_errors_total', 'Batch listener calls that raised.')
+missed_deadlines = Counter('pienviro_scheduler_missed_deadlines_total', 'Channel reads skipped because the batch ran late.')
+
+
+class SampleChannel(object):
+    """
+    Single channel registered with the SampleScheduler.
+    """
+
+    def __init__(self, name, read_func, interval_ticks):
+        """
+        Constructor.
+        :param name: Channel name (e.g. 'temp').
+        :param read_func: Function called with no arguments to read the
+        current channel value.
+        :param interval_ticks: Number of scheduler ticks between reads.
+        """
+        self.name = name
+        self.read_func = read_func
+        self.interval_ticks = interval_ticks
+        self.next_tick = 0 # first read is due on the first tick
+        self.read_latency = read_latency.labels(name)
+        self.read_errors = read_errors.labels(name)
+
+
+class SampleScheduler(object):
+    """
+    Runs every sensor read on one shared timeline. Each channel has its
+    own read interval, quantized to whole scheduler ticks, so channels
+    that are due on the same tick are read together as one batch and
+    share one timestamp. Reads are serialized with the bus lock, which
+    should also be held by anything else that talks to the sensors.
+    """
+
+    def __init__(self, tick_sec=0.5, bus_lock=None):
+        """
+        Constructor.
+        :param tick_sec: Resolution of the shared timeline, in seconds.
+        Channel intervals are rounded to a multiple of this.
+        :param bus_lock: Lock used to serialize sensor bus access. A new
+        lock is created if not passed in.
+        """
+        self.tick_sec = float(tick_sec)
+        self.bus_lock = bus_lock if bus_lock is not None else Lock()
+        self._channels = OrderedDict()
+        self._batch_listeners = []
+        self._stop_event = Event()
+        self._start_time = None # monotonic time of tick 0
+        self._tick = 0
+        # Timing stats
+        self._batches = 0
+        self._reads = 0
+        self._read_errors = 0
+        self._listener_errors = 0
+        self._missed_deadlines = 0
+        self._last_jitter_sec = 0.0
+        self._max_jitter_sec = 0.0
+        self._total_jitter_sec = 0.0
+
+    ####################################################################
+
+    def add_channel(self, name, read_func, interval_sec):
+        """
+        Register channel to be read every interval_sec seconds.
+        :param name: Channel name, used as key in each batch.
+        :param read_func: Function called with no arguments to read the
+        current channel value.
+        :param interval_sec: Read interval, in seconds.
+        """
+        self._channels[name] = SampleChannel(name, read_func, self._to_ticks(interval_sec))
+
+    def set_interval(self, name, interval_sec):
+        """
+        Change read interval of registered channel. Takes effect after
+        the next read of that channel.
+        :param name: Channel name.
+        :param interval_sec: Read interval, in seconds.
+        """
+        self._channels[name].interval_ticks = self._to_ticks(interval_sec)
+
+    def add_batch_listener(self, listener):
+        """
+        Register function to be called after each batch of reads.
+        :param listener: Function called with (timestamp, samples), where
+        timestamp is the wall clock time of the tick and samples is a
+        dict of channel name to value.
+        """
+        self._batch_listeners.append(listener)
+
+    def _to_ticks(self, interval_sec):
+        """
+        Convert interval in seconds to whole number of ticks (minimum 1).
+        """
+        return max(1, int(round(interval_sec / self.tick_sec)))
+
+    ####################################################################
+
+    def run(self):
+        """
+        Scheduler loop, runs until stop() is called.
+        """
+        self._stop_event.clear()
+        self._start_time = monotonic()
+        self._tick = 0
+        while not self._stop_event.is_set():
+            self._tick = self._next_due_tick()
+            wait_sec = self._start_time + self._tick * self.tick_sec - monotonic()
+            if wait_sec > 0 and self._stop_event.wait(wait_sec):
+                break
+            self.run_pending()
+
+    def stop(self):
+        """
+        Signal scheduler loop to exit after the current batch.
+        """
+        self._stop_event.set()
+
+    def _next_due_tick(self):
+        """
+        Return the first tick any channel is due on.
+        """
+        return min(channel.next_tick for channel in self._channels.values())
+
+    def run_pending(self, tick=None):
+        """
+        Read every channel that is due on the current tick as one batch,
+        notify batch listeners, and return samples.
+        :param tick: Tick to run. Defaults to the current scheduler tick.
+        """
+        if tick is None: tick = self._tick
+        if self._start_time is None: self._start_time = monotonic()
+        now = monotonic()
+        self._record_jitter(now - (self._start_time + tick * self.tick_sec))
+        timestamp, samples = self._read_due(tick)
+        if samples: self.notify(timestamp, samples)
+        return samples
+
+    def read_first(self):
+        """
+        Read every channel once before the scheduler loop starts (e.g.
+        to publish readings while startup work is still running), and
+        return (timestamp, samples). Batch listeners are not called, pass
+        the batch to notify() once they are ready for it. Each channel is
+        next read one interval after run() starts.
+        """
+        if self._start_time is None: self._start_time = monotonic()
+        return self._read_due(0)
+
+    def _read_due(self, tick):
+        """
+        Read every channel that is due on tick, return (timestamp,
+        samples).
+        """
+        timestamp = time()
+        samples = OrderedDict()
+        with self.bus_lock:
+            for channel in self._channels.values():
+                if channel.next_tick > tick:
+                    continue
+                read_start = monotonic()
+                try:
+                    samples[channel.name] = channel.read_func()
+                    self._reads += 1
+                except (IOError, OSError) as err:
+                    self._read_errors += 1
+                    channel.read_errors.inc()
+                    log.warning('Failed to read %s channel (%s)!', channel.name, err)
+                except Exception: # e.g. replay backend out of samples, must not end the sampling thread
+                    self._read_errors += 1
+                    channel.read_errors.inc()
+                    log.exception('Unexpected error reading %s channel!', channel.name)
+                read_end = monotonic()
+                channel.read_latency.observe(read_end - read_start)
+                self._advance(channel, tick, read_end)
+        self._batches += 1
+        return timestamp, samples
+
+    def notify(self, timestamp, samples, skip=()):
+        """
+        Call batch listeners with batch of samples.
+        :param timestamp: Wall clock time the batch was read.
+        :param samples: Dict of channel name to value.
+        :param skip: Listeners not to call (e.g. ones already given the
+        batch).
+        """
+        for listener in self._batch_listeners:
+            if listener in skip:
+                continue
+            try:
+                listener(timestamp, samples)
+            except Exception: # one failing sink (e.g. full disk) must not stop sampling for the others
+                self._listener_errors += 1
+                listener_errors.inc()
+                log.exception('Batch listener %r failed!', listener)
+
+    def _advance(self, channel, tick, now):
+        """
+        Move channel to its next due tick. Deadlines that have already
+        passed (e.g. a slow read held up the batch) are skipped and
+        counted as missed, which keeps the channel on its grid.
+        """
+        channel.next_tick = tick + channel.interval_ticks
+        current_tick = int((now - self._start_time) / self.tick_sec)
+        while channel.next_tick < current_tick:
+            channel.next_tick += channel.interval_ticks
+            self._missed_deadlines += 1
+            missed_deadlines.inc()
+
+    def _record_jitter(self, jitter_sec):
+        """
+        Save how late the current batch started relative to its tick.
+        """
+        jitter_sec = max(0.0, jitter_sec)
+        schedule_lag.observe(jitter_sec)
+        self._last_jitter_sec = jitter_sec
+        self._max_jitter_sec = max(self._max_jitter_sec, jitter_sec)
+        self._total_jitter_sec += jitter_sec
+
+    ####################################################################
+
+    def get_stats(self):
+        """
+        Return dict of scheduler timing stats.
+        """
+        return {'batches': self._batches,
+                'reads': self._reads,
+                'read_errors': self._read_errors,
+                'listener_errors': self._listener_errors,
+                'missed_deadlines': self._missed_deadlines,
+                'last_jitter_sec': self._last_jitter_sec,
+                'max_jitter_sec': self._max_jitter_sec,
+                'mean_jitter_sec': self._total_jitter_sec / self._batches if self._batches else 0.0}
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+from collections import OrderedDict
+from threading import Event
+from time import monotonic
+
+from metrics import Histogram
+
+render_time = Histogram('pienviro_screen_render_seconds', 'Time taken to render a new scrolling message into frames.')
+frame_push_time = Histogram('pienviro_screen_frame_push_seconds', 'Time taken to push each frame to the LED matrix.')
+
+def rotation_map(rotation):
+    """
+    Return list mapping each index of a row-major 8x8 frame to its index
+    on the LED matrix at rotation, matching SenseHat.set_pixels.
+    :param rotation: Rotation in degrees (0, 90, 180 or 270).
+    """
+    pix_map = [[row * 8 + col for col in range(8)] for row in range(8)]
+    for _ in range((rotation // 90) % 4):
+        pix_map = [[pix_map[col][7 - row] for col in range(8)] for row in range(8)] # rotate 90 deg counter clockwise
+    return [pix_map[index // 8][index % 8] for index in range(64)]
+
+
+def sense_hat_glyphs(sense_hat):
+    """
+    Return glyph function that reads characters from the Sense HAT font.
+    Each glyph is a list of columns, each a tuple of 8 booleans (True
+    for lit), with blank columns on either side trimmed like
+    SenseHat.show_message does.
+    :param sense_hat: SenseHat object.
+    """
+    def glyph(char):
+        pixels = sense_hat._trim_whitespace(sense_hat._get_char_pixels(char))
+        lit = [list(pixel) == [255, 255, 255] for pixel in pixels]
+        return [tuple(lit[i:i + 8]) for i in range(0, len(lit), 8)]
+    return glyph
+
+
+class ScreenRenderer(object):
+    """
+    Renders scrolling messages for the 8x8 LED matrix as a list of
+    ready-to-push frames, producing the same output as
+    SenseHat.show_message. Work is cached at three levels, so a message
+    that only differs from the last one by a few digits only costs the
+    frames those digits scroll through:
+    - the colored columns of each character (rasterised once)
+    - each frame, keyed by the columns it shows and rotation (LRU)
+    - whole messages, keyed by text, colors and rotation (LRU)
+    """
+
+    def __init__(self, glyph_func, message_cache_size=8, frame_cache_size=1024):
+        """
+        Constructor.
+        :param glyph_func: Function returning the glyph for a character
+        (see sense_hat_glyphs).
+        :param message_cache_size: Number of rendered messages to keep.
+        :param frame_cache_size: Number of rendered frames to keep.
+        """
+        self._glyph_func = glyph_func
+        self._message_cache_size = message_cache_size
+        self._frame_cache_size = frame_cache_size
+        self._columns = {} # (char, text color, background color) -> list of column tuples
+        self._blank_columns = {} # background color -> column tuple
+        self._frames = OrderedDict() # (column ids, rotation) -> frame
+        self._messages = OrderedDict() # (text, text color, background color, rotation) -> frames
+        self._rotation_maps = dict((rotation, rotation_map((rotation - 90) % 360)) for rotation in (0, 90, 180, 270)) # scrolling shifts rotation by -90, like show_message
+        self.frames_rendered = 0
+        self.frame_hits = 0 # frames reused from the frame cache
+        self.message_hits = 0 # messages reused from the message cache
+
+    def render(self, text, text_color, back_color, rotation=0):
+        """
+        Return list of 64-pixel frames that scroll text across the
+        screen. Frames are already rotated, so push them with the
+        Sense HAT rotation set to 0.
+        :param text: Message to scroll.
+        :param text_color: Text color (R,G,B).
+        :param back_color: Background color (R,G,B).
+        :param rotation: Screen rotation in degrees.
+        """
+        text_color, back_color = tuple(text_color), tuple(back_color)
+        key = (text, text_color, back_color, rotation)
+        if key in self._messages:
+            self._messages.move_to_end(key)
+            self.message_hits += 1
+            return self._messages[key]
+        start = monotonic()
+        strip = self._strip(text, text_color, back_color)
+        frames = [self._frame(strip[i:i + 8], rotation) for i in range(len(strip) - 8)]
+        render_time.observe(monotonic() - start)
+        self._messages[key] = frames
+        if len(self._messages) > self._message_cache_size: self._messages.popitem(last=False)
+        return frames
+
+    def _strip(self, text, text_color, back_color):
+        """
+        Return list of colored columns for text, padded with a blank
+        screen either side and a blank column after each character.
+        """
+        if back_color not in self._blank_columns: self._blank_columns[back_color] = (back_color,) * 8
+        blank = self._blank_columns[back_color]
+        strip = [blank] * 8
+        for char in text:
+            strip.extend(self._char_columns(char, text_color, back_color))
+            strip.append(blank)
+        strip.extend([blank] * 8)
+        return strip
+
+    def _char_columns(self, char, text_color, back_color):
+        """
+        Return (cached) colored columns for character.
+        """
+        key = (char, text_color, back_color)
+        if key not in self._columns:
+            self._columns[key] = [tuple(text_color if lit else back_color for lit in column) for column in self._glyph_func(char)]
+        return self._columns[key]
+
+    def _frame(self, columns, rotation):
+        """
+        Return (cached) rotated frame showing 8 columns. Columns are
+        shared cached objects, so their ids identify the frame.
+        """
+        key = (tuple(id(column) for column in columns), rotation)
+        frame = self._frames.get(key)
+        if frame is None:
+            pixels = [pixel for column in columns for pixel in column] # the scroll direction is rows of the -90 rotated frame
+            frame = [None] * 64
+            for index, offset in enumerate(self._rotation_maps[rotation]):
+                frame[offset] = pixels[index]
+            self._frames[key] = frame
+            self.frames_rendered += 1
+            if len(self._frames) > self._frame_cache_size: self._frames.popitem(last=False)
+        else:
+            self._frames.move_to_end(key)
+            self.frame_hits += 1
+        return frame
+
+    @staticmethod
+    def play(frames, frame_sec, set_pixels, stop_event=None):
+        """
+        Push frames on a fixed timer. Each frame is shown frame_sec after
+        the previous one was due (not after it was pushed), so slow
+        pushes don't stretch the scroll. Returns early if stop_event is
+        set.
+        :param frames: Frames from render().
+        :param frame_sec: Time each frame is shown, in seconds.
+        :param set_pixels: Function that pushes a 64-pixel frame.
+        :param stop_event: Optional Event to stop playback.
+        """
+        if stop_event is None: stop_event = Event()
+        start = monotonic()
+        for index, frame in enumerate(frames):
+            push_start = monotonic()
+            set_pixels(frame)
+            frame_push_time.observe(monotonic() - push_start)
+            wait_sec = start + (index + 1) * frame_sec - monotonic()
+            if wait_sec > 0 and stop_event.wait(wait_sec):
+                return
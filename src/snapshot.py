@@ -0,0 +1,47 @@
+#!/usr/bin/python
+from collections import namedtuple
+
+
+class Snapshot(namedtuple('Snapshot', ['version',
+                                       'temp', 'temp_time',
+                                       'humidity', 'humidity_time',
+                                       'press', 'press_time'])):
+    """
+    Immutable, versioned set of the current environment readings and
+    the time each one was read. A new snapshot is built for every update
+    and published by swapping a single reference, so readers always see
+    all values from one consistent update without taking a lock.
+    """
+
+    __slots__ = ()
+
+    channels = ('temp', 'humidity', 'press')
+
+    @classmethod
+    def empty(cls):
+        """
+        Return initial snapshot, with no readings.
+        """
+        return cls(0, None, None, None, None, None, None)
+
+    def update(self, timestamp, samples):
+        """
+        Return new snapshot with the next version number, containing the
+        passed samples and the readings of this snapshot for any channel
+        that is not in samples.
+        :param timestamp: Time the samples were read, in seconds since
+        epoch.
+        :param samples: Dict of channel name to value.
+        """
+        values = {'version': self.version + 1}
+        for channel in self.channels:
+            if channel in samples:
+                values[channel] = samples[channel]
+                values[channel + '_time'] = timestamp
+        return self._replace(**values)
+
+    def to_dict(self):
+        """
+        Return snapshot as a dict (e.g. for JSON encoding).
+        """
+        return dict(self._asdict())
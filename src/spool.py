@@ -0,0 +1,269 @@
+#!/usr/bin/python
+from glob import glob
+from logging import getLogger
+from mmap import mmap
+from os import makedirs, remove, rename
+from os.path import basename, exists, join
+from struct import Struct
+from threading import Lock
+from time import gmtime, monotonic, strftime, time
+
+log = getLogger(__name__)
+
+
+class SpoolSegment(object):
+    """
+    One day of spooled samples, stored as fixed-size binary records in a
+    memory-mapped file. The file starts with a header holding the number
+    of records written and the number acknowledged by downstream sinks,
+    followed by the records. The file grows in steps of grow_records, so
+    appends are just a struct pack into the map.
+    """
+
+    header = Struct('<4sHHQQ') # magic, version, record size, count, acked
+    record = Struct('<dB7xd') # timestamp, channel id, (padding), value
+    magic = b'PESP'
+    version = 2 # 2: values in canonical SI units (1: degF, %, inHg)
+
+    def __init__(self, path, grow_records=4096):
+        """
+        Constructor, opens segment file (creating it if needed).
+        :param path: Segment file path.
+        :param grow_records: Number of records to grow file by when full.
+        """
+        self.path = path
+        self._grow_records = grow_records
+        if exists(path):
+            self._file = open(path, 'r+b')
+            self._map = mmap(self._file.fileno(), 0)
+            magic, version, record_size, self.count, self.acked = self.header.unpack_from(self._map)
+            if magic != self.magic or version != self.version or record_size != self.record.size:
+                self._map.close()
+                self._file.close()
+                raise ValueError('Invalid spool segment ({})'.format(path))
+        else:
+            self._file = open(path, 'w+b')
+            self._file.truncate(self.header.size + grow_records * self.record.size)
+            self._map = mmap(self._file.fileno(), 0)
+            self.count = 0
+            self.acked = 0
+            self._write_header()
+
+    @property
+    def capacity(self):
+        """
+        Number of records file has room for.
+        """
+        return (len(self._map) - self.header.size) // self.record.size
+
+    def _write_header(self):
+        self.header.pack_into(self._map, 0, self.magic, self.version, self.record.size, self.count, self.acked)
+
+    def append(self, timestamp, channel_id, value):
+        """
+        Append record, return number of records in segment.
+        """
+        if self.count >= self.capacity:
+            self._map.resize(len(self._map) + self._grow_records * self.record.size)
+        self.record.pack_into(self._map, self.header.size + self.count * self.record.size, timestamp, channel_id, value)
+        self.count += 1
+        self._write_header()
+        return self.count
+
+    def ack(self, count):
+        """
+        Mark first count records as acknowledged.
+        """
+        if count > self.acked:
+            self.acked = min(count, self.count)
+            self._write_header()
+
+    def records(self, start=0, end=None):
+        """
+        Return iterator of (timestamp, channel_id, value) records.
+        :param start: Index of first record.
+        :param end: Index after last record. Defaults to record count.
+        """
+        if end is None: end = self.count
+        offset = self.header.size
+        return self.record.iter_unpack(self._map[offset + start * self.record.size:offset + end * self.record.size])
+
+    def sync(self):
+        """
+        Flush written records to disk.
+        """
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+class SampleSpool(object):
+    """
+    Append-only, write-ahead spool of every sample, segmented by (UTC)
+    day. Samples are appended before being handed to downstream sinks,
+    and sinks acknowledge them once they are safely written, so samples
+    that were not sent before a restart can be replayed on startup.
+    Disk syncs are batched (every sync_every records or sync_sec
+    seconds) to keep SD card writes cheap. Segments are deleted once
+    fully acknowledged and older than retention_sec.
+    """
+
+    def __init__(self, spool_dir, channels, sync_every=64, sync_sec=10.0, retention_sec=7*24*60*60):
+        """
+        Constructor.
+        :param spool_dir: Directory for segment files.
+        :param channels: List of channel names. Records store the index
+        of the channel in this list, so only append to the end of it.
+        :param sync_every: Number of records between disk syncs.
+        :param sync_sec: Maximum time between disk syncs, in seconds.
+        :param retention_sec: Minimum age of a segment before it is
+        deleted, in seconds.
+        """
+        makedirs(spool_dir, exist_ok=True)
+        self._spool_dir = spool_dir
+        self._channels = list(channels)
+        self._channel_ids = dict((channel, i) for i, channel in enumerate(self._channels))
+        self._sync_every = sync_every
+        self._sync_sec = sync_sec
+        self._retention_sec = retention_sec
+        self._segments = {} # day -> SpoolSegment
+        self._unsynced = 0
+        self._last_sync = monotonic()
+        self._lock = Lock()
+        for path in sorted(glob(join(spool_dir, '*.spool'))):
+            try:
+                self._segments[basename(path)[:-len('.spool')]] = SpoolSegment(path)
+            except ValueError as err:
+                log.warning('Skipping spool segment (%s)!', err)
+                rename(path, path + '.invalid') # keep it, but don't let today's segment overwrite it
+
+    @staticmethod
+    def _day(timestamp):
+        return strftime('%Y%m%d', gmtime(timestamp))
+
+    def _segment(self, day):
+        """
+        Return segment for day, creating it if needed. Must be called
+        with lock held.
+        """
+        if day not in self._segments:
+            self._segments[day] = SpoolSegment(join(self._spool_dir, day + '.spool'))
+        return self._segments[day]
+
+    ####################################################################
+
+    def append(self, timestamp, samples):
+        """
+        Append batch of samples read at the same time, and return token
+        to pass to ack() once they are written downstream.
+        :param timestamp: Sample time, in seconds since epoch.
+        :param samples: Dict of channel name to value.
+        """
+        day = self._day(timestamp)
+        with self._lock:
+            segment = self._segment(day)
+            for channel, value in samples.items():
+                count = segment.append(timestamp, self._channel_ids[channel], value)
+            self._unsynced += len(samples)
+            if self._unsynced >= self._sync_every or monotonic() - self._last_sync >= self._sync_sec:
+                self._sync()
+        return (day, count)
+
+    def ack(self, token):
+        """
+        Mark all samples up to and including token as written
+        downstream, then delete old segments that are fully acked.
+        :param token: Token returned by append() or pending().
+        """
+        day, count = token
+        with self._lock:
+            for segment_day in sorted(self._segments):
+                if segment_day < day:
+                    self._segments[segment_day].ack(self._segments[segment_day].count)
+                elif segment_day == day:
+                    self._segments[segment_day].ack(count)
+            self._delete_expired()
+
+    def _delete_expired(self):
+        """
+        Delete fully acked segments older than retention. Must be called
+        with lock held.
+        """
+        oldest_day = self._day(time() - self._retention_sec)
+        for day in sorted(self._segments):
+            segment = self._segments[day]
+            if day >= oldest_day or segment.acked < segment.count:
+                break
+            segment.close()
+            remove(segment.path)
+            del self._segments[day]
+
+    ####################################################################
+
+    def replay(self, since=None):
+        """
+        Return iterator of (timestamp, samples) batches for every sample
+        in the spool (acked or not), oldest first.
+        :param since: Skip samples older than this, in seconds since
+        epoch.
+        """
+        for _, timestamp, samples in self._batches(acked=True, since=since):
+            yield timestamp, samples
+
+    def pending(self):
+        """
+        Return iterator of (token, timestamp, samples) batches for every
+        sample not yet acked, oldest first.
+        """
+        return self._batches(acked=False)
+
+    def _batches(self, acked, since=None):
+        """
+        Read segments sequentially, grouping consecutive records with
+        the same timestamp back into their original batch.
+        """
+        with self._lock:
+            segments = [(day, self._segments[day]) for day in sorted(self._segments)]
+            if since is not None:
+                segments = [(day, segment) for day, segment in segments if day >= self._day(since)]
+        for day, segment in segments:
+            start = 0 if acked else segment.acked
+            end = segment.count
+            timestamp, samples = None, {}
+            for index, (record_time, channel_id, value) in enumerate(segment.records(start, end), start + 1):
+                if since is not None and record_time < since:
+                    continue
+                if record_time != timestamp and samples:
+                    yield (day, index - 1), timestamp, samples
+                    samples = {}
+                timestamp = record_time
+                samples[self._channels[channel_id]] = value
+            if samples:
+                yield (day, end), timestamp, samples
+
+    ####################################################################
+
+    def sync(self):
+        """
+        Flush all appended samples to disk.
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        for segment in self._segments.values():
+            segment.sync()
+        self._unsynced = 0
+        self._last_sync = monotonic()
+
+    def close(self):
+        """
+        Flush and close all segment files.
+        """
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+from collections import deque
+from threading import Condition, Lock
+from time import monotonic
+
+from metrics import Counter, Gauge, Histogram
+
+subscribers = Gauge('pienviro_stream_subscribers', 'Clients subscribed to the live event stream.')
+events_sent = Counter('pienviro_stream_events_total', 'Events queued to live stream subscribers.')
+evictions = Counter('pienviro_stream_evictions_total', 'Live stream subscribers dropped for falling behind.')
+publish_time = Histogram('pienviro_stream_publish_seconds', 'Time taken to fan out each snapshot to all subscribers.')
+
+
+class Subscriber(object):
+    """
+    One live stream client. Events are queued by the broadcaster and
+    taken off by the server connection. A client whose queue fills up is
+    evicted rather than slowing everyone else down.
+    """
+
+    def __init__(self, query=''):
+        """
+        Constructor.
+        :param query: Request query string, may hold 'unit' parameters.
+        """
+        self.query = query
+        self.queue = deque()
+        self.evicted = False
+
+    def take(self):
+        """
+        Return list of queued events (may be empty).
+        """
+        events = []
+        while self.queue:
+            events.append(self.queue.popleft())
+        return events
+
+
+class SnapshotBroadcaster(object):
+    """
+    Fans out every new snapshot to live stream subscribers as
+    server-sent events. Each event is the /env response body, encoded
+    once per snapshot version and set of units by the ResponseCache and
+    shared by every subscriber (and poller) that asked for those units.
+    """
+
+    content_type = 'text/event-stream; charset=utf-8'
+
+    def __init__(self, response_cache, max_queue=16, keepalive_sec=15.0, retry_ms=1000):
+        """
+        Constructor.
+        :param response_cache: ResponseCache used to encode events.
+        :param max_queue: Events a subscriber may have waiting before it
+        is evicted.
+        :param keepalive_sec: Time between comment lines sent to idle
+        subscribers, so dead connections are noticed.
+        :param retry_ms: Reconnect delay sent to clients.
+        """
+        self._cache = response_cache
+        self._max_queue = max_queue
+        self.keepalive_sec = keepalive_sec
+        self.preamble = 'retry: {}\n\n'.format(retry_ms).encode('latin-1')
+        self.keepalive = b': keepalive\n\n'
+        self._subscribers = set()
+        self._lock = Lock()
+        self._cond = Condition(self._lock) # wakes thread consumers
+        self._events = (None, {}) # (snapshot version, event id -> encoded event) of last snapshot
+        self._publish_hooks = []
+        subscribers.set_function(lambda: len(self._subscribers))
+
+    def subscribe(self, query='', last_event_id=None):
+        """
+        Return new Subscriber, with the current snapshot queued unless
+        the client already has it (last_event_id, sent by reconnecting
+        EventSource clients). Raises ValueError if query asks for an
+        unknown unit.
+        :param query: Request query string, may hold 'unit' parameters.
+        :param last_event_id: Last-Event-ID header value.
+        """
+        subscriber = Subscriber(query)
+        event_id, event = self._event(subscriber)
+        if event is not None and event_id != last_event_id:
+            subscriber.queue.append(event)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def add_publish_hook(self, hook):
+        """
+        Register function to be called (from the publishing thread, with
+        no arguments) once events for an update are queued, e.g. to wake
+        an event loop that serves subscribers.
+        """
+        self._publish_hooks.append(hook)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _event(self, subscriber):
+        """
+        Return (event id, encoded event) of current snapshot in
+        subscriber's units, or (None, None) while warming up. The event
+        id is the ETag value, so it differs per process, per snapshot
+        and per unit choice.
+        """
+        cached = self._cache.get('/env', subscriber.query)
+        if cached.status != 200:
+            return None, None
+        event_id = cached.etag.strip('"')
+        snapshot_version = event_id.partition('-')[0]
+        events_version, events = self._events
+        if events_version != snapshot_version:
+            events = {}
+            self._events = (snapshot_version, events)
+        event = events.get(event_id)
+        if event is None:
+            event = b'id: ' + event_id.encode('latin-1') + b'\nevent: env\ndata: ' + cached.body + b'\n\n'
+            events[event_id] = event # single assignment, safe to race
+        return event_id, event
+
+    ####################################################################
+
+    def publish(self, snapshot=None):
+        """
+        Queue current snapshot to every subscriber, evicting those whose
+        queue is full. Called from the sampling thread after each update.
+        :param snapshot: Published snapshot (unused, the current one is
+        read from the response cache).
+        """
+        start = monotonic()
+        with self._lock:
+            current = list(self._subscribers)
+        evicted = []
+        events = {} # query -> event, most subscribers share a few queries
+        for subscriber in current:
+            if len(subscriber.queue) >= self._max_queue:
+                subscriber.evicted = True
+                evicted.append(subscriber)
+                continue
+            event = events.get(subscriber.query)
+            if event is None:
+                event = events[subscriber.query] = self._event(subscriber)[1]
+            if event is None:
+                return # still warming up, nothing to send
+            subscriber.queue.append(event)
+        with self._cond:
+            for subscriber in evicted:
+                self._subscribers.discard(subscriber)
+            self._cond.notify_all()
+        for hook in self._publish_hooks:
+            hook()
+        events_sent.inc(len(current) - len(evicted))
+        if evicted: evictions.inc(len(evicted))
+        publish_time.observe(monotonic() - start)
+
+    def wait(self, subscriber, timeout_sec):
+        """
+        Return list of queued events for subscriber, waiting up to
+        timeout_sec for one if none are queued (for thread consumers,
+        e.g. the Flask server).
+        """
+        with self._cond:
+            if not subscriber.queue and not subscriber.evicted:
+                self._cond.wait(timeout_sec)
+        return subscriber.take()
+
+    def events(self, subscriber):
+        """
+        Return iterator of encoded events for subscriber, with keepalive
+        comments while idle. Ends when the subscriber is evicted, and
+        unsubscribes when closed (e.g. client went away).
+        """
+        try:
+            yield self.preamble
+            while not subscriber.evicted:
+                events = self.wait(subscriber, self.keepalive_sec)
+                yield b''.join(events) if events else self.keepalive
+        finally:
+            self.unsubscribe(subscriber)
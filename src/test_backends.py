@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""
+Tests for temperature calibration against off-device backends, which
+must not depend on the host's CPU temperature.
+
+Usage: python -m pytest test_backends.py (or python -m unittest)
+"""
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from backends import ReplaySenseHat, SimulatedSenseHat
+from pi_enviro import PiEnviro
+
+flat_waveforms = {'temperature': {'amplitude': 0.0, 'noise': 0.0}} # constant 21.0 degC
+
+
+class CalibrationTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix='pienviro-test-')
+
+    def tearDown(self):
+        rmtree(self.temp_dir, ignore_errors=True)
+
+    def pi_enviro(self, sense_hat):
+        return PiEnviro(sense_hat=sense_hat, spool_dir=join(self.temp_dir, 'spool'), archive_dir=join(self.temp_dir, 'archive'))
+
+    def test_simulated_without_cpu_temp_skips_calibration(self):
+        pi_enviro = self.pi_enviro(SimulatedSenseHat(waveforms=flat_waveforms, sample_rate_hz=1000))
+        self.assertIsNone(pi_enviro._read_cpu_temp())
+        self.assertAlmostEqual(pi_enviro._read_temp(), 21.0 + 273.15) # canonical K
+        self.assertIsNone(pi_enviro._temp_correction)
+
+    def test_simulated_cpu_temp_gives_deterministic_calibration(self):
+        temps = []
+        for _ in range(2):
+            pi_enviro = self.pi_enviro(SimulatedSenseHat(waveforms=flat_waveforms, sample_rate_hz=1000, cpu_temp=52.12))
+            temps.append(pi_enviro._read_temp())
+        self.assertEqual(temps[0], temps[1])
+        self.assertAlmostEqual(temps[0], 21.0 + 273.15 - (52.12 - 21.0) / 1.556)
+
+    def test_replay_uses_recorded_cpu_temp(self):
+        filename = join(self.temp_dir, 'samples.csv')
+        with open(filename, 'w') as samples_file:
+            samples_file.write('timestamp,temperature,humidity,pressure,cpu_temperature\n')
+            samples_file.write('0,21.0,40.0,1013.0,52.12\n')
+        pi_enviro = self.pi_enviro(ReplaySenseHat(filename))
+        self.assertAlmostEqual(pi_enviro._read_cpu_temp(), 52.12 + 273.15)
+        self.assertAlmostEqual(pi_enviro._read_temp(), 21.0 + 273.15 - (52.12 - 21.0) / 1.556)
+
+    def test_replay_without_cpu_temp_column_skips_calibration(self):
+        filename = join(self.temp_dir, 'samples.csv')
+        with open(filename, 'w') as samples_file:
+            samples_file.write('timestamp,temperature,humidity,pressure\n')
+            samples_file.write('0,21.0,40.0,1013.0\n')
+        pi_enviro = self.pi_enviro(ReplaySenseHat(filename))
+        self.assertIsNone(pi_enviro._read_cpu_temp())
+        self.assertAlmostEqual(pi_enviro._read_temp(), 21.0 + 273.15)
+
+
+if __name__ == '__main__':
+    main()
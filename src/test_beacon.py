@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+Tests for the beacon table and scanner, run against a fake
+BeaconService.
+
+Usage: python -m pytest test_beacon.py (or python -m unittest)
+"""
+from threading import Thread
+from time import monotonic, sleep
+from unittest import TestCase, main
+
+from beacon import BeaconScanner, BeaconTable
+
+uuid = 'e2c56db5-dffb-48d2-b060-d0f5a71096e0'
+
+
+class FakeBeaconService(object):
+    """
+    BeaconService stand-in. Each scan blocks for its timeout (like the
+    real one) and returns the next scripted result, or raises it if it
+    is an exception. Once the script runs out, scans find nothing.
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.scans = [] # (start, end, timeout) per scan
+
+    def scan(self, timeout):
+        start = monotonic()
+        sleep(timeout)
+        self.scans.append((start, monotonic(), timeout))
+        result = self.script.pop(0) if self.script else {}
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def run_scanner(scanner, run_sec):
+    thread = Thread(target=scanner.run)
+    thread.start()
+    sleep(run_sec)
+    scanner.stop()
+    thread.join(2.0)
+    return thread
+
+
+class BeaconTableTest(TestCase):
+
+    def test_dedup_smoothing_and_ttl(self):
+        table = BeaconTable(ttl_sec=10.0, rssi_alpha=0.5)
+        table.update({'aa:01': [uuid, 1, 1, -59, -70]}, timestamp=100.0)
+        table.update({'aa:01': [uuid, 1, 1, -59, -60], 'aa:02': [uuid, 1, 2, -59, -80]}, timestamp=105.0)
+        self.assertEqual(len(table), 2)
+        beacon = table.find(uuid, 1, 1)
+        self.assertIs(beacon, table.get('aa:01'))
+        self.assertEqual(beacon.to_dict()['rssi'], -65.0)
+        self.assertEqual(beacon.to_dict()['seen_count'], 2)
+        self.assertEqual([entry['address'] for entry in table.to_list()], ['aa:01', 'aa:02']) # strongest first
+        table.update({'aa:02': [uuid, 1, 2, -59, -80]}, timestamp=115.5) # aa:01 last seen 10.5 s ago
+        self.assertIsNone(table.get('aa:01'))
+        self.assertIsNone(table.find(uuid, 1, 1))
+        self.assertEqual(len(table), 1)
+
+
+class BeaconScannerTest(TestCase):
+
+    def test_scan_window_and_idle_gap(self):
+        service = FakeBeaconService([])
+        scanner = BeaconScanner(service, scan_sec=0.05, idle_sec=0.1)
+        self.assertFalse(run_scanner(scanner, 0.5).is_alive())
+        self.assertTrue(all(timeout == 0.05 for _, _, timeout in service.scans))
+        gaps = [next_start - end for (_, end, _), (next_start, _, _) in zip(service.scans, service.scans[1:])]
+        self.assertTrue(gaps)
+        self.assertTrue(all(gap >= 0.09 for gap in gaps)) # radio left idle between windows
+        self.assertLessEqual(len(service.scans), 4) # 0.15 s per cycle
+        self.assertEqual(scanner.scans, len(service.scans))
+
+    def test_back_to_back_scans_with_no_idle_gap(self):
+        service = FakeBeaconService([])
+        scanner = BeaconScanner(service, scan_sec=0.05, idle_sec=0.0)
+        run_scanner(scanner, 0.5)
+        self.assertGreaterEqual(len(service.scans), 7)
+
+    def test_out_of_range_beacon_evicted_after_ttl(self):
+        seen = {'aa:01': [uuid, 1, 1, -59, -70]}
+        service = FakeBeaconService([seen, seen])
+        scanner = BeaconScanner(service, scan_sec=0.02, idle_sec=0.0, ttl_sec=0.2)
+        thread = Thread(target=scanner.run)
+        thread.start()
+        sleep(0.1)
+        self.assertIsNotNone(scanner.table.get('aa:01'))
+        sleep(0.4) # empty scans since, evicted once ttl has passed
+        scanner.stop()
+        thread.join(2.0)
+        self.assertIsNone(scanner.table.get('aa:01'))
+
+    def test_scan_errors_do_not_stop_scanner(self):
+        seen = {'aa:01': [uuid, 1, 1, -59, -70]}
+        service = FakeBeaconService([OSError('hci0 down'), KeyError('unexpected'), ValueError('bad advert'), seen])
+        scanner = BeaconScanner(service, scan_sec=0.02, idle_sec=0.0)
+        self.assertFalse(run_scanner(scanner, 0.3).is_alive())
+        self.assertEqual(scanner.scan_errors, 3)
+        self.assertGreater(scanner.scans, 4)
+        self.assertIsNotNone(scanner.table.get('aa:01'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+Tests for export compression error bounds.
+
+Usage: python -m pytest test_compression.py (or python -m unittest)
+"""
+from math import sin
+from random import Random
+from unittest import TestCase, main
+
+from compression import DeadBand, SwingingDoor
+from config import validate
+
+
+class CompressionTest(TestCase):
+
+    def series(self, count=5000, seed=1):
+        random = Random(seed)
+        return [(15.0 * i, 293.0 + 2.0 * sin(i / 200.0) + random.gauss(0.0, 0.02)) for i in range(count)]
+
+    @staticmethod
+    def kept(compressor, series):
+        points = []
+        for timestamp, value in series:
+            points.extend(compressor.add(timestamp, value))
+        points.extend(compressor.flush())
+        return points
+
+    def test_swinging_door_max_error(self):
+        deviation = 0.05
+        series = self.series()
+        points = self.kept(SwingingDoor(deviation, heartbeat_sec=1e9), series)
+        self.assertLess(len(points), len(series) / 5) # actually compresses
+        self.assertEqual(points[0], series[0])
+        self.assertEqual(points[-1], series[-1])
+        segment = 0
+        for timestamp, value in series: # linear interpolation between kept points
+            while points[segment + 1][0] < timestamp:
+                segment += 1
+            (t0, v0), (t1, v1) = points[segment], points[segment + 1]
+            interpolated = v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+            self.assertLessEqual(abs(interpolated - value), deviation + 1e-9)
+
+    def test_swinging_door_heartbeat(self):
+        points = self.kept(SwingingDoor(10.0, heartbeat_sec=600.0), self.series(count=500))
+        self.assertLessEqual(max(t1 - t0 for (t0, _), (t1, _) in zip(points, points[1:])), 600.0)
+
+    def test_dead_band_max_error(self):
+        deviation = 0.05
+        series = self.series()
+        points = self.kept(DeadBand(deviation, heartbeat_sec=1e9), series)
+        self.assertLess(len(points), len(series))
+        segment = 0
+        for timestamp, value in series: # step interpolation, last kept value holds
+            while segment + 1 < len(points) and points[segment + 1][0] <= timestamp:
+                segment += 1
+            self.assertLessEqual(abs(points[segment][1] - value), deviation + 1e-9)
+
+    def test_negative_bounds_rejected(self):
+        for compressor_class in (DeadBand, SwingingDoor):
+            with self.assertRaises(ValueError):
+                compressor_class(-0.05)
+            with self.assertRaises(ValueError):
+                compressor_class(0.05, heartbeat_sec=-1.0)
+            self.assertEqual(self.kept(compressor_class(0.0, heartbeat_sec=0.0), self.series(count=10)), self.series(count=10))
+
+    def test_negative_bounds_fail_config_validation(self):
+        with self.assertRaisesRegex(ValueError, 'sinks.compression.temp is invalid'):
+            validate({'sinks': {'compression': {'temp': {'deviation': -1}}}})
+        with self.assertRaisesRegex(ValueError, 'sinks.compression.press is invalid'):
+            validate({'sinks': {'compression': {'press': {'heartbeat_sec': -600}}}})
+
+
+if __name__ == '__main__':
+    main()
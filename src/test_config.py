@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""
+Tests for config validation and live reload.
+
+Usage: python -m pytest test_config.py (or python -m unittest)
+"""
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from backends import SimulatedSenseHat
+from config import validate
+from pi_enviro import PiEnviro
+
+
+class ApplyConfigTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix='pienviro-test-')
+        self.pi_enviro = PiEnviro(sense_hat=SimulatedSenseHat(sample_rate_hz=1000), spool_dir=join(self.temp_dir, 'spool'),
+                                  archive_dir=join(self.temp_dir, 'archive'))
+
+    def tearDown(self):
+        rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_reload_keeps_joystick_display_changes(self):
+        self.pi_enviro.inc_screen_color()
+        self.pi_enviro.inc_screen_speed()
+        color, speed = self.pi_enviro._screen_text_color, self.pi_enviro._screen_speed
+        self.pi_enviro.apply_config(validate({'sampling': {'intervals': {'temp': 2.0}}}))
+        self.assertEqual(self.pi_enviro._config['sampling']['intervals']['temp'], 2.0)
+        self.assertEqual((self.pi_enviro._screen_text_color, self.pi_enviro._screen_speed), (color, speed))
+
+    def test_reload_applies_changed_display_options(self):
+        self.pi_enviro.inc_screen_speed()
+        speed = self.pi_enviro._screen_speed
+        self.pi_enviro.apply_config(validate({'display': {'rotation': 90, 'text_color': 3}}))
+        self.assertEqual(self.pi_enviro._screen_rotation, 90)
+        self.assertEqual(self.pi_enviro._screen_text_color, PiEnviro.colors[3])
+        self.assertEqual(self.pi_enviro._screen_speed, speed) # not in the reloaded config's changes
+
+
+if __name__ == '__main__':
+    main()
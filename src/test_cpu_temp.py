@@ -0,0 +1,55 @@
+#!/usr/bin/python
+"""
+Tests for the CPU temperature sensor, against a fake thermal zone file.
+
+Usage: python -m pytest test_cpu_temp.py (or python -m unittest)
+"""
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from unittest import TestCase, main
+
+from cpu_temp import CpuTempSensor
+
+
+class CpuTempSensorTest(TestCase):
+
+    def setUp(self):
+        self.zone_dir = mkdtemp(prefix='pienviro-test-')
+        self.zone_path = join(self.zone_dir, 'temp')
+        self.write_zone('41700\n')
+
+    def tearDown(self):
+        rmtree(self.zone_dir, ignore_errors=True)
+
+    def write_zone(self, text):
+        with open(self.zone_path, 'w') as zone_file:
+            zone_file.write(text)
+
+    def test_reads_millidegrees_and_caches_for_ttl(self):
+        sensor = CpuTempSensor(ttl_sec=0.05, zone_path=self.zone_path)
+        self.assertEqual(sensor.read(), 41.7)
+        self.write_zone('52300\n')
+        self.assertEqual(sensor.read(), 41.7) # cached
+        sleep(0.06)
+        self.assertEqual(sensor.read(), 52.3) # same file handle, re-read with pread
+        sensor.close()
+
+    def test_failed_read_falls_back_to_vcgencmd(self):
+        sensor = CpuTempSensor(ttl_sec=0.0, zone_path=self.zone_dir) # opens, but pread raises IsADirectoryError
+        sensor._has_vcgencmd = False # as if vcgencmd is not installed either
+        self.assertIsNone(sensor.read()) # no exception, calibration is skipped
+        self.assertIsNone(sensor._fd)
+        self.assertIsNone(sensor.read())
+
+    def test_garbled_zone_file_falls_back_to_vcgencmd(self):
+        self.write_zone('')
+        sensor = CpuTempSensor(ttl_sec=0.0, zone_path=self.zone_path)
+        sensor._has_vcgencmd = False
+        self.assertIsNone(sensor.read())
+        self.assertIsNone(sensor._fd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""
+Tests for the fleet aggregator's hedged and retried polls, against
+local stub nodes.
+
+Usage: python -m pytest test_fleet.py (or python -m unittest)
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from socket import socket
+from threading import Thread
+from time import monotonic, sleep, time
+from unittest import TestCase, main
+
+from fleet import FleetAggregator, hedged_requests
+
+
+class StubNode(BaseHTTPRequestHandler):
+    """
+    Stub PiEnviro /env. Each request takes the next scripted action
+    ('ok', 'fail' for a 500, or a number of seconds to stall before
+    answering), then 'ok' once the script runs out. Once the server's
+    dead flag is set, connections are dropped without an answer.
+    """
+
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real node
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.dead:
+            self.close_connection = True
+            return
+        action = self.server.script.pop(0) if self.server.script else 'ok'
+        if action == 'fail':
+            body, status = b'boom', 500
+        else:
+            if action != 'ok': sleep(action)
+            now = time()
+            body, status = dumps({'temp': 70.0, 'temp_time': now, 'humidity': 40.0, 'humidity_time': now,
+                                  'press': 29.92, 'press_time': now}).encode('utf-8'), 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class FleetAggregatorTest(TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def stub_node(self, script=()):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubNode)
+        server.daemon_threads = True
+        server.requests = 0
+        server.dead = False
+        server.script = list(script)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server
+
+    def aggregator(self, **nodes):
+        urls = [{'name': name, 'url': url if isinstance(url, str) else 'http://127.0.0.1:{}'.format(url.server_port)} for name, url in nodes.items()]
+        return FleetAggregator(urls, poll_sec=0.05, timeout_sec=1.0, hedge_sec=0.1, max_age_sec=0.3)
+
+    def test_slow_node_gets_hedged_request(self):
+        slow = self.stub_node([1.5]) # first request stalls past the round deadline, the hedge answers
+        fleet = self.aggregator(office=slow)
+        hedged = hedged_requests.value
+        start = monotonic()
+        view = fleet.poll_once()
+        self.assertLess(monotonic() - start, 0.5)
+        self.assertEqual(hedged_requests.value, hedged + 1)
+        self.assertEqual(slow.requests, 2)
+        self.assertTrue(view.nodes['office']['online'])
+        self.assertEqual(view.nodes['office']['temp'], 70.0)
+
+    def test_fast_failure_is_retried_once(self):
+        flaky = self.stub_node(['fail'])
+        fleet = self.aggregator(office=flaky)
+        hedged = hedged_requests.value
+        start = monotonic()
+        view = fleet.poll_once()
+        self.assertLess(monotonic() - start, 0.1) # retried straight away, not at hedge time
+        self.assertEqual(flaky.requests, 2)
+        self.assertEqual(hedged_requests.value, hedged)
+        self.assertTrue(view.nodes['office']['online'])
+
+    def test_failing_node_is_retried_only_once(self):
+        broken = self.stub_node(['fail'] * 10)
+        view = self.aggregator(office=broken).poll_once()
+        self.assertEqual(broken.requests, 2)
+        self.assertFalse(view.nodes['office']['online'])
+
+    def test_dead_node_marked_stale(self):
+        healthy = self.stub_node()
+        dying = self.stub_node()
+        fleet = self.aggregator(office=healthy, garage=dying)
+        view = fleet.poll_once()
+        self.assertTrue(view.nodes['garage']['online'])
+        self.assertEqual(view.nodes['garage']['temp'], 70.0)
+        dying.dead = True
+        view = fleet.poll_once()
+        self.assertFalse(view.nodes['garage']['online'])
+        self.assertEqual(view.nodes['garage']['temp'], 70.0) # last reading kept until max_age_sec
+        sleep(0.35)
+        view = fleet.poll_once()
+        garage = view.nodes['garage']
+        self.assertFalse(garage['online'])
+        self.assertIsNone(garage['temp'])
+        self.assertGreater(garage['temp_age_sec'], 0.3)
+        self.assertTrue(view.nodes['office']['online'])
+        self.assertEqual(view.nodes['office']['temp'], 70.0)
+
+    def test_unreachable_node_never_online(self):
+        view = self.aggregator(attic='http://127.0.0.1:{}'.format(free_port())).poll_once()
+        self.assertFalse(view.nodes['attic']['online'])
+        self.assertIsNone(view.nodes['attic']['temp'])
+
+
+if __name__ == '__main__':
+    main()
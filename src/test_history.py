@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""
+Tests for the history ring buffers: wraparound, range queries,
+downsampling and resizing.
+
+Usage: python -m pytest test_history.py (or python -m unittest)
+"""
+from unittest import TestCase, main
+
+from history import HistoryStore, RingBuffer
+
+
+class RingBufferTest(TestCase):
+
+    def filled(self, capacity, count):
+        ring = RingBuffer(capacity)
+        for t in range(count):
+            ring.append(float(t), 10.0 * t)
+        return ring
+
+    def test_wraparound_keeps_newest(self):
+        ring = self.filled(5, 13)
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(ring.samples(), [(float(t), 10.0 * t) for t in range(8, 13)])
+
+    def test_range_query_across_wrap(self):
+        ring = self.filled(5, 13) # physical start is in the middle of the arrays
+        self.assertEqual([t for t, _ in ring.samples(9.5, 11.0)], [10.0, 11.0]) # until is inclusive
+        self.assertEqual([t for t, _ in ring.samples(since=0.0)], [8.0, 9.0, 10.0, 11.0, 12.0])
+        self.assertEqual(ring.samples(since=12.5), [])
+        self.assertEqual([t for t, _ in ring.samples(until=8.0)], [8.0])
+
+    def test_downsample(self):
+        ring = self.filled(10, 10)
+        buckets = ring.downsample(4.0)
+        self.assertEqual([(bucket_time, count) for bucket_time, _, _, _, count in buckets], [(0.0, 4), (4.0, 4), (8.0, 2)])
+        self.assertEqual(buckets[1][1:4], (40.0, 70.0, 55.0))
+
+    def test_resize_keeps_newest(self):
+        ring = self.filled(5, 13)
+        ring.resize(3)
+        self.assertEqual([t for t, _ in ring.samples()], [10.0, 11.0, 12.0])
+        ring.resize(6)
+        for t in range(13, 17):
+            ring.append(float(t), 10.0 * t)
+        self.assertEqual([t for t, _ in ring.samples()], [11.0, 12.0, 13.0, 14.0, 15.0, 16.0])
+
+    def test_history_store_sized_for_retention(self):
+        history = HistoryStore({'temp': 15.0}, retention_sec=3600)
+        self.assertEqual(history._buffers['temp'].capacity, 241)
+        history.set_interval('temp', 1.0)
+        self.assertEqual(history._buffers['temp'].capacity, 3601)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+Tests for the batched InfluxDB writer, against a local stub server that
+can be made to fail.
+
+Usage: python -m pytest test_influxdb.py (or python -m unittest)
+"""
+from glob import glob
+from gzip import decompress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import monotonic, sleep
+from unittest import TestCase, main
+
+from influxdb import InfluxDBWriter, format_line
+
+
+class StubInfluxDB(BaseHTTPRequestHandler):
+    """
+    Stub /write endpoint. Records every line it accepts, and answers 503
+    while the server's fail flag is set.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append((self.headers.get('Content-Encoding'), monotonic()))
+        if self.server.fail:
+            self.send_response(503)
+        else:
+            self.server.lines.extend(decompress(body).decode('utf-8').splitlines())
+            self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def wait_for(condition, timeout_sec=5.0):
+    deadline = monotonic() + timeout_sec
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+class InfluxDBWriterTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubInfluxDB)
+        self.server.lines = []
+        self.server.posts = [] # (Content-Encoding, time) per POST
+        self.server.fail = False
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.spill_dir = mkdtemp(prefix='pienviro-test-')
+        self.acks = []
+        self.writer = InfluxDBWriter('http://127.0.0.1:{}'.format(self.server.server_port), 'test', batch_size=10, flush_sec=0.01,
+                                     spill_dir=self.spill_dir, spill_after_failures=2, retry_base_sec=0.05, retry_max_sec=1.0,
+                                     timeout_sec=2.0, ack_callback=self.acks.append)
+        self.thread = Thread(target=self.writer.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        self.thread.join(5.0)
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.spill_dir, ignore_errors=True)
+
+    def write(self, first, count):
+        lines = [format_line('env_data', {'temp': 70.0 + i / 100.0}, 1700000000.0 + i) for i in range(first, first + count)]
+        for i, line in enumerate(lines, first + 1):
+            self.writer.write(line, ack=i)
+        return lines
+
+    def test_gzip_batches(self):
+        lines = self.write(0, 25)
+        self.assertTrue(wait_for(lambda: len(self.server.lines) == 25))
+        self.assertEqual(self.server.lines, lines)
+        self.assertTrue(all(encoding == 'gzip' for encoding, _ in self.server.posts))
+        self.assertGreaterEqual(len(self.server.posts), 3) # batch_size 10
+        self.assertTrue(wait_for(lambda: self.acks and self.acks[-1] == 25))
+
+    def test_outage_spills_backs_off_and_replays_once(self):
+        self.server.fail = True
+        lines = self.write(0, 30)
+        self.assertTrue(wait_for(lambda: self.writer.get_stats()['points_spilled'] > 0))
+        outage_start = monotonic()
+        lines += self.write(30, 20) # queued while the server is still down
+        sleep(0.6)
+        stats = self.writer.get_stats()
+        self.assertEqual(self.server.lines, [])
+        self.assertGreater(stats['failed_flushes'], 1)
+        self.assertTrue(glob(join(self.spill_dir, 'spill-*.lp')))
+        retries = [post_time for _, post_time in self.server.posts if post_time >= outage_start]
+        self.assertLess(len(retries), 10) # flush_sec alone would retry ~60 times
+        self.server.fail = False
+        self.assertTrue(wait_for(lambda: len(self.server.lines) >= len(lines)))
+        sleep(0.1)
+        self.assertEqual(sorted(self.server.lines), sorted(lines)) # every point exactly once
+        self.assertEqual(glob(join(self.spill_dir, 'spill-*.lp')), [])
+        self.assertEqual(self.acks[-1], 50)
+        self.assertEqual(self.acks, sorted(self.acks))
+        self.assertEqual(self.writer.queue_depth(), 0)
+
+
+if __name__ == '__main__':
+    main()
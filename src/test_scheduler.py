@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""
+Tests for the shared sampling scheduler, run against a stub Sense HAT.
+
+Usage: python -m pytest test_scheduler.py (or python -m unittest)
+"""
+from threading import Thread
+from time import sleep
+from unittest import TestCase, main
+
+from scheduler import SampleScheduler
+
+
+class StubSenseHat(object):
+    """
+    Sense HAT stand-in that counts reads, and can be made slow or
+    failing.
+    """
+
+    def __init__(self, read_sec=0.0, error=None):
+        self.reads = {'temp': 0, 'humidity': 0, 'press': 0}
+        self.read_sec = read_sec
+        self.error = error # exception raised by humidity reads
+
+    def _read(self, channel, value):
+        self.reads[channel] += 1
+        if self.read_sec: sleep(self.read_sec)
+        return value
+
+    def get_temperature(self):
+        return self._read('temp', 21.0)
+
+    def get_humidity(self):
+        if self.error is not None:
+            self.reads['humidity'] += 1
+            raise self.error
+        return self._read('humidity', 40.0)
+
+    def get_pressure(self):
+        return self._read('press', 1013.25)
+
+
+def create_scheduler(sense_hat, tick_sec=0.5, interval_sec=1.0):
+    scheduler = SampleScheduler(tick_sec=tick_sec)
+    scheduler.add_channel('temp', sense_hat.get_temperature, interval_sec)
+    scheduler.add_channel('humidity', sense_hat.get_humidity, interval_sec)
+    scheduler.add_channel('press', sense_hat.get_pressure, interval_sec)
+    return scheduler
+
+
+class SampleSchedulerTest(TestCase):
+
+    def test_batch_feeds_every_listener(self):
+        sense_hat = StubSenseHat()
+        scheduler = create_scheduler(sense_hat)
+        batches = ([], [])
+        for received in batches:
+            scheduler.add_batch_listener(lambda timestamp, samples, received=received: received.append((timestamp, dict(samples))))
+        samples = scheduler.run_pending(tick=0)
+        self.assertEqual(dict(samples), {'temp': 21.0, 'humidity': 40.0, 'press': 1013.25})
+        self.assertEqual(batches[0], batches[1])
+        self.assertEqual(len(batches[0]), 1) # one batch, one shared timestamp
+        self.assertEqual(sense_hat.reads, {'temp': 1, 'humidity': 1, 'press': 1})
+
+    def test_channels_read_on_their_own_intervals(self):
+        sense_hat = StubSenseHat()
+        scheduler = create_scheduler(sense_hat)
+        scheduler.set_interval('press', 2.0)
+        read = [sorted(scheduler.run_pending(tick=tick)) for tick in range(0, 6, 2)]
+        self.assertEqual(read, [['humidity', 'press', 'temp'], ['humidity', 'temp'], ['humidity', 'press', 'temp']])
+
+    def test_read_first_reads_once_without_listeners(self):
+        sense_hat = StubSenseHat()
+        scheduler = create_scheduler(sense_hat)
+        batches = []
+        scheduler.add_batch_listener(lambda timestamp, samples: batches.append(samples))
+        timestamp, samples = scheduler.read_first()
+        self.assertEqual(sorted(samples), ['humidity', 'press', 'temp'])
+        self.assertEqual(batches, [])
+        self.assertEqual(scheduler.run_pending(tick=0), {}) # channels already advanced past the first tick
+        self.assertEqual(sense_hat.reads, {'temp': 1, 'humidity': 1, 'press': 1})
+        scheduler.notify(timestamp, samples)
+        self.assertEqual(batches, [samples])
+        self.assertEqual(sorted(scheduler.run_pending(tick=2)), ['humidity', 'press', 'temp'])
+
+    def test_notify_skips_listeners(self):
+        scheduler = create_scheduler(StubSenseHat())
+        called = []
+        first = lambda timestamp, samples: called.append('first')
+        scheduler.add_batch_listener(first)
+        scheduler.add_batch_listener(lambda timestamp, samples: called.append('second'))
+        scheduler.notify(0.0, {'temp': 1.0}, skip=(first,))
+        self.assertEqual(called, ['second'])
+
+    def test_slow_reads_count_missed_deadlines(self):
+        scheduler = create_scheduler(StubSenseHat(read_sec=0.02), tick_sec=0.01, interval_sec=0.01)
+        scheduler.run_pending(tick=0) # three 20 ms reads, each channel due every 10 ms
+        stats = scheduler.get_stats()
+        self.assertGreater(stats['missed_deadlines'], 0)
+        for channel in scheduler._channels.values():
+            self.assertGreater(channel.next_tick, 1) # skipped ahead, not bunched up behind
+        self.assertEqual(stats['reads'], 3)
+
+    def test_failing_read_and_listener_keep_loop_running(self):
+        sense_hat = StubSenseHat(error=ValueError('bad reading'))
+        scheduler = create_scheduler(sense_hat, tick_sec=0.01, interval_sec=0.01)
+        batches = []
+        def failing_listener(timestamp, samples):
+            raise OSError('disk full')
+        scheduler.add_batch_listener(failing_listener)
+        scheduler.add_batch_listener(lambda timestamp, samples: batches.append(dict(samples)))
+        thread = Thread(target=scheduler.run)
+        thread.start()
+        sleep(0.2)
+        scheduler.stop()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+        stats = scheduler.get_stats()
+        self.assertGreater(stats['batches'], 5)
+        self.assertEqual(stats['read_errors'], sense_hat.reads['humidity'])
+        self.assertEqual(stats['listener_errors'], len(batches))
+        self.assertTrue(all(sorted(samples) == ['press', 'temp'] for samples in batches))
+
+
+if __name__ == '__main__':
+    main()
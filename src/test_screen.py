@@ -0,0 +1,134 @@
+#!/usr/bin/python
+"""
+Tests for the cached screen renderer: frames must match what
+SenseHat.show_message pushes, at every rotation.
+
+Usage: python -m pytest test_screen.py (or python -m unittest)
+"""
+from unittest import TestCase, main
+
+from backends import VirtualBackend
+from screen import ScreenRenderer
+
+white, black = [255, 255, 255], [0, 0, 0]
+
+
+def rot90(matrix):
+    """
+    Rotate square matrix 90 degrees counter clockwise, like numpy.rot90.
+    """
+    size = len(matrix)
+    return [[matrix[col][size - 1 - row] for col in range(size)] for row in range(size)]
+
+
+class ShowMessageSenseHat(object):
+    """
+    Uncached reference: the sense_hat library's show_message and
+    set_pixels algorithm, writing into an in-memory framebuffer and
+    recording it after every frame.
+    """
+
+    def __init__(self, glyph_func):
+        self._glyph_func = glyph_func
+        self._pix_map = {0: [[row * 8 + col for col in range(8)] for row in range(8)]}
+        for rotation in (90, 180, 270):
+            self._pix_map[rotation] = rot90(self._pix_map[rotation - 90])
+        self._rotation = 0
+        self.framebuffer = [None] * 64
+        self.frames = []
+
+    def set_rotation(self, rotation):
+        self._rotation = rotation
+
+    def _get_char_pixels_trimmed(self, char):
+        return [white if lit else black for column in self._glyph_func(char) for lit in column]
+
+    def set_pixels(self, pixel_list):
+        pix_map = self._pix_map[self._rotation]
+        for index, pixel in enumerate(pixel_list):
+            self.framebuffer[pix_map[index // 8][index % 8]] = tuple(pixel)
+        self.frames.append(list(self.framebuffer))
+
+    def show_message(self, text_string, text_colour, back_colour):
+        previous_rotation = self._rotation
+        self._rotation -= 90
+        if self._rotation < 0: self._rotation = 270
+        dummy_colour = [None, None, None]
+        string_padding = [dummy_colour] * 64
+        letter_padding = [dummy_colour] * 8
+        scroll_pixels = []
+        scroll_pixels.extend(string_padding)
+        for char in text_string:
+            scroll_pixels.extend(self._get_char_pixels_trimmed(char))
+            scroll_pixels.extend(letter_padding)
+        scroll_pixels.extend(string_padding)
+        coloured_pixels = [text_colour if pixel == white else back_colour for pixel in scroll_pixels]
+        scroll_length = len(coloured_pixels) // 8
+        for i in range(scroll_length - 8):
+            start = i * 8
+            self.set_pixels(coloured_pixels[start:start + 64])
+        self._rotation = previous_rotation
+
+
+class ScreenRendererTest(TestCase):
+
+    message = 'Temp: 70.1 degF'
+    text_color, back_color = (0, 0, 255), (0, 0, 0)
+
+    def setUp(self):
+        self.glyph = VirtualBackend().get_glyph
+
+    def test_frames_match_show_message_at_every_rotation(self):
+        renderer = ScreenRenderer(self.glyph)
+        for rotation in (0, 90, 180, 270):
+            reference = ShowMessageSenseHat(self.glyph)
+            reference.set_rotation(rotation)
+            reference.show_message(self.message, self.text_color, self.back_color)
+            frames = renderer.render(self.message, self.text_color, self.back_color, rotation)
+            self.assertEqual(len(frames), len(reference.frames))
+            self.assertEqual(frames, reference.frames, 'rotation {}'.format(rotation))
+
+    def test_message_cache_hits_and_eviction(self):
+        renderer = ScreenRenderer(self.glyph, message_cache_size=2)
+        first = renderer.render('a1', self.text_color, self.back_color)
+        self.assertIs(renderer.render('a1', self.text_color, self.back_color), first)
+        self.assertEqual(renderer.message_hits, 1)
+        renderer.render('b2', self.text_color, self.back_color)
+        renderer.render('a1', self.text_color, self.back_color) # a1 now most recent, b2 is evicted next
+        renderer.render('c3', self.text_color, self.back_color)
+        self.assertIs(renderer.render('a1', self.text_color, self.back_color), first)
+        self.assertEqual(renderer.message_hits, 3)
+        rendered = renderer.frames_rendered
+        self.assertIsNot(renderer.render('b2', self.text_color, self.back_color), None)
+        self.assertEqual(renderer.message_hits, 3) # b2 was evicted, so rendered again...
+        self.assertEqual(renderer.frames_rendered, rendered) # ...from cached frames
+
+    def test_changed_digit_only_renders_frames_it_scrolls_through(self):
+        renderer = ScreenRenderer(self.glyph)
+        frames = renderer.render(self.message, self.text_color, self.back_color, 270)
+        rendered, hits = renderer.frames_rendered, renderer.frame_hits
+        changed = renderer.render(self.message.replace('70.1', '70.2'), self.text_color, self.back_color, 270)
+        new_frames = renderer.frames_rendered - rendered
+        self.assertEqual(len(changed), len(frames))
+        self.assertGreater(new_frames, 0)
+        self.assertLessEqual(new_frames, 5 + 8 - 1) # frames showing any of the changed glyph's 5 columns
+        self.assertEqual(renderer.frame_hits - hits, len(changed) - new_frames)
+
+    def test_frame_cache_lru_eviction(self):
+        renderer = ScreenRenderer(self.glyph, frame_cache_size=3)
+        columns = [[(color,) * 8 for _ in range(8)] for color in ((1, 1, 1), (2, 2, 2), (3, 3, 3), (4, 4, 4))]
+        a, b, c, d = columns
+        renderer._frame(a, 0)
+        renderer._frame(b, 0)
+        renderer._frame(c, 0)
+        renderer._frame(a, 0) # hit, a becomes most recent
+        self.assertEqual((renderer.frames_rendered, renderer.frame_hits), (3, 1))
+        renderer._frame(d, 0) # evicts b, the least recently used
+        renderer._frame(a, 0)
+        self.assertEqual((renderer.frames_rendered, renderer.frame_hits), (4, 2))
+        renderer._frame(b, 0)
+        self.assertEqual((renderer.frames_rendered, renderer.frame_hits), (5, 2))
+
+
+if __name__ == '__main__':
+    main()
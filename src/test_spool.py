@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+Tests for the write-ahead spool: token/ack arithmetic, reopening and
+replay.
+
+Usage: python -m pytest test_spool.py (or python -m unittest)
+"""
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from unittest import TestCase, main
+
+from spool import SampleSpool
+
+channels = ('temp', 'humidity', 'press')
+
+
+class SampleSpoolTest(TestCase):
+
+    def setUp(self):
+        self.spool_dir = mkdtemp(prefix='pienviro-test-')
+        self.midnight = (int(time()) // 86400) * 86400 # UTC, so batches either side are in different segments
+        self.batches = [(self.midnight - 20 + 10 * i, {'temp': 290.0 + i, 'humidity': 40.0 + i, 'press': 101325.0 + i}) for i in range(4)]
+
+    def tearDown(self):
+        rmtree(self.spool_dir, ignore_errors=True)
+
+    def append_all(self, spool):
+        return [spool.append(timestamp, samples) for timestamp, samples in self.batches]
+
+    def test_pending_tokens_match_append_tokens(self):
+        spool = SampleSpool(self.spool_dir, channels)
+        tokens = self.append_all(spool)
+        pending = list(spool.pending())
+        self.assertEqual([token for token, _, _ in pending], tokens)
+        self.assertEqual([(timestamp, samples) for _, timestamp, samples in pending], self.batches)
+        spool.close()
+
+    def test_ack_covers_earlier_batches_and_segments(self):
+        spool = SampleSpool(self.spool_dir, channels)
+        tokens = self.append_all(spool)
+        self.assertNotEqual(tokens[1][0], tokens[2][0]) # batches 0-1 before midnight, 2-3 after
+        spool.ack(tokens[2]) # acks the whole previous day too
+        self.assertEqual([token for token, _, _ in spool.pending()], tokens[3:])
+        spool.ack(tokens[1]) # older token never un-acks
+        self.assertEqual([token for token, _, _ in spool.pending()], tokens[3:])
+        spool.close()
+
+    def test_reopen_keeps_acks_and_replays_everything(self):
+        spool = SampleSpool(self.spool_dir, channels)
+        tokens = self.append_all(spool)
+        spool.ack(tokens[0])
+        spool.close()
+        spool = SampleSpool(self.spool_dir, channels)
+        self.assertEqual([token for token, _, _ in spool.pending()], tokens[1:])
+        self.assertEqual(list(spool.replay()), self.batches)
+        self.assertEqual(list(spool.replay(since=self.batches[2][0])), self.batches[2:])
+        spool.ack(tokens[-1])
+        self.assertEqual(list(spool.pending()), [])
+        spool.close()
+
+    def test_append_after_reopen_continues_segment(self):
+        spool = SampleSpool(self.spool_dir, channels)
+        tokens = self.append_all(spool)
+        spool.close()
+        spool = SampleSpool(self.spool_dir, channels)
+        timestamp = self.batches[-1][0] + 10
+        token = spool.append(timestamp, {'temp': 300.0})
+        self.assertEqual(token, (tokens[-1][0], tokens[-1][1] + 1))
+        self.assertEqual(list(spool.pending())[-1], (token, timestamp, {'temp': 300.0}))
+        spool.close()
+
+
+if __name__ == '__main__':
+    main()
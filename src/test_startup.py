@@ -0,0 +1,51 @@
+#!/usr/bin/python
+"""
+Tests that PiEnviro startup stays off the network and survives a bad
+InfluxDB config.
+
+Usage: python -m pytest test_startup.py (or python -m unittest)
+"""
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from backends import SimulatedSenseHat
+from pi_enviro import PiEnviro
+
+
+class StartupTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix='pienviro-test-')
+
+    def tearDown(self):
+        rmtree(self.temp_dir, ignore_errors=True)
+
+    def pi_enviro(self, influxdb_config):
+        return PiEnviro(influxdb_config=influxdb_config, sense_hat=SimulatedSenseHat(sample_rate_hz=1000),
+                        spool_dir=join(self.temp_dir, 'spool'), archive_dir=join(self.temp_dir, 'archive'))
+
+    def test_invalid_influxdb_config_disables_sink(self):
+        influxdb_config = join(self.temp_dir, 'influxdb.yml')
+        with open(influxdb_config, 'w') as config_file:
+            config_file.write('url: http://127.0.0.1:8086\n') # no db
+        with self.assertLogs('pi_enviro', 'ERROR'):
+            pi_enviro = self.pi_enviro(influxdb_config)
+        self.assertFalse(hasattr(pi_enviro, '_influxdb_writer'))
+        self.assertFalse(hasattr(pi_enviro, '_influxdb_thread_obj'))
+        pi_enviro.get_temp(force_update=True) # samples are spooled and acked without a writer
+        self.assertTrue(pi_enviro.stop(timeout_sec=2.0))
+
+    def test_measurement_not_looked_up_on_startup(self):
+        influxdb_config = join(self.temp_dir, 'influxdb.yml')
+        with open(influxdb_config, 'w') as config_file:
+            config_file.write('url: http://127.0.0.1:8086\ndb: test\n')
+        pi_enviro = self.pi_enviro(influxdb_config)
+        self.assertIsNone(pi_enviro._influxdb_measurement) # looked up by the writer thread
+        pi_enviro._get_ipaddr = lambda: '10.0.0.7'
+        self.assertEqual(pi_enviro._get_influxdb_measurement(), 'env_data[10.0.0.7]')
+
+
+if __name__ == '__main__':
+    main()
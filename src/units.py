@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""
+Units for sensor readings. Readings are stored in canonical SI units
+(kelvin, pascal; relative humidity, which has no SI unit, in percent)
+and converted on the way out. Every supported unit is an affine map to
+its canonical unit, so any conversion between two units of the same
+quantity compiles to one (scale, offset) pair, cached after first use.
+The hot path is one multiply and one add, with no unit objects built.
+"""
+from collections import namedtuple
+
+
+class Conversion(namedtuple('Conversion', ['scale', 'offset'])):
+    """
+    Compiled conversion: value * scale + offset.
+    """
+
+    __slots__ = ()
+
+    def __call__(self, value):
+        return value * self.scale + self.offset if value is not None else None
+
+
+# Unit name -> (quantity, scale, offset) such that canonical = value * scale + offset
+_units = {'K': ('temperature', 1.0, 0.0),
+          'degC': ('temperature', 1.0, 273.15),
+          'degF': ('temperature', 5.0 / 9.0, 273.15 - 32 * 5.0 / 9.0),
+          '%': ('humidity', 1.0, 0.0),
+          'fraction': ('humidity', 100.0, 0.0),
+          'Pa': ('pressure', 1.0, 0.0),
+          'hPa': ('pressure', 100.0, 0.0),
+          'kPa': ('pressure', 1000.0, 0.0),
+          'mbar': ('pressure', 100.0, 0.0),
+          'bar': ('pressure', 100000.0, 0.0),
+          'atm': ('pressure', 101325.0, 0.0),
+          'psi': ('pressure', 6894.757293168361, 0.0),
+          'inHg': ('pressure', 3386.388640341, 0.0), # conventional, at 0 degC
+          'mmHg': ('pressure', 133.322387415, 0.0)}
+
+# Alternative spellings accepted in requests
+_aliases = {'kelvin': 'K', 'C': 'degC', 'celsius': 'degC', 'F': 'degF', 'fahrenheit': 'degF',
+            'percent': '%', 'pct': '%', 'pascal': 'Pa', 'millibar': 'mbar', 'in_Hg': 'inHg', 'mm_Hg': 'mmHg'}
+
+# Quantity measured by each channel, and its canonical unit
+channel_quantities = {'temp': 'temperature', 'humidity': 'humidity', 'press': 'pressure'}
+canonical_units = {'temp': 'K', 'humidity': '%', 'press': 'Pa'}
+
+# Units used for display, the REST API (when no unit is requested) and the InfluxDB export
+display_units = {'temp': 'degF', 'humidity': '%', 'press': 'inHg'}
+
+_conversions = {} # (from unit, to unit) -> Conversion
+
+
+def normalize_unit(unit):
+    """
+    Return canonical spelling of unit name, raise ValueError if it is
+    not a known unit.
+    """
+    unit = _aliases.get(unit, unit)
+    if unit not in _units:
+        raise ValueError('Unknown unit "{}", expected one of {}'.format(unit, ', '.join(sorted(_units))))
+    return unit
+
+
+def get_conversion(from_unit, to_unit):
+    """
+    Return compiled Conversion between two units of the same quantity.
+    Raises ValueError for unknown or incompatible units.
+    """
+    conversion = _conversions.get((from_unit, to_unit))
+    if conversion is None:
+        from_quantity, from_scale, from_offset = _units[normalize_unit(from_unit)]
+        to_quantity, to_scale, to_offset = _units[normalize_unit(to_unit)]
+        if from_quantity != to_quantity:
+            raise ValueError('Cannot convert {} ({}) to {} ({})'.format(from_unit, from_quantity, to_unit, to_quantity))
+        # value -> canonical -> to_unit: ((value * from_scale + from_offset) - to_offset) / to_scale
+        conversion = Conversion(from_scale / to_scale, (from_offset - to_offset) / to_scale)
+        _conversions[(from_unit, to_unit)] = conversion
+    return conversion
+
+
+def convert(value, from_unit, to_unit):
+    """
+    Convert value between units (see get_conversion).
+    """
+    return get_conversion(from_unit, to_unit)(value)
+
+
+def resolve_units(requested, channels=tuple(canonical_units)):
+    """
+    Return dict of channel to output unit, for a list of requested unit
+    names (e.g. from '?unit=degC&unit=hPa'). Each unit applies to the
+    channel that measures its quantity; other channels use their display
+    unit. Raises ValueError for unknown units, or units that don't apply
+    to any of the channels.
+    """
+    units = dict((channel, display_units[channel]) for channel in channels)
+    for unit in requested:
+        unit = normalize_unit(unit)
+        matched = [channel for channel in channels if channel_quantities[channel] == _units[unit][0]]
+        if not matched:
+            raise ValueError('Unit "{}" does not apply to {}'.format(unit, ', '.join(channels)))
+        for channel in matched:
+            units[channel] = unit
+    return units
@@ -1,4 +1,5 @@
 #!/bin/sh
 apt-get -y install sense-hat
 #python /app/beacon.py &
-python /app/rest_api.py
+#python3 /app/fleet.py # run as fleet aggregator instead (reads fleet.yml)
+exec python3 /app/rest_api.py # exec, so docker stop (SIGTERM) reaches the API and it shuts down cleanly